@@ -0,0 +1,863 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the line follower hot path.
+Runs against a fake sysfs tree in tmpfs, so no EV3 brick is required (python-ev3dev2 must be installed).
+
+Functional checks of the same code paths run first, any failing assertion fails the run.
+
+Save the results as a baseline and compare later runs against it:
+    python3 benchmark.py --save-baseline benchmark_baseline.json
+    python3 benchmark.py --baseline benchmark_baseline.json --threshold 0.2
+
+Every result is the best of --repeat runs, and the baseline also stores how far the worst of them was off, the noise
+of the measurement. A run fails when a benchmark got slower than the threshold plus that noise allows, and stays that
+slow when it is run --confirm times again.
+"""
+from line_position_estimator import LinePositionEstimator, reference_line_position
+import argparse
+import json
+import math
+import platform
+import random
+import struct
+import sys
+import time
+
+SAMPLE_VALUES = (97, 95, 60, 12, 8, 55, 93, 98)
+
+
+def measure(function, duration=1.0):
+    """
+    Call function repeatedly for roughly duration seconds.
+    :return: Calls per second.
+    """
+    calls = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    while True:
+        for _ in range(100):
+            function()
+        calls += 100
+        now = time.perf_counter()
+        if now >= deadline:
+            return calls / (now - start)
+
+
+def bench_sensor_read(duration=1.0):
+    from fake_sysfs import FakeSysfs
+    from light_array_sensor import LightArraySensor
+    from calibration import CalibrationProfile
+
+    with FakeSysfs() as sysfs:
+        sysfs.add_port('in1')
+        sysfs.add_light_array('in1', SAMPLE_VALUES)
+        sensor = LightArraySensor(port='in1')
+
+        results = [("read_data (bin_data)", measure(sensor.read_data, duration))]
+        sensor.enable_fast_read()
+        assert sensor.read_data() == SAMPLE_VALUES
+        results.append(("read_data (fast_read)", measure(sensor.read_data, duration)))
+        sensor.calibration = CalibrationProfile([5] * 8, [100] * 8)
+        assert sensor.read_data() == sensor.calibration.normalize(SAMPLE_VALUES)
+        results.append(("read_data (fast_read, calibrated)", measure(sensor.read_data, duration)))
+        sensor.close()
+    return results
+
+
+def bench_acquisition(duration=1.0, period=0.002):
+    """
+    Ticks that each get a sensor frame and then sleep for the rest of a short loop period, reading the bus in the
+    loop versus taking the newest sample from the acquisition thread.
+    """
+    from fake_sysfs import FakeSysfs
+    from light_array_sensor import LightArraySensor
+    from calibration import CalibrationProfile
+    from sensor_acquisition import SensorAcquisition
+
+    with FakeSysfs() as sysfs:
+        sysfs.add_port('in1')
+        sysfs.add_light_array('in1', SAMPLE_VALUES)
+        sensor = LightArraySensor(port='in1', fast_read=True)
+        acquisition = SensorAcquisition(sensor, max_age=0.05)
+
+        def tick(read_frame):
+            start = time.perf_counter()
+            frame = read_frame()
+            assert frame.values == SAMPLE_VALUES
+            return time.perf_counter() - start
+
+        def busy_per_tick(read_frame):
+            ticks = 0
+            total = 0.0
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                total += tick(read_frame)
+                ticks += 1
+                time.sleep(period)
+            return total / ticks
+
+        results = [("read_frame in the loop (us/tick)", busy_per_tick(sensor.read_frame) * 1e6)]
+        acquisition.start()
+        while acquisition.latest()[1] is None:
+            time.sleep(0.001)
+        results.append(("SensorAcquisition.read_frame (us/tick)", busy_per_tick(acquisition.read_frame) * 1e6))
+        acquisition.stop()
+        assert acquisition.stale == 0
+        sensor.close()
+    return results
+
+
+def bench_line_position(duration=1.0):
+    estimator = LinePositionEstimator(max_value=100)
+    rng = random.Random(0)
+    frames = [tuple(rng.randint(0, 100) for _ in range(8)) for _ in range(1000)] + [SAMPLE_VALUES]
+    for frame in frames:
+        assert estimator.estimate(frame) == reference_line_position(frame, 100)
+
+    results = [
+        ("reference_line_position", measure(lambda: reference_line_position(SAMPLE_VALUES, 100), duration)),
+        ("LinePositionEstimator.estimate", measure(lambda: estimator.estimate(SAMPLE_VALUES), duration)),
+    ]
+
+    try:
+        import numpy as np
+    except ImportError:
+        return results
+
+    batch = np.array(frames * 100)
+    positions = estimator.estimate_batch(batch)
+    for frame, position in zip(frames, positions):
+        expected = reference_line_position(frame, 100)
+        assert (expected is None and np.isnan(position)) or expected == position
+    rate = measure(lambda: estimator.estimate_batch(batch), duration) * len(batch)
+    results.append(("LinePositionEstimator.estimate_batch", rate))
+    return results
+
+
+def bench_line_state(duration=1.0):
+    from line_state_estimator import LineStateEstimator
+
+    rng = random.Random(0)
+    # A line drifting across the array with noise, dropouts and outliers, replayed over and over
+    positions = []
+    for index in range(1000):
+        position = 4.5 + 3.0 * math.sin(index * 0.01) + rng.gauss(0, 0.1)
+        if rng.random() < 0.02:
+            position = None
+        elif rng.random() < 0.01:
+            position = rng.uniform(1, 8)
+        positions.append(position)
+
+    results = []
+    for name, samples in (("LineStateEstimator.update", [4.5 + 0.1 * math.sin(index) for index in range(1000)]),
+                          ("LineStateEstimator.update (dropouts)", positions)):
+        estimator = LineStateEstimator()
+        state = {'index': 0, 'time': 0.0}
+
+        def update():
+            index = state['index']
+            state['time'] += 0.01
+            estimator.update(state['time'], samples[index], 0.01)
+            state['index'] = (index + 1) % len(samples)
+
+        results.append((name, measure(update, duration)))
+    return results
+
+
+class AttributeWrites:
+    """
+    Counts the sysfs attribute writes of motors while installed: ev3dev2's attribute writes by name, and the os.pwrite
+    calls of the direct mode.
+    """
+    def __init__(self):
+        self.names = []
+
+    def install(self):
+        import ev3dev2
+        import os
+
+        pwrite = os.pwrite
+        set_attribute = ev3dev2.Device._set_attribute
+        names = self.names
+
+        def counting_pwrite(fd, data, offset):
+            names.append('pwrite')
+            return pwrite(fd, data, offset)
+
+        def counting_set_attribute(device, attribute, name, value):
+            names.append(name)
+            return set_attribute(device, attribute, name, value)
+
+        os.pwrite = counting_pwrite
+        ev3dev2.Device._set_attribute = counting_set_attribute
+        self._restore = (pwrite, set_attribute)
+
+    def uninstall(self):
+        import ev3dev2
+        import os
+
+        os.pwrite, ev3dev2.Device._set_attribute = self._restore
+
+    def take(self):
+        """
+        :return: The names of the attributes written since the last call.
+        """
+        names = list(self.names)
+        del self.names[:]
+        return names
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
+
+
+def bench_motor_commands(duration=1.0):
+    """
+    Commands per second of both motors set directly and through DifferentialDrive. Also counts the attribute writes
+    both issue on the fake motors, and checks that the drive writes nothing for skipped commands, only speed_sp for
+    coalesced ones and a stop only once per motor.
+    """
+    from fake_sysfs import FakeSysfs
+    from ev3_motor import EV3Motor
+    from differential_drive import DifferentialDrive
+
+    # Slowly varying corrections, like the PID output on a gentle curve
+    speeds = [10 + 5 * math.sin(i / 50.0) for i in range(1000)]
+
+    with FakeSysfs() as sysfs:
+        sysfs.add_motor('outA', 'motor0')
+        sysfs.add_motor('outB', 'motor1')
+        left_motor = EV3Motor(port='outA')
+        right_motor = EV3Motor(port='outB')
+        drive = DifferentialDrive(left_motor, right_motor)
+
+        def direct_ticks():
+            for speed in speeds:
+                left_motor.set_speed(speed)
+                right_motor.set_speed(-speed)
+
+        def drive_ticks():
+            for speed in speeds:
+                drive.set_speeds(speed, -speed)
+
+        with AttributeWrites() as writes:
+            direct_ticks()
+            direct_writes = len(writes.take()) / float(len(speeds))
+            left_motor.stop()
+            right_motor.stop()
+            writes.take()
+
+            for _ in range(100):
+                drive.stop()
+            assert not writes.take(), "A stopped drive wrote to the motors"
+            drive.set_speeds(speeds[0], -speeds[0])
+            writes.take()  # The full start
+            for _ in range(100):
+                drive.set_speeds(speeds[0] + 0.1, -speeds[0] - 0.1)
+            assert not writes.take(), "Commands within the deadband were written"
+            sent = drive.commands_sent
+            drive_ticks()
+            coalesced = writes.take()
+            assert set(coalesced) == {'speed_sp'}, set(coalesced)
+            assert len(coalesced) == drive.commands_sent - sent, (len(coalesced), drive.commands_sent - sent)
+            drive_writes = len(coalesced) / float(len(speeds))
+            drive.stop()
+            assert writes.take() == ['stop_action', 'command'] * 2, "Stopping did not stop each motor once"
+            drive.stop()
+            assert not writes.take(), "Stopping a stopped drive wrote to the motors"
+
+        results = [("EV3Motor.set_speed x2 ({:.1f} writes/tick)".format(direct_writes),
+                    measure(direct_ticks, duration) * len(speeds))]
+        drive_rate = measure(drive_ticks, duration) * len(speeds)
+        results.append(("DifferentialDrive.set_speeds ({:.2f} writes/tick)".format(drive_writes), drive_rate))
+    return results
+
+
+def bench_direct_drive(duration=1.0):
+    """
+    Latency of a speed change through motor.on(), through speed_sp and through duty_cycle_sp in run-direct mode.
+    Also checks that a direct mode speed change is exactly one write and that it lands in duty_cycle_sp.
+    :return: List of (name, microseconds per command).
+    """
+    from fake_sysfs import FakeSysfs
+    from ev3_motor import EV3Motor, FeedForwardTable
+
+    speeds = [10 + 5 * math.sin(i / 50.0) for i in range(1000)]
+
+    with FakeSysfs() as sysfs:
+        sysfs.add_motor('outA', 'motor0')
+        motor = EV3Motor(port='outA')
+
+        def set_speed_commands():
+            for speed in speeds:
+                motor.set_speed(speed)
+
+        def update_speed_commands():
+            for speed in speeds:
+                motor.update_speed(speed)
+
+        results = [("EV3Motor.set_speed (on)", 1e6 / (measure(set_speed_commands, duration) * len(speeds)))]
+        results.append(("EV3Motor.update_speed (speed_sp)",
+                        1e6 / (measure(update_speed_commands, duration) * len(speeds))))
+
+        motor.stop()
+        motor.enable_direct_mode(FeedForwardTable(voltage=7.5))
+        sysfs.write_attribute('tacho-motor', 'motor0', 'command', '')  # Plain files keep the tail of longer values
+        motor.set_speed(10)
+
+        # Count the writes of a few hundred direct mode updates
+        with AttributeWrites() as writes:
+            sysfs.write_attribute('tacho-motor', 'motor0', 'duty_cycle_sp', '')
+            for speed in speeds[:200]:
+                motor.update_speed(speed)
+            motor.update_speed(37)
+        names = writes.take()
+        assert names == ['pwrite'] * 201, names
+        assert sysfs.read_attribute('tacho-motor', 'motor0', 'duty_cycle_sp').startswith('43'), \
+            sysfs.read_attribute('tacho-motor', 'motor0', 'duty_cycle_sp')
+        assert sysfs.read_attribute('tacho-motor', 'motor0', 'command') == 'run-direct'
+
+        results.append(("EV3Motor.update_speed (run-direct)",
+                        1e6 / (measure(update_speed_commands, duration) * len(speeds))))
+        motor.disable_direct_mode()
+    return results
+
+
+def bench_control_loop(duration=1.0):
+    """
+    Ticks per second of the floating point pipeline LineFollower uses and of the fixed-point MicroPython core, each
+    reading the sensor and commanding both motors.
+    """
+    from fake_sysfs import FakeSysfs
+    from light_array_sensor import LightArraySensor
+    from ev3_motor import EV3Motor
+    from differential_drive import DifferentialDrive
+    from pid_controller import PIDController
+    from fixed_point_core import (ControlCore, FixedPointEstimator, FixedPointPID, SysfsLightArray, SysfsMotor,
+                                  benchmark_loop)
+
+    with FakeSysfs() as sysfs:
+        sysfs.add_port('in1')
+        sysfs.add_light_array('in1', SAMPLE_VALUES)
+        sysfs.add_motor('outA', 'motor0')
+        sysfs.add_motor('outB', 'motor1')
+
+        sensor = LightArraySensor(port='in1', fast_read=True)
+        drive = DifferentialDrive(EV3Motor(port='outA'), EV3Motor(port='outB'))
+        pid = PIDController(kp=6.5, ki=0.0, kd=6.5, setpoint=4.5, output_limits=(-100, 100))
+
+        def float_tick():
+            frame = sensor.read_frame()
+            correction = pid.compute(frame.position)
+            drive.set_speeds(20 + correction, 20 - correction)
+
+        results = [("float tick (LineFollower pipeline)", measure(float_tick, duration))]
+        drive.stop()
+        sensor.close()
+
+        core = ControlCore(SysfsLightArray('in1', sysfs.root), SysfsMotor('outA', sysfs.root),
+                           SysfsMotor('outB', sysfs.root), FixedPointEstimator(), FixedPointPID(6.5, 0.0, 6.5),
+                           base_speed=20)
+        results.append(("ControlCore.tick (fixed point)", measure(core.tick, duration)))
+        results.append(("ControlCore loop (benchmark_loop)", benchmark_loop(core, 20000)[0]))
+    return results
+
+
+def bench_stages(duration=1.0):
+    """
+    Calls per second of each stage the profiler times, on a LineFollower running against fake devices, and of whole
+    ticks with the profiler disabled and enabled.
+    """
+    from fake_sysfs import FakeSysfs, FakeSysfsBackend
+    from line_follower import LineFollower
+    import contextlib
+    import io
+
+    with FakeSysfs() as sysfs:
+        sysfs.add_line_follower(SAMPLE_VALUES)
+        with contextlib.redirect_stdout(io.StringIO()):
+            follower = LineFollower(backend=FakeSysfsBackend())
+            follower.enable_tuning_server(port=0)
+        follower.profile_path = None
+        follower.running = True
+        frame = follower.sensor.read_frame()
+        speeds = [10 + 5 * math.sin(i / 50.0) for i in range(1000)]
+        follower.left_motor.set_speed(speeds[0])
+
+        def update_speed():
+            for speed in speeds:
+                follower.left_motor.update_speed(speed)
+
+        def tick():
+            # Without end_tick(), which would sleep until the next deadline
+            follower.scheduler.begin_tick()
+            follower.tick()
+
+        stages = [
+            ("read_data", follower.sensor.read_data, 1),
+            ("compute_line_position", lambda: follower.sensor.compute_line_position(SAMPLE_VALUES), 1),
+            ("pid_compute", lambda: follower.pid.compute(frame.position), 1),
+            ("scale_motor_speeds", lambda: follower.scale_motor_speeds(90.0, 120.0), 1),
+            ("motor_update_speed", update_speed, len(speeds)),
+            ("handle_button_presses", follower.handle_button_presses, 1),
+            ("tuning_server", lambda: follower.server.process(follower.apply_command), 1),
+            ("debug_visualization", lambda: follower.debug_visualization(frame), 1),
+            ("tick", tick, 1),
+        ]
+        results = [("stage " + name, measure(function, duration) * calls) for name, function, calls in stages]
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            follower.enable_profiling()
+            results.append(("stage tick (profiling)", measure(tick, duration)))
+            follower.disable_profiling()
+        # Disabled, the profiler must leave the objects exactly as they were
+        for _, owner, name in follower.profiling_hooks():
+            assert getattr(owner, name).__func__ is getattr(type(owner), name), name
+        assert follower.profiler.stages['read_data'].count == follower.profiler.stages['tick'].count
+
+        follower.server.stop()
+        follower.drive.stop()
+        follower.left_motor.stop()
+        follower.speaker.stop()
+    return results
+
+
+def bench_tuning_server(duration=1.0, requests=200):
+    """
+    Loopback test of the tuning server against a simulated LineFollower running in a background thread.
+    :return: Command round trip latencies (a command waits for the next tick boundary), pipelined command throughput
+             and the telemetry rate a subscriber receives.
+    """
+    import contextlib
+    import io
+
+    # The follower reports the updated gains and its statistics on exit
+    with contextlib.redirect_stdout(io.StringIO()):
+        latencies, throughput, telemetry_rate = _run_tuning_server(duration, requests)
+
+    ms = 1000.0
+    return [
+        ("command latency p50 (ms)", latencies[len(latencies) // 2] * ms),
+        ("command latency p99 (ms)", latencies[int(len(latencies) * 0.99)] * ms),
+        ("pipelined commands/s", throughput),
+        ("telemetry samples/s", telemetry_rate),
+    ]
+
+
+def _run_tuning_server(duration, requests):
+    from threading import Thread
+    from line_follower import LineFollower
+    from simulation import SimulationBackend
+    from tuning_server import TuningClient
+
+    follower = LineFollower(backend=SimulationBackend())
+    follower.debug_mode = False
+    follower.enable_tuning_server(port=0, decimation=1)
+    stop = []
+    # The simulated clock runs ahead of real time, so ticks follow each other as fast as the loop runs
+    loop = Thread(target=follower.follow_line, kwargs={'stop_condition': lambda: bool(stop)})
+    loop.start()
+    try:
+        client = TuningClient('127.0.0.1', follower.server.address[1])
+        latencies = []
+        for i in range(requests):
+            start = time.perf_counter()
+            reply = client.request({'cmd': 'set', 'kp': 6.5 + i % 2})
+            latencies.append(time.perf_counter() - start)
+            assert reply['ok'] and reply['kp'] == 6.5 + i % 2
+        assert not client.request({'cmd': 'set', 'kp': float('nan')})['ok']
+        latencies.sort()
+
+        start = time.perf_counter()
+        for i in range(requests):
+            client.send({'cmd': 'set', 'kd': 6.5})
+        replies = 0
+        while replies < requests:
+            if 'id' in client.receive():
+                replies += 1
+        throughput = requests / (time.perf_counter() - start)
+
+        client.request({'cmd': 'subscribe'})
+        client.telemetry.clear()
+        start = time.perf_counter()
+        samples = 0
+        while time.perf_counter() - start < duration:
+            if 'telemetry' in client.receive():
+                samples += 1
+        telemetry_rate = samples / (time.perf_counter() - start)
+        client.close()
+    finally:
+        stop.append(True)
+        loop.join()
+    return latencies, throughput, telemetry_rate
+
+
+def check_reset_stats():
+    """
+    Resetting the loop statistics between two ticks, as the tuning server's reset_stats command does, must not break
+    the loop, and a loop that fails must still stop the motors.
+    """
+    from line_follower import LineFollower
+    from simulation import SimulationBackend
+    import contextlib
+    import io
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        follower = LineFollower(backend=SimulationBackend())
+        follower.debug_mode = False
+        follower.running = True
+        ticks = []
+
+        def reset_midway():
+            ticks.append(follower.scheduler.ticks)
+            if len(ticks) == 50:
+                follower.apply_command({'cmd': 'reset_stats'})
+            return len(ticks) >= 250
+
+        follower.follow_line(stop_condition=reset_midway)
+        assert follower.scheduler.ticks == 200, follower.scheduler.ticks
+
+        follower = LineFollower(backend=SimulationBackend())
+        follower.debug_mode = False
+        follower.running = True
+        tick = follower.tick
+
+        def failing_tick():
+            if follower.scheduler.ticks == 20:
+                raise RuntimeError("Tick failed")
+            tick()
+
+        follower.tick = failing_tick
+        try:
+            follower.follow_line()
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("The failure of the tick was swallowed")
+        world = follower.backend.world
+        assert not world.left_motor._running and not world.right_motor._running
+
+
+def check_button_debounce():
+    """
+    A release within the debounce time of its press is dropped, but must not leave the button pressed.
+    """
+    from ui_events import ButtonEvents
+
+    buttons = ButtonEvents(debounce=0.05)
+    for timestamp, pressed in ((0.0, True), (0.03, False), (1.0, True), (1.01, False), (1.02, True), (1.2, False)):
+        buttons.push('enter', pressed, timestamp)
+    events = []
+    event = buttons.poll()
+    while event is not None:
+        events.append(tuple(event))
+        event = buttons.poll()
+    assert events == [('enter', True, 0.0), ('enter', True, 1.0), ('enter', False, 1.2)], events
+
+
+
+def check_debug_renderer():
+    """
+    The renderer thread draws the published snapshots on a SimulatedDisplay, at most frame_rate times per second and
+    only when something changed, and draws nothing after stop().
+    """
+    from debug_display import DebugRenderer, DebugSnapshot
+    from simulation import SimulatedDisplay
+
+    def wait_for(condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return condition()
+
+    display = SimulatedDisplay()
+    texts = []
+    draw_text = display.draw.text
+
+    def recording_text(xy, text, **kwargs):
+        texts.append(text)
+        return draw_text(xy, text, **kwargs)
+
+    display.draw.text = recording_text
+    renderer = DebugRenderer(display, frame_rate=20, inverted=False)
+    snapshot = DebugSnapshot(values=[100, 100, 100, 10, 10, 100, 100, 100], position=3.5, mode='PID', running=True,
+                             loop_frequency=100.0, kp=6.5, ki=0.0, kd=6.5, left_speed=12, right_speed=8,
+                             scaling_factor=1.0)
+    renderer.publish(snapshot)
+    renderer.start()
+    try:
+        assert renderer.running
+        assert wait_for(lambda: renderer.frames_drawn == 1), renderer.frames_drawn
+        assert display.updates == 1, display.updates
+        assert texts == ["Mode: PID | State: Run", "Kp: 6.50 Ki: 0.00 Kd: 6.50",
+                         "Line Pos: 3.50 | Freq: 100.0 Hz", "L: 12 R: 8 | Scale: 1.00"], texts
+        assert display.image.crop(renderer.bars_box).getextrema() == (0, 255), "No sensor bars drawn"
+
+        # An equal snapshot changes nothing on the screen and is not pushed
+        renderer.publish(snapshot._replace())
+        time.sleep(0.15)
+        assert renderer.frames_drawn == 1 and display.updates == 1, (renderer.frames_drawn, display.updates)
+
+        # Publishing every tick of a 1 kHz loop redraws at the frame rate, only the lines that changed
+        del texts[:]
+        start = time.monotonic()
+        for i in range(300):
+            renderer.publish(snapshot._replace(position=i / 100.0))
+            time.sleep(0.001)
+        elapsed = time.monotonic() - start
+        assert wait_for(lambda: texts and texts[-1] == "Line Pos: 2.99 | Freq: 100.0 Hz"), texts[-1:]
+        frames = renderer.frames_drawn - 1
+        assert 1 <= frames <= elapsed * 20 + 2, (frames, elapsed)
+        assert set(texts) <= {"Line Pos: {:.2f} | Freq: 100.0 Hz".format(i / 100.0) for i in range(300)}, texts
+    finally:
+        renderer.stop()
+
+    assert not renderer.running
+    frames = renderer.frames_drawn
+    renderer.publish(snapshot._replace(mode='Manual'))
+    time.sleep(0.15)
+    assert renderer.frames_drawn == frames and display.updates == frames, "Drew after stop()"
+
+
+def check_fast_read_length():
+    """
+    The fast read path discards short and overlong bin_data instead of unpacking the first 16 bytes of a longer read.
+    """
+    from fake_sysfs import FakeSysfs
+    from light_array_sensor import LightArraySensor
+
+    sample = struct.pack('<8h', *SAMPLE_VALUES)
+    with FakeSysfs() as sysfs:
+        sysfs.add_port('in1')
+        sysfs.add_light_array('in1', SAMPLE_VALUES)
+        for flipped in (False, True):
+            plain = LightArraySensor(port='in1', flipped=flipped)
+            fast = LightArraySensor(port='in1', flipped=flipped, fast_read=True)
+            for data in (sample + b'\0\0', sample + sample, sample[:14], sample):
+                sysfs.write_attribute('lego-sensor', 'sensor0', 'bin_data', data)
+                expected = plain.read_data(warn=False) if len(data) == 16 else None
+                assert fast.read_data(warn=False) == expected, (flipped, len(data), fast.read_data(warn=False))
+            assert expected == (SAMPLE_VALUES[::-1] if flipped else SAMPLE_VALUES), expected
+            fast.close()
+
+
+def check_replay_pid():
+    """
+    Replaying the PID over the telemetry of a simulated run with line losses reproduces the recorded outputs, with and
+    without the line state estimator. Skipped without NumPy.
+    """
+    try:
+        import telemetry_analysis
+    except ImportError:
+        return
+    from line_follower import LineFollower
+    from simulation import SimulationBackend
+    from telemetry import FLAG_RUNNING, FLAG_VALID, FLAG_LINE
+    import contextlib
+    import io
+    import numpy as np
+    import os
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    for estimator in (False, True):
+        path = os.path.join(directory, 'run.lft')
+        with contextlib.redirect_stdout(io.StringIO()):
+            follower = LineFollower(backend=SimulationBackend())
+            follower.debug_mode = False
+            follower.running = True
+            follower.pid.ki = 0.3
+            if estimator:
+                follower.enable_line_estimator()
+            follower.enable_telemetry(path)
+            ticks = []
+
+            def knock_off_line():
+                # Turn the robot off the line every 400 ticks, alternating sides
+                ticks.append(None)
+                if len(ticks) % 400 == 0:
+                    follower.backend.world.heading += 0.6 * (-1) ** (len(ticks) // 400)
+                return len(ticks) > 2000
+
+            follower.follow_line(stop_condition=knock_off_line)
+
+        records = telemetry_analysis.load(path)
+        assert telemetry_analysis.recovery_time(records)['losses'] > 2, telemetry_analysis.recovery_time(records)
+        active = (records['flags'] & (FLAG_RUNNING | FLAG_VALID)) == FLAG_RUNNING | FLAG_VALID
+        positions = np.where(active & (records['flags'] & FLAG_LINE != 0), records['position'], np.nan)
+        if estimator:
+            # The simulated loop has no read to actuate latency
+            _, positions = telemetry_analysis.replay_line_state(records, 0.0, positions)
+        pid = follower.pid
+        outputs = telemetry_analysis.replay_pid(positions, pid.kp, pid.ki, pid.kd, pid.setpoint, pid.output_limits,
+                                                active=active)
+        valid = telemetry_analysis.controlled(records) & ~np.isnan(outputs)
+        difference = np.max(np.abs(outputs[valid] - records['output'][valid]))
+        assert difference < 1e-3, (estimator, difference)
+        os.remove(path)
+    os.rmdir(directory)
+
+# Functional checks, run before the benchmarks. A failing check fails the run.
+CHECKS = [
+    check_reset_stats,
+    check_button_debounce,
+    check_debug_renderer,
+    check_fast_read_length,
+    check_replay_pid,
+]
+
+# Benchmarks in the order they run, with the unit of their results
+BENCHMARKS = [
+    (bench_sensor_read, "reads/s"),
+    (bench_acquisition, "us/tick"),
+    (bench_line_position, "estimates/s"),
+    (bench_line_state, "updates/s"),
+    (bench_motor_commands, "ticks/s"),
+    (bench_direct_drive, "us/command"),
+    (bench_control_loop, "ticks/s"),
+    (bench_stages, "calls/s"),
+    (bench_tuning_server, ""),
+]
+
+
+def is_rate(name, unit):
+    """
+    :return: True if higher is better, i.e. the result is a rate and not a duration.
+    """
+    return '/s' in unit or '/s' in name
+
+
+def slowdown(name, unit, reference, value):
+    """
+    :return: How much slower value is than reference as a fraction, negative if it is faster.
+    """
+    if is_rate(name, unit):
+        return reference / value - 1.0
+    return value / reference - 1.0
+
+
+def run_benchmarks(duration=1.0, selection=None, repeat=3, functions=None):
+    """
+    :param selection: Only run the benchmarks whose function name contains this, all if None.
+    :param repeat: Run every benchmark this many times and keep the best result, to be less sensitive to noise.
+    :param functions: Only run the benchmarks with these function names, all if None.
+    :return: Dict of name -> {'value': best result, 'unit': ..., 'spread': slowdown of the worst run against the
+             best, the noise of the measurement, 'benchmark': function name}.
+    """
+    results = {}
+    for function, unit in BENCHMARKS:
+        if selection is not None and selection not in function.__name__:
+            continue
+        if functions is not None and function.__name__ not in functions:
+            continue
+        runs = {}
+        for _ in range(repeat):
+            for name, value in function(duration):
+                runs.setdefault(name, []).append(value)
+        for name, values in runs.items():
+            best, worst = (max(values), min(values)) if is_rate(name, unit) else (min(values), max(values))
+            print("{:<40} {:>12.{}f} {}".format(name, best, 0 if best >= 100 else 2, unit))
+            results[name] = {'value': best, 'unit': unit, 'benchmark': function.__name__,
+                             'spread': slowdown(name, unit, best, worst) if best and worst else 0.0}
+    return results
+
+
+def run_checks(selection=None):
+    """
+    :param selection: Only run the checks whose function name contains this, all if None.
+    """
+    for check in CHECKS:
+        if selection is not None and selection not in check.__name__:
+            continue
+        check()
+        print("{:<40} {:>12}".format(check.__name__, "ok"))
+
+
+def machine():
+    return "{} {} | Python {}".format(platform.machine(), platform.processor() or platform.node(),
+                                      platform.python_version())
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    :param threshold: Allowed slowdown as a fraction, e.g. 0.2 for 20%, on top of the noise of the baseline's own runs.
+    :return: List of (name, baseline value, value, slowdown, allowed slowdown) of the benchmarks that regressed beyond
+             it.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        reference = baseline['results'].get(name)
+        if reference is None or not reference['value'] or not result['value']:
+            continue
+        allowed = threshold + reference.get('spread', 0.0)
+        change = slowdown(name, result['unit'], reference['value'], result['value'])
+        if change > allowed:
+            regressions.append((name, reference['value'], result['value'], change, allowed))
+    return regressions
+
+
+def confirm_regressions(results, baseline, threshold, duration, repeat, confirmations):
+    """
+    Run the benchmarks that regressed again and keep the better results, so only a regression that shows up in every
+    run fails.
+    :param confirmations: Times to run them again at most.
+    :return: The regressions left, see compare_to_baseline().
+    """
+    regressions = compare_to_baseline(results, baseline, threshold)
+    for _ in range(confirmations):
+        if not regressions:
+            break
+        functions = set(results[name]['benchmark'] for name, _, _, _, _ in regressions)
+        print("Running {} again to confirm the regressions".format(", ".join(sorted(functions))))
+        for name, result in run_benchmarks(duration, repeat=repeat, functions=functions).items():
+            previous = results.get(name)
+            if previous is None or slowdown(name, result['unit'], previous['value'], result['value']) < 0:
+                results[name] = result
+        regressions = compare_to_baseline(results, baseline, threshold)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the line follower hot path against fake devices.")
+    parser.add_argument('--duration', type=float, default=1.0, help="Seconds to run each measurement")
+    parser.add_argument('--repeat', type=int, default=3, help="Keep the best of this many runs of each benchmark")
+    parser.add_argument('--only', default=None, help="Only run the benchmarks whose name contains this, e.g. stages")
+    parser.add_argument('--save-baseline', default=None, help="Store the results in this JSON file")
+    parser.add_argument('--baseline', default=None, help="Compare the results to this JSON file")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="Allowed slowdown against the baseline, on top of the noise measured with it")
+    parser.add_argument('--confirm', type=int, default=2,
+                        help="Run regressed benchmarks this many times again before failing")
+    args = parser.parse_args()
+
+    run_checks(args.only)
+    results = run_benchmarks(args.duration, args.only, args.repeat)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'machine': machine(), 'created': time.time(), 'results': results}, f, indent=2,
+                      sort_keys=True)
+        print("Saved baseline to {}".format(args.save_baseline))
+
+    if args.baseline is None:
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('machine') != machine():
+        print("WARNING: The baseline was measured on {}, this is {}".format(baseline.get('machine'), machine()))
+    regressions = confirm_regressions(results, baseline, args.threshold, args.duration, args.repeat, args.confirm)
+    if not regressions:
+        print("No regressions beyond {:.0%} against {}".format(args.threshold, args.baseline))
+        return
+    print("Regressions beyond {:.0%} against {}:".format(args.threshold, args.baseline))
+    for name, reference, value, change, allowed in regressions:
+        print("  {:<40} {:>12.2f} -> {:>12.2f} ({:.0%} slower, {:.0%} allowed)".format(
+            name, reference, value, change, allowed))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Automatic light array calibration and calibration profiles.
+
+Instead of the sensor's CAL mode, which returns broken data after a mode switch, the robot sweeps the array over the
+line with its motors in RAW mode, records the darkest and brightest reading of every element and normalizes the RAW
+values in software through per-element lookup tables. Profiles are stored by name (e.g. per surface or lighting) in a
+JSON file and the active one is loaded at startup.
+
+Run directly to compare raw and calibrated tracking on a simulated array with uneven elements:
+    python3 calibration.py
+"""
+from operator import getitem
+import json
+import math
+import os
+import time
+
+# Calibration profiles, see load_profile() and save_profile()
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration.json')
+
+
+class CalibrationProfile:
+    """
+    Per-element normalization of RAW values to 0..max_value, from the darkest (line) and brightest (floor) reading
+    of every element.
+
+    Each element gets a lookup table from RAW value to normalized value, so normalize() is a single C level map over
+    the eight values. RAW values beyond the tables are clamped on a slower path.
+    """
+    def __init__(self, minimums, maximums, max_value=100, name='default', created=None):
+        """
+        :param minimums: Darkest RAW reading of each element.
+        :param maximums: Brightest RAW reading of each element.
+        """
+        if len(minimums) != len(maximums):
+            raise ValueError("minimums and maximums must have the same length")
+        for low, high in zip(minimums, maximums):
+            if high <= low:
+                raise ValueError("Every element needs a maximum above its minimum")
+        self.minimums = [int(value) for value in minimums]
+        self.maximums = [int(value) for value in maximums]
+        self.max_value = max_value
+        self.name = name
+        self.created = created if created is not None else time.time()
+
+        # Tables cover 0 up to the largest maximum, RAW readings are not negative
+        self.size = max(self.maximums) + 1
+        self.tables = [self._table(low, high) for low, high in zip(self.minimums, self.maximums)]
+
+    def _table(self, low, high):
+        scale = float(self.max_value) / (high - low)
+        return bytes(max(0, min(self.max_value, int(round((raw - low) * scale)))) for raw in range(self.size))
+
+    def normalize(self, values):
+        """
+        :param values: RAW values, one per element.
+        :return: Tuple of normalized values, 0 at the element's minimum and max_value at its maximum.
+        """
+        try:
+            if min(values) >= 0:
+                return tuple(map(getitem, self.tables, values))
+        except IndexError:
+            pass
+        last = self.size - 1
+        return tuple(table[max(0, min(last, value))] for table, value in zip(self.tables, values))
+
+    def contrast(self):
+        """
+        :return: The smallest difference between maximum and minimum of any element.
+        """
+        return min(high - low for low, high in zip(self.minimums, self.maximums))
+
+    def to_dict(self):
+        return {
+            'minimums': self.minimums,
+            'maximums': self.maximums,
+            'max_value': self.max_value,
+            'created': self.created,
+        }
+
+    @classmethod
+    def from_dict(cls, name, data):
+        return cls(data['minimums'], data['maximums'], data.get('max_value', 100), name, data.get('created'))
+
+
+def sweep(sensor, drive, clock, sleep, speed=15, sweep_time=0.6, sample_interval=0.005, min_contrast=20):
+    """
+    Calibrate by turning the robot in place over the line: a sweep to one side, twice as long back to the other side
+    and back to the start, while recording every element's darkest and brightest RAW reading.
+    The robot should start centered over the line, with the line across the array.
+    :param sensor: The LightArraySensor, switched to RAW mode and read without any calibration.
+    :param drive: The DifferentialDrive to turn with.
+    :param clock: Clock of the backend, the simulator's virtual clock in simulation.
+    :param sleep: Sleep of the backend.
+    :param speed: Turning speed of the wheels.
+    :param sweep_time: Seconds to turn to one side.
+    :param min_contrast: Smallest acceptable difference between an element's minimum and maximum.
+    :return: A CalibrationProfile named 'default'.
+    :raises RuntimeError: If some element did not see both the line and the floor.
+    """
+    previous = sensor.calibration
+    sensor.calibration = None
+    if sensor.mode != "RAW":
+        sensor.set_mode("RAW")
+
+    count = None
+    minimums = maximums = None
+    try:
+        for direction, duration in ((1, sweep_time), (-1, 2 * sweep_time), (1, sweep_time)):
+            drive.set_speeds(direction * speed, -direction * speed)
+            end = clock() + duration
+            while clock() < end:
+                values = sensor.read_data(warn=False)
+                if values is not None:
+                    if minimums is None:
+                        count = len(values)
+                        minimums = list(values)
+                        maximums = list(values)
+                    for i in range(count):
+                        value = values[i]
+                        if value < minimums[i]:
+                            minimums[i] = value
+                        elif value > maximums[i]:
+                            maximums[i] = value
+                sleep(sample_interval)
+    finally:
+        drive.stop()
+        sensor.calibration = previous
+
+    if minimums is None:
+        raise RuntimeError("No valid sensor data during the calibration sweep")
+    weak = [i for i in range(count) if maximums[i] - minimums[i] < min_contrast]
+    if weak:
+        raise RuntimeError("Calibration failed, elements {} did not see both the line and the floor".format(
+            ", ".join(str(i) for i in weak)))
+    return CalibrationProfile(minimums, maximums, max_value=sensor.max_value)
+
+
+def load_profiles(path=CALIBRATION_FILE):
+    """
+    :return: (dict of name to CalibrationProfile, name of the active profile or None).
+    """
+    if not os.path.exists(path):
+        return {}, None
+    with open(path) as f:
+        data = json.load(f)
+    profiles = dict((name, CalibrationProfile.from_dict(name, entry)) for name, entry in data['profiles'].items())
+    return profiles, data.get('active')
+
+
+def load_profile(name=None, path=CALIBRATION_FILE):
+    """
+    :param name: Profile to load, the active one if None.
+    :return: The CalibrationProfile, or None if there is no such profile.
+    """
+    profiles, active = load_profiles(path)
+    return profiles.get(name if name is not None else active)
+
+
+def save_profile(profile, name=None, path=CALIBRATION_FILE, activate=True):
+    """
+    Add or replace a profile in the profiles file.
+    :param name: Name to store it under, e.g. the surface or the lighting, the profile's own name if None.
+    :param activate: Make it the profile loaded at startup.
+    """
+    if name is not None:
+        profile.name = name
+    profiles, active = load_profiles(path)
+    profiles[profile.name] = profile
+    if activate or active is None:
+        active = profile.name
+    data = {
+        'active': active,
+        'profiles': dict((key, value.to_dict()) for key, value in profiles.items()),
+    }
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.rename(temporary, path)
+
+
+def compare(track='rounded', duration=60.0, base_speed=30):
+    """
+    Drive a simulated array with uneven elements without and with an automatic sweep calibration.
+    :return: (list of (label, world summary), the CalibrationProfile, heading change in degrees after the sweep).
+    """
+    from line_follower import LineFollower
+    from simulation import SimulationBackend, TRACKS, run_simulation
+    import contextlib
+    import io
+
+    track = TRACKS[track]()
+    # Elements differ by up to a third in sensitivity and offset, like a worn array under uneven light
+    whites = (62, 95, 78, 100, 70, 90, 60, 98)
+    blacks = (20, 8, 14, 5, 25, 10, 18, 6)
+
+    def create_follower():
+        follower = LineFollower(backend=SimulationBackend(track=track, sensor_white=whites, sensor_black=blacks))
+        follower.debug_mode = False
+        follower.base_speed = base_speed
+        return follower
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Calibrate on a robot of its own, so the sweep does not count towards the tracking error and lap times
+        calibrating = create_follower()
+        world = calibrating.backend.world
+        heading = world.heading
+        profile = sweep(calibrating.sensor, calibrating.drive, calibrating.backend.clock, calibrating.backend.sleep)
+        calibrating.backend.sleep(0.2)
+        drift = math.degrees(world.heading - heading)
+
+    results = []
+    for label in ("raw", "calibrated"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            follower = create_follower()
+            if label == "calibrated":
+                follower.sensor.calibration = profile
+            summary = run_simulation(follower, duration)
+        results.append((label, summary))
+    return results, profile, drift
+
+
+if __name__ == "__main__":
+    results, profile, drift = compare()
+    print("sweep      | minimums {} | maximums {} | heading change {:.1f} degrees".format(
+        profile.minimums, profile.maximums, drift))
+    for label, summary in results:
+        lap_time = sum(summary['lap_times']) / len(summary['lap_times']) if summary['lap_times'] else float('nan')
+        print("{:<10} | laps {:2d} | lap time {:6.2f} s | RMS error {:5.1f} mm | max error {:5.1f} mm | "
+              "off track {}".format(label, summary['laps'], lap_time, summary['rms_error'], summary['max_error'],
+                                    summary['off_track']))
@@ -0,0 +1,185 @@
+from collections import namedtuple
+from threading import Event, Thread
+import time
+
+# Everything the debug screen shows, published by the control loop once per tick.
+DebugSnapshot = namedtuple('DebugSnapshot', [
+    'values', 'position', 'mode', 'running', 'loop_frequency',
+    'kp', 'ki', 'kd', 'left_speed', 'right_speed', 'scaling_factor',
+])
+
+
+class DebugRenderer:
+    """
+    Draws the debug screen on the EV3 display from a background thread at a fixed frame rate.
+    The control loop only publishes snapshots, the renderer picks up the latest one, redraws the regions whose
+    content changed and pushes the framebuffer only if something was redrawn.
+    """
+    SCREEN_WIDTH = 178
+    SCREEN_HEIGHT = 128
+    MAX_BAR_HEIGHT = 64  # Half of the screen height reserved for sensor bars
+    TEXT_HEIGHT = 14
+
+    def __init__(self, display=None, max_value=100, num_sensors=8, frame_rate=8, inverted=True, create_display=None):
+        """
+        :param display: An ev3dev2 Display or any object with image, draw and update().
+        :param max_value: Maximum sensor value, used to scale the bars.
+        :param frame_rate: Redraws per second.
+        :param inverted: Mirror the bars horizontally (sensor mounted facing backwards).
+        :param create_display: Function returning the display (or None if there is none) if display is None. Called
+                               in the renderer thread on the first start(), so the display and Pillow are only loaded
+                               when the debug screen is used and never delay the control loop.
+        """
+        self.display = None
+        self.max_value = max_value
+        self.num_sensors = num_sensors
+        self.frame_period = 1.0 / frame_rate
+        self.inverted = inverted
+        self.available = True  # False once create_display() returned no display
+
+        self.bar_width = self.SCREEN_WIDTH // num_sensors
+        self._create_display = create_display
+        self.frames_drawn = 0
+        self._snapshot = None
+        self._region_keys = []
+        self._stop_event = Event()
+        self._thread = None
+        if display is not None:
+            self._setup(display)
+
+    def _setup(self, display):
+        self.bars_box = (0, 0, display.image.size[0], self.MAX_BAR_HEIGHT + 1)
+        self.text_boxes = [(0, y, display.image.size[0], y + self.TEXT_HEIGHT) for y in (66, 80, 94, 108)]
+        self._region_keys = [None] * (1 + len(self.text_boxes))
+        self.display = display
+        self._chrome = self._build_chrome()
+
+    def _bar_x(self, i):
+        if self.inverted:
+            x1 = self.SCREEN_WIDTH - ((i + 1) * self.bar_width)
+        else:
+            x1 = i * self.bar_width
+        return x1, x1 + self.bar_width - 2
+
+    def _build_chrome(self):
+        """
+        Prebuild the static part of the screen (bar outlines) once, regions are reset by pasting from it.
+        """
+        from PIL import Image, ImageDraw
+
+        chrome = Image.new(self.display.image.mode, self.display.image.size, 'white')
+        draw = ImageDraw.Draw(chrome)
+        for i in range(self.num_sensors):
+            x1, x2 = self._bar_x(i)
+            draw.rectangle((x1, self.SCREEN_HEIGHT // 2 - self.MAX_BAR_HEIGHT, x2, self.SCREEN_HEIGHT // 2), outline='black')
+        return chrome
+
+    def publish(self, snapshot):
+        """
+        Hand the latest state to the renderer. Only a reference assignment, cheap enough for every control tick.
+        """
+        self._snapshot = snapshot
+
+    def start(self):
+        if self._thread is not None or not self.available:
+            return
+        self._stop_event.clear()
+        self._region_keys = [None] * len(self._region_keys)
+        self._thread = Thread(target=self._run, name='DebugRenderer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def _run(self):
+        if self.display is None:
+            display = self._create_display()
+            if display is None:
+                self.available = False
+                return
+            self._setup(display)
+
+        last_snapshot = None
+        next_frame = time.monotonic()
+        while not self._stop_event.is_set():
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot is not last_snapshot:
+                self.render(snapshot)
+                last_snapshot = snapshot
+            next_frame += self.frame_period
+            delay = next_frame - time.monotonic()
+            if delay < 0:
+                next_frame = time.monotonic()
+                delay = 0
+            self._stop_event.wait(delay)
+
+    def render(self, snapshot):
+        """
+        Redraw the regions whose content differs from the last rendered snapshot.
+        :return: True if the display was updated.
+        """
+        keys = [(snapshot.values, snapshot.position)] + self._text_lines(snapshot)
+
+        changed = False
+        for region, key in enumerate(keys):
+            if key == self._region_keys[region]:
+                continue
+            self._region_keys[region] = key
+            changed = True
+            if region == 0:
+                self._draw_bars(snapshot)
+            else:
+                box = self.text_boxes[region - 1]
+                self._restore(box)
+                self.display.draw.text((5, box[1]), key, fill='black')
+
+        if changed:
+            self.display.update()
+            self.frames_drawn += 1
+        return changed
+
+    def _text_lines(self, snapshot):
+        if snapshot.position is not None:
+            position_line = "Line Pos: {:.2f} | Freq: {:.1f} Hz".format(snapshot.position, snapshot.loop_frequency)
+        else:
+            position_line = "Line Pos: N/A | Freq: {:.1f} Hz".format(snapshot.loop_frequency)
+        return [
+            "Mode: {} | State: {}".format(snapshot.mode, "Run" if snapshot.running else "Stop"),
+            "Kp: {:.2f} Ki: {:.2f} Kd: {:.2f}".format(snapshot.kp, snapshot.ki, snapshot.kd),
+            position_line,
+            "L: {:.0f} R: {:.0f} | Scale: {:.2f}".format(snapshot.left_speed, snapshot.right_speed, snapshot.scaling_factor),
+        ]
+
+    def _restore(self, box):
+        self.display.image.paste(self._chrome.crop(box), box[:2])
+
+    def _draw_bars(self, snapshot):
+        self._restore(self.bars_box)
+        draw = self.display.draw
+
+        if snapshot.values is None:
+            draw.text((5, 10), "Invalid sensor data", fill='black')
+            return
+
+        for i, value in enumerate(snapshot.values):
+            normalized_value = max(0, min(value, self.max_value))  # Clamp to [0, max_value]
+            bar_height = int(((self.max_value - normalized_value) / self.max_value) * self.MAX_BAR_HEIGHT)
+            x1, x2 = self._bar_x(i)
+            draw.rectangle((x1, self.SCREEN_HEIGHT // 2 - bar_height, x2, self.SCREEN_HEIGHT // 2), fill='black')
+
+        if snapshot.position is not None:
+            num_sensors = len(snapshot.values)
+            if self.inverted:
+                line_x = self.SCREEN_WIDTH - int((snapshot.position / num_sensors) * self.SCREEN_WIDTH)
+            else:
+                line_x = int((snapshot.position / num_sensors) * self.SCREEN_WIDTH)
+            draw.line((line_x, 0, line_x, self.MAX_BAR_HEIGHT), fill='black', width=2)
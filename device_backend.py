@@ -0,0 +1,87 @@
+from light_array_sensor import LightArraySensor
+from ev3_motor import EV3Motor, FeedForwardTable, read_battery_voltage
+from startup import retry
+from threading import Lock
+import os
+import time
+
+
+class EV3DevBackend:
+    """
+    Creates the devices LineFollower uses on a real EV3 brick running ev3dev.
+
+    A backend provides the sensor, the motors, buttons, sound and display and the clock the control loop is scheduled
+    on. See simulation.SimulationBackend for the hardware-free counterpart.
+    """
+    clock = staticmethod(time.monotonic)
+    sleep = staticmethod(time.sleep)
+    timer = staticmethod(time.monotonic)  # Used to measure how long each loop phase takes
+
+    def __init__(self, sensor_port='in1', sensor_flipped=False, direct_drive=False, feed_forward_points=None):
+        """
+        :param direct_drive: Drive the motors in run-direct mode, see EV3Motor.enable_direct_mode(). The PID gains
+                             will need retuning, since the motors' speed regulation no longer smooths the commands.
+        :param feed_forward_points: Measured (speed, duty cycle) points for the FeedForwardTable of direct drive, see
+                                    ev3_motor.measure_feed_forward(). The rough defaults if None.
+        """
+        self.sensor_port = sensor_port
+        self.sensor_flipped = sensor_flipped
+        self.direct_drive = direct_drive
+        self.feed_forward_points = feed_forward_points
+        self._sound = None
+        self._feed_forward = None
+        self._feed_forward_lock = Lock()  # The motors are brought up in parallel
+
+    def create_sound(self):
+        """
+        :return: The shared Sound instance, created (and ev3dev2.sound imported) on the first call.
+        """
+        if self._sound is None:
+            from ev3dev2.sound import Sound
+            self._sound = Sound()
+        return self._sound
+
+    def create_sensor(self):
+        return LightArraySensor(port=self.sensor_port, flipped=self.sensor_flipped, create_sound=self.create_sound)
+
+    def create_motor(self, port, timeout=5.0):
+        """
+        :param timeout: Seconds to keep retrying while the motor is not found, e.g. right after boot.
+        """
+        from ev3dev2 import DeviceNotFound
+        motor = retry(lambda: EV3Motor(port=port, motor_type='large'), DeviceNotFound, timeout=timeout)
+        if self.direct_drive:
+            motor.enable_direct_mode(self.feed_forward())
+        return motor
+
+    def feed_forward(self):
+        """
+        :return: The FeedForwardTable shared by the motors, compensated for the battery voltage at start up.
+        """
+        with self._feed_forward_lock:
+            if self._feed_forward is None:
+                options = {'points': self.feed_forward_points} if self.feed_forward_points else {}
+                self._feed_forward = FeedForwardTable(voltage=read_battery_voltage(), **options)
+        return self._feed_forward
+
+    def create_button_events(self):
+        """
+        :return: A ButtonEvents queue fed by the brick buttons' evdev device, or by polling if it is not available.
+        """
+        from ui_events import BUTTONS_FILENAME, EvdevButtonReader, PollingButtonReader
+
+        if os.path.exists(BUTTONS_FILENAME):
+            return EvdevButtonReader(BUTTONS_FILENAME)
+        from ev3dev2.button import Button
+        return PollingButtonReader(Button())
+
+    def create_display(self):
+        """
+        Imports Pillow and maps the framebuffer, so LineFollower only calls this from the renderer thread.
+        :return: The EV3 display, or None if it can not be used.
+        """
+        try:
+            from ev3dev2.display import Display
+        except ImportError:
+            return None
+        return Display()
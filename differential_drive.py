@@ -0,0 +1,75 @@
+class DifferentialDrive:
+    """
+    Coalesces the speed commands for a pair of EV3Motor instances.
+    Remembers the last command sent to each motor: a running motor only gets its speed_sp updated, changes smaller
+    than the deadband are not written at all and stop is only sent when a motor actually transitions to stopped.
+    """
+    def __init__(self, left_motor, right_motor, deadband=0.5, brake=True):
+        """
+        :param left_motor: EV3Motor driving the left wheel.
+        :param right_motor: EV3Motor driving the right wheel.
+        :param deadband: Speed changes (in percent) below this are not sent to the motor.
+        :param brake: Brake instead of coast when stopping.
+        """
+        self.left_motor = left_motor
+        self.right_motor = right_motor
+        self.deadband = deadband
+        self.brake = brake
+
+        # Last requested speeds, for display and telemetry
+        self.left_speed = 0
+        self.right_speed = 0
+
+        self.commands_sent = 0
+        self.commands_skipped = 0
+
+        # Speed last written to each motor, None while stopped
+        self._left_sent = None
+        self._right_sent = None
+
+    def set_speeds(self, left_speed, right_speed):
+        """
+        :param left_speed: Speed percentage (-100 to 100) of the left motor.
+        :param right_speed: Speed percentage (-100 to 100) of the right motor.
+        """
+        self.left_speed = left_speed
+        self.right_speed = right_speed
+        self._left_sent = self._command(self.left_motor, self._left_sent, left_speed)
+        self._right_sent = self._command(self.right_motor, self._right_sent, right_speed)
+
+    def _command(self, motor, sent, speed):
+        if sent is None:
+            motor.set_speed(speed)  # Full start: speed_sp, stop_action and run-forever
+        elif abs(speed - sent) < self.deadband:
+            self.commands_skipped += 1
+            return sent
+        else:
+            motor.update_speed(speed)
+        self.commands_sent += 1
+        return speed
+
+    def stop(self):
+        """
+        Stop both motors, only motors that are not already stopped get a command.
+        """
+        self.left_speed = 0
+        self.right_speed = 0
+        if self._left_sent is not None:
+            self.left_motor.stop(brake=self.brake)
+            self._left_sent = None
+            self.commands_sent += 1
+        if self._right_sent is not None:
+            self.right_motor.stop(brake=self.brake)
+            self._right_sent = None
+            self.commands_sent += 1
+
+    def invalidate(self):
+        """
+        Forget the cached state, e.g. after the motors were commanded directly. The next set_speeds() does a full start.
+        """
+        self._left_sent = None
+        self._right_sent = None
+
+    @property
+    def stopped(self):
+        return self._left_sent is None and self._right_sent is None
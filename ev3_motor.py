@@ -1,29 +1,130 @@
 from ev3dev2.motor import LargeMotor, MediumMotor, OUTPUT_A, OUTPUT_B, OUTPUT_C, OUTPUT_D
 from ev3dev2.motor import SpeedPercent, SpeedDPS, SpeedRPM
+import os
 import time
 
+# Rough no-load response of a large motor in run-direct mode at REFERENCE_VOLTAGE: (speed in percent of max_speed,
+# duty cycle in percent). The motor does not turn below about 10% duty cycle. Measure your own with
+# measure_feed_forward().
+DEFAULT_FEED_FORWARD = [(0, 0), (1, 10), (100, 100)]
+REFERENCE_VOLTAGE = 7.5
+
+# duty_cycle_sp contents for -100..100, so a direct mode command writes a prebuilt buffer
+DUTY_CYCLE_STRINGS = [str(duty).encode() for duty in range(-100, 101)]
+
+
+class FeedForwardTable:
+    """
+    Maps a speed percentage to the duty cycle that turns the wheel at that speed in run-direct mode.
+
+    The response is interpolated from points measured at a reference battery voltage. The speed a duty cycle gives
+    is roughly proportional to the battery voltage, so the duty cycles are scaled by reference / actual voltage and
+    the robot responds the same on a full and on a tired battery. The table is rebuilt by set_voltage(), lookups are a
+    single list index.
+    """
+    def __init__(self, points=DEFAULT_FEED_FORWARD, reference_voltage=REFERENCE_VOLTAGE, voltage=None):
+        """
+        :param points: List of (speed percent, duty cycle percent) measured at reference_voltage, ascending.
+        :param voltage: Current battery voltage, reference_voltage if None.
+        """
+        self.points = sorted(points)
+        self.reference_voltage = reference_voltage
+        self.set_voltage(voltage if voltage is not None else reference_voltage)
+
+    def _interpolate(self, speed):
+        points = self.points
+        if speed <= points[0][0]:
+            return points[0][1]
+        for (speed1, duty1), (speed2, duty2) in zip(points, points[1:]):
+            if speed <= speed2:
+                return duty1 + (duty2 - duty1) * (speed - speed1) / float(speed2 - speed1)
+        return points[-1][1]
+
+    def set_voltage(self, voltage):
+        """
+        Rebuild the table for the current battery voltage.
+        """
+        self.voltage = voltage
+        scale = self.reference_voltage / voltage
+        self.table = [min(100, int(round(self._interpolate(speed) * scale))) for speed in range(101)]
+
+    def duty_cycle(self, speed):
+        """
+        :param speed: Speed percentage (-100 to 100).
+        :return: Duty cycle percentage (-100 to 100).
+        """
+        duty = self.table[min(100, int(round(abs(speed))))]
+        return duty if speed >= 0 else -duty
+
+
+def read_battery_voltage():
+    """
+    :return: The battery voltage in volts.
+    """
+    from ev3dev2.power import PowerSupply
+    return PowerSupply().measured_volts
+
+
 class EV3Motor:
     """
     A simple library for controlling LEGO EV3 motors.
     """
 
-    def __init__(self, port, motor_type='large'):
+    def __init__(self, port, motor_type='large', motor=None):
         """
         Initialize the motor.
 
         :param port: The motor port (e.g., OUTPUT_A, OUTPUT_B, OUTPUT_C, OUTPUT_D).
         :param motor_type: The type of motor ('large' or 'medium').
+        :param motor: An already initialized ev3dev2 motor (or a stand-in such as a simulated motor) to use instead.
         """
-        if motor_type == 'large':
+        if motor is not None:
+            self.motor = motor
+        elif motor_type == 'large':
             self.motor = LargeMotor(port)
         elif motor_type == 'medium':
             self.motor = MediumMotor(port)
         else:
             raise ValueError("Invalid motor type. Use 'large' or 'medium'.")
 
+        self.feed_forward = None
+        self._duty_fd = None
+        self._direct_running = False
+
+    def enable_direct_mode(self, feed_forward=None):
+        """
+        Switch set_speed() and update_speed() to run-direct mode: the motor's own speed regulation is bypassed and a
+        speed is a duty cycle written to duty_cycle_sp through a persistent file descriptor. Once the motor runs, every
+        speed change is a single write.
+        :param feed_forward: FeedForwardTable translating speeds into duty cycles, speed percent = duty cycle if None.
+        """
+        if self._duty_fd is not None:
+            return
+        self.feed_forward = feed_forward
+        self._duty_fd = os.open(os.path.join(self.motor._path, 'duty_cycle_sp'), os.O_WRONLY)
+        self._direct_running = False
+
+    def disable_direct_mode(self):
+        if self._duty_fd is None:
+            return
+        self.stop()
+        os.close(self._duty_fd)
+        self._duty_fd = None
+
+    @property
+    def direct_mode(self):
+        return self._duty_fd is not None
+
+    def _write_duty_cycle(self, speed):
+        if self.feed_forward is not None:
+            duty = self.feed_forward.duty_cycle(speed)
+        else:
+            duty = max(-100, min(100, int(round(speed))))
+        os.pwrite(self._duty_fd, DUTY_CYCLE_STRINGS[duty + 100], 0)
 
     def stop(self, brake=True):
         self.motor.off(brake=brake)
+        self._direct_running = False
 
     def run_to_position(self, position, speed=50, brake=True):
         """
@@ -32,6 +133,7 @@ class EV3Motor:
         :param brake: Whether to brake when the position is reached.
         """
         self.motor.on_to_position(SpeedPercent(speed), position, brake=brake)
+        self._direct_running = False
 
     def run_timed(self, time_ms, speed=50):
         """
@@ -39,6 +141,7 @@ class EV3Motor:
         :param speed: Speed percentage (-100 to 100).
         """
         self.motor.on_for_seconds(SpeedPercent(speed), time_ms / 1000)
+        self._direct_running = False
 
     def run_to_rel_position(self, rel_position, speed=50, brake=True):
         """
@@ -47,13 +150,31 @@ class EV3Motor:
         :param brake: Whether to brake when the position is reached.
         """
         self.motor.on_for_degrees(SpeedPercent(speed), rel_position, brake=brake)
+        self._direct_running = False
 
     def set_speed(self, speed):
         """
         :param speed: Speed percentage (-100 to 100).
         """
+        if self._duty_fd is not None:
+            self._write_duty_cycle(speed)
+            if not self._direct_running:
+                self.motor.command = 'run-direct'
+                self._direct_running = True
+            return
         self.motor.on(SpeedPercent(speed))
 
+    def update_speed(self, speed):
+        """
+        Change the speed of a motor that is already running from set_speed(). Only writes speed_sp, or duty_cycle_sp
+        in direct mode.
+        :param speed: Speed percentage (-100 to 100).
+        """
+        if self._duty_fd is not None:
+            self._write_duty_cycle(speed)
+            return
+        self.motor.speed_sp = int(round(SpeedPercent(speed).to_native_units(self.motor)))
+
     def get_position(self):
         """
         :return: Current position in degrees.
@@ -65,6 +186,37 @@ class EV3Motor:
         Reset the motor's position to 0 degrees.
         """
         self.motor.reset()
+        self._direct_running = False
+
+
+def measure_feed_forward(motor, duty_cycles=range(0, 101, 10), settle=1.0, samples=10):
+    """
+    Measure the run-direct response of a motor with the wheel off the ground.
+    :param motor: An EV3Motor.
+    :param settle: Seconds to let the speed settle at every duty cycle.
+    :return: FeedForwardTable of the measured points, referenced to the battery voltage during the measurement.
+    """
+    voltage = read_battery_voltage()
+    motor.enable_direct_mode()
+    max_speed = float(motor.motor.max_speed)
+    points = []
+    try:
+        for duty in duty_cycles:
+            motor.set_speed(duty)
+            time.sleep(settle)
+            speed = 0.0
+            for _ in range(samples):
+                speed += motor.motor.speed
+                time.sleep(0.02)
+            points.append((100.0 * speed / samples / max_speed, duty))
+    finally:
+        motor.stop()
+    # The response has to be increasing to be inverted, drop points that did not speed up (e.g. the dead zone)
+    increasing = [points[0]]
+    for speed, duty in points[1:]:
+        if speed > increasing[-1][0]:
+            increasing.append((speed, duty))
+    return FeedForwardTable(increasing, reference_voltage=voltage, voltage=voltage)
 
 
 
@@ -0,0 +1,150 @@
+from ev3dev2 import Device
+from device_backend import EV3DevBackend
+import os
+import shutil
+import struct
+import tempfile
+
+
+class FakeSysfs:
+    """
+    A fake /sys/class tree in a temporary directory (tmpfs if available) that ev3dev2 devices can be opened on.
+    Used to benchmark and exercise the sysfs code paths without an EV3 brick.
+    """
+    def __init__(self, root=None):
+        """
+        :param root: Directory to build the tree in. A new temporary directory is created if None.
+        """
+        if root is None:
+            base = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            root = tempfile.mkdtemp(prefix='fake-sysfs-', dir=base)
+        self.root = root
+        self._previous_root = None
+
+    def device_path(self, class_name, name):
+        return os.path.join(self.root, class_name, name)
+
+    def add_device(self, class_name, name, attributes, writable=()):
+        """
+        Create a device directory with one file per attribute.
+        :param class_name: The sysfs class (e.g. 'lego-sensor', 'tacho-motor').
+        :param name: The device name (e.g. 'sensor0').
+        :param attributes: Dict mapping attribute names to str or bytes contents.
+        :param writable: Attribute names that ev3dev2 should open for writing.
+        """
+        path = self.device_path(class_name, name)
+        os.makedirs(path, exist_ok=True)
+        for attribute, value in attributes.items():
+            self.write_attribute(class_name, name, attribute, value)
+            os.chmod(os.path.join(path, attribute), 0o660 if attribute in writable else 0o440)
+        return path
+
+    def write_attribute(self, class_name, name, attribute, value):
+        if isinstance(value, str):
+            value = value.encode()
+        path = os.path.join(self.device_path(class_name, name), attribute)
+        if os.path.exists(path):
+            os.chmod(path, 0o660)
+        with open(path, 'wb') as f:
+            f.write(value)
+
+    def read_attribute(self, class_name, name, attribute):
+        with open(os.path.join(self.device_path(class_name, name), attribute), 'rb') as f:
+            return f.read().strip().decode()
+
+    def add_port(self, address='in1', name='port0'):
+        return self.add_device('lego-port', name, {
+            'address': 'ev3-ports:{}'.format(address),
+            'mode': 'auto',
+            'set_device': '',
+        }, writable=('mode', 'set_device'))
+
+    def add_light_array(self, address='in1', values=(100,) * 8, name='sensor0'):
+        """
+        Create a ms-light-array sensor in RAW mode reporting the given eight values.
+        """
+        return self.add_device('lego-sensor', name, {
+            'address': 'ev3-ports:{}:i2c1'.format(address),
+            'driver_name': 'ms-light-array',
+            'mode': 'RAW',
+            'command': '',
+            'bin_data_format': 's16',
+            'num_values': '8',
+            'bin_data': struct.pack('<8h', *values),
+        }, writable=('mode', 'command'))
+
+    def add_motor(self, address='outA', name='motor0', driver_name='lego-ev3-l-motor'):
+        """
+        Create a tacho motor with the attributes EV3Motor uses.
+        """
+        return self.add_device('tacho-motor', name, {
+            'address': 'ev3-ports:{}'.format(address),
+            'driver_name': driver_name,
+            'command': '',
+            'commands': 'run-forever run-to-abs-pos run-to-rel-pos run-timed run-direct stop reset',
+            'count_per_rot': '360',
+            'max_speed': '1050',
+            'speed_sp': '0',
+            'speed': '0',
+            'position': '0',
+            'duty_cycle_sp': '0',
+            'stop_action': 'coast',
+            'stop_actions': 'coast brake hold',
+            'polarity': 'normal',
+            'state': '',
+        }, writable=('command', 'speed_sp', 'duty_cycle_sp', 'stop_action', 'position', 'polarity'))
+
+    def add_line_follower(self, values=(100,) * 8):
+        """
+        Create the devices LineFollower uses: a light array on in1 and the motors on outA and outB.
+        """
+        self.add_port('in1')
+        self.add_light_array('in1', values)
+        self.add_motor('outA', 'motor0')
+        self.add_motor('outB', 'motor1')
+
+    def set_light_array_values(self, values, name='sensor0'):
+        self.write_attribute('lego-sensor', name, 'bin_data', struct.pack('<8h', *values))
+
+    def install(self):
+        """
+        Point ev3dev2 at this tree instead of /sys/class.
+        """
+        self._previous_root = Device.DEVICE_ROOT_PATH
+        Device.DEVICE_ROOT_PATH = self.root
+
+    def uninstall(self):
+        if self._previous_root is not None:
+            Device.DEVICE_ROOT_PATH = self._previous_root
+            self._previous_root = None
+
+    def cleanup(self):
+        self.uninstall()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+
+class FakeSysfsBackend(EV3DevBackend):
+    """
+    Device backend for a LineFollower on a FakeSysfs tree: the real sensor and motor code on fake attribute files,
+    with the buttons and sound of the simulation and no display. The tree needs a port with a light array and the two
+    motors, see add_line_follower().
+    """
+    def __init__(self, **kwargs):
+        from simulation import SimulatedButtons, SimulatedSound
+
+        EV3DevBackend.__init__(self, **kwargs)
+        self._sound = SimulatedSound()
+        self.buttons = SimulatedButtons(self.clock)
+
+    def create_button_events(self):
+        return self.buttons
+
+    def create_display(self):
+        return None
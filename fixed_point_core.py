@@ -0,0 +1,602 @@
+"""
+Allocation-free line following core for MicroPython, see line_follower_micropython.py.
+
+Everything the control loop touches per tick is allocated up front: the sensor is read into a preallocated
+array('h') through a persistent file, the line position and the PID use integer fixed-point math with positions in
+thousandths and speeds in thousandths of a percent, and the motor speed strings are prebuilt, so a tick creates no
+objects and the garbage collector never has to run in the middle of a corner.
+
+This module is plain Python that every MicroPython build can compile, fixed_point_native.py overrides the hot
+methods with versions compiled to machine code where the build has a native code emitter. The same code runs under
+CPython to check it against the floating point implementation and to benchmark it.
+"""
+from array import array
+import gc
+import os
+import select
+import struct
+import time
+
+try:
+    from micropython import const
+except ImportError:
+    def const(value):
+        return value
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+    sleep_us = time.sleep_us
+except AttributeError:
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_diff(end, start):
+        return end - start
+
+    def sleep_us(microseconds):
+        time.sleep(microseconds / 1000000)
+
+SCALE = const(1000)  # Positions, gains and speeds are fixed point numbers in thousandths
+NO_LINE = const(-1)  # Position returned when no line is detected
+SYS_CLASS = '/sys/class'
+
+# The brick buttons' evdev device and key codes, as in ui_events.py, which needs threads MicroPython does not have
+BUTTONS_FILENAME = '/dev/input/by-path/platform-gpio_keys-event'
+BUTTON_CODES = {
+    103: 'up',
+    108: 'down',
+    105: 'left',
+    106: 'right',
+    28: 'enter',
+    14: 'backspace',
+}
+EV_KEY = const(1)
+# struct input_event: struct timeval (two native longs), type, code, value
+TIMEVAL_SIZE = struct.calcsize('ll')
+INPUT_EVENT_SIZE = struct.calcsize('llHHi')
+
+try:
+    listdir = os.listdir
+except AttributeError:  # MicroPython without micropython-lib's os
+    def listdir(path):
+        return [entry[0] for entry in os.ilistdir(path)]
+
+
+class FixedPointEstimator:
+    """
+    Integer version of LinePositionEstimator: the same weighted average of squared inverted values, as thousandths.
+
+    Per slot of the raw buffer, a table maps the value straight to its contrast times the edge weight, so a reversed
+    (flipped) array, the noise threshold and an optional per-element calibration (see calibration.py) cost nothing
+    per tick.
+    """
+    def __init__(self, max_value=100, num_sensors=8, noise_ratio=0.1, edge_weight=2, flipped=False,
+                 minimums=None, maximums=None, raw_max=None):
+        """
+        :param minimums: Per element RAW minimums of a calibration profile, normalize nothing if None.
+        :param maximums: Per element RAW maximums of a calibration profile.
+        :param raw_max: Largest RAW value the tables cover, max_value (or the largest calibration maximum) if None.
+        """
+        self.num_sensors = num_sensors
+        if raw_max is None:
+            raw_max = max(maximums) if maximums else max_value
+        self.last = raw_max
+        noise_threshold = noise_ratio * max_value * max_value
+
+        self.tables = []
+        self.index_weights = array('B', [0] * num_sensors)
+        for slot in range(num_sensors):
+            element = num_sensors - 1 - slot if flipped else slot
+            self.index_weights[slot] = element + 1
+            weight = edge_weight if element in (0, num_sensors - 1) else 1
+            table = array('H', [0] * (raw_max + 1))
+            for raw in range(raw_max + 1):
+                value = raw
+                if minimums is not None:
+                    low = minimums[element]
+                    high = maximums[element]
+                    value = max(0, min(max_value, int(round((raw - low) * (float(max_value) / (high - low))))))
+                else:
+                    value = min(value, max_value)
+                contrast = (max_value - value) ** 2
+                table[raw] = contrast * weight if contrast > noise_threshold else 0
+            self.tables.append(table)
+
+    def estimate(self, values):
+        """
+        :param values: Raw values of the slots, e.g. the SysfsLightArray buffer.
+        :return: Line position in thousandths (1000 to 8000), NO_LINE if no line is detected.
+        """
+        tables = self.tables
+        weights = self.index_weights
+        last = self.last
+        total = 0
+        weighted_sum = 0
+        i = 0
+        while i < self.num_sensors:
+            value = values[i]
+            if value < 0:
+                value = 0
+            elif value > last:
+                value = last
+            contrast = tables[i][value]
+            total += contrast
+            weighted_sum += contrast * weights[i]
+            i += 1
+        if total == 0:
+            return NO_LINE
+        # Split the division so no intermediate leaves the small int range of a 32-bit MicroPython
+        quotient = weighted_sum // total
+        return quotient * SCALE + (weighted_sum - quotient * total) * SCALE // total
+
+
+class FixedPointPID:
+    """
+    Integer version of PIDController with per call integration and derivative. The error is in thousandths of a
+    position and the output in thousandths of a percent. Gains must stay below 100 so the products fit a small int.
+    """
+    def __init__(self, kp, ki, kd, setpoint=4.5, output_limit=100):
+        self.kp = int(round(kp * SCALE))
+        self.ki = int(round(ki * SCALE))
+        self.kd = int(round(kd * SCALE))
+        self.setpoint = int(round(setpoint * SCALE))
+        self.output_limit = output_limit * SCALE
+        # The integral is bounded so that its term alone can just saturate the output, which also keeps it small
+        self.integral_limit = self.output_limit * SCALE // self.ki if self.ki else 0
+        self.reset()
+
+    def reset(self):
+        self.integral = 0
+        self.previous_error = 0
+
+    def compute(self, position):
+        """
+        :param position: Line position in thousandths.
+        :return: Correction in thousandths of a percent.
+        """
+        error = self.setpoint - position
+        output = self.kp * error // SCALE
+        if self.ki:
+            integral = self.integral + error
+            limit = self.integral_limit
+            if integral > limit:
+                integral = limit
+            elif integral < -limit:
+                integral = -limit
+            self.integral = integral
+            output += self.ki * integral // SCALE
+        output += self.kd * (error - self.previous_error) // SCALE
+        self.previous_error = error
+
+        limit = self.output_limit
+        if output > limit:
+            return limit
+        if output < -limit:
+            return -limit
+        return output
+
+
+def find_device(class_name, address, root=SYS_CLASS):
+    """
+    :param address: Port address prefix, e.g. 'ev3-ports:in1'.
+    :return: Path of the first device of the sysfs class whose address starts with address, None if there is none.
+    """
+    directory = root + '/' + class_name
+    try:
+        names = listdir(directory)
+    except OSError:
+        return None
+    for name in sorted(names):
+        path = directory + '/' + name
+        with open(path + '/address') as f:
+            if f.read().strip().startswith(address):
+                return path
+    return None
+
+
+def write_attribute(path, attribute, value):
+    with open(path + '/' + attribute, 'w') as f:
+        f.write(value)
+
+
+class SysfsLightArray:
+    """
+    The ms-light-array in RAW mode, read through a persistent bin_data file straight into a preallocated buffer.
+    The 16 bytes of little-endian signed 16-bit values are the memory layout of array('h') on the EV3, so there is
+    nothing to decode.
+    """
+    def __init__(self, port='in1', root=SYS_CLASS, timeout_ms=10000):
+        address = 'ev3-ports:' + port
+        port_path = find_device('lego-port', address, root)
+        if port_path is None:
+            raise OSError("No port {}".format(port))
+        write_attribute(port_path, 'mode', 'nxt-i2c')
+
+        # The sensor appears and becomes writable shortly after the port mode is set
+        start = ticks_us()
+        delay_ms = 10
+        while True:
+            path = find_device('lego-sensor', address, root)
+            try:
+                if path is None:
+                    raise OSError("No light array on {}".format(port))
+                write_attribute(path, 'mode', 'RAW')
+                break
+            except OSError:
+                if ticks_diff(ticks_us(), start) > timeout_ms * 1000:
+                    raise
+                time.sleep(delay_ms / 1000)
+                delay_ms = min(500, delay_ms * 2)
+
+        self.path = path
+        self.values = array('h', [0] * 8)
+        self._file = open(path + '/bin_data', 'rb')
+
+    def read(self):
+        """
+        Read a sample into values.
+        :return: True if a complete sample was read.
+        """
+        f = self._file
+        f.seek(0)
+        return f.readinto(self.values) == 16
+
+    def close(self):
+        self._file.close()
+
+
+class SysfsMotor:
+    """
+    A tacho motor driven through persistent speed_sp and command files. The speed_sp strings of every possible speed
+    are built once, so changing the speed allocates nothing.
+    """
+    def __init__(self, port='outA', root=SYS_CLASS, brake=True):
+        path = find_device('tacho-motor', 'ev3-ports:' + port, root)
+        if path is None:
+            raise OSError("No motor on {}".format(port))
+        self.path = path
+        with open(path + '/max_speed') as f:
+            self.max_speed = int(f.read())
+        write_attribute(path, 'stop_action', 'brake' if brake else 'coast')
+
+        self.speed_strings = [str(speed - self.max_speed).encode() for speed in range(2 * self.max_speed + 1)]
+        self._speed_sp = open(path + '/speed_sp', 'wb')
+        self._command = open(path + '/command', 'wb')
+        self.speed_sp = None  # Last speed written, None while stopped
+
+    def run(self, speed_sp):
+        """
+        :param speed_sp: Speed in degrees per second, written only if it changed.
+        """
+        if speed_sp == self.speed_sp:
+            return
+        f = self._speed_sp
+        f.seek(0)
+        f.write(self.speed_strings[speed_sp + self.max_speed])
+        f.flush()
+        if self.speed_sp is None:
+            f = self._command
+            f.seek(0)
+            f.write(b'run-forever')
+            f.flush()
+        self.speed_sp = speed_sp
+
+    def stop(self):
+        if self.speed_sp is None:
+            return
+        f = self._command
+        f.seek(0)
+        f.write(b'stop')
+        f.flush()
+        self.speed_sp = None
+
+    def close(self):
+        self.stop()
+        self._speed_sp.close()
+        self._command.close()
+
+
+class EvdevButtons:
+    """
+    The brick buttons, read from their evdev device only when poll() reports an event, so checking them every tick
+    costs a single system call and allocates nothing while no button is touched.
+    """
+    def __init__(self, path=BUTTONS_FILENAME):
+        self._file = open(path, 'rb', 0)
+        self._poller = select.poll()
+        self._poller.register(self._file, select.POLLIN)
+        # ipoll() reuses its result instead of building a list, CPython only has poll()
+        self._poll = getattr(self._poller, 'ipoll', self._poller.poll)
+        self._event = bytearray(INPUT_EVENT_SIZE)
+
+    def pressed(self, timeout_ms=0):
+        """
+        :param timeout_ms: Milliseconds to wait for a press, -1 waits until there is one.
+        :return: Name of the next button pressed, e.g. 'enter', None if there was none within the timeout.
+        """
+        while True:
+            ready = False
+            for _ in self._poll(timeout_ms):
+                ready = True
+            if not ready:
+                return None
+            if self._file.readinto(self._event) == INPUT_EVENT_SIZE:
+                event_type, code, value = struct.unpack_from('HHi', self._event, TIMEVAL_SIZE)
+                if event_type == EV_KEY and value == 1 and code in BUTTON_CODES:
+                    return BUTTON_CODES[code]
+
+    def close(self):
+        self._poller.unregister(self._file)
+        self._file.close()
+
+
+class ControlCore:
+    """
+    One sense -> compute -> actuate tick on fixed-point numbers, plus the loop that runs it at a fixed rate and
+    collects garbage only in the idle time after a tick.
+    """
+    def __init__(self, sensor, left_motor, right_motor, estimator, pid, base_speed=10, max_speed=100, deadband=5):
+        """
+        :param base_speed: Base speed in percent.
+        :param max_speed: Largest motor speed in percent.
+        :param deadband: Speed changes below this many degrees per second are not written.
+        """
+        self.sensor = sensor
+        self.left_motor = left_motor
+        self.right_motor = right_motor
+        self.estimator = estimator
+        self.pid = pid
+        self.base_speed = int(base_speed * SCALE)
+        self.max_speed = int(max_speed * SCALE)
+        self.deadband = deadband
+        self.left_speed = 0  # Commanded speeds in thousandths of a percent
+        self.right_speed = 0
+        self.last_position = NO_LINE
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.invalid = 0
+        self.lost = 0
+        self.missed = 0  # Ticks that ended after their deadline
+        self.max_busy_us = 0
+        self.collections = 0
+        self.max_collection_us = 0
+
+    def tick(self):
+        self.ticks += 1
+        if not self.sensor.read():
+            self.invalid += 1
+            return
+        position = self.estimator.estimate(self.sensor.values)
+        base = self.base_speed
+        if position == NO_LINE:
+            self.lost += 1
+            # Turn in place towards the side the line was last seen on
+            if self.last_position == NO_LINE:
+                left = 0
+                right = 0
+            elif self.last_position < self.pid.setpoint:
+                left = base
+                right = -base
+            else:
+                left = -base
+                right = base
+        else:
+            self.last_position = position
+            correction = self.pid.compute(position)
+            left = base + correction
+            right = base - correction
+            # Scale both down proportionally if one exceeds the maximum
+            largest = left if left > 0 else -left
+            other = right if right > 0 else -right
+            if other > largest:
+                largest = other
+            if largest > self.max_speed:
+                left = left * self.max_speed // largest
+                right = right * self.max_speed // largest
+        self.left_speed = left
+        self.right_speed = right
+        self._drive(self.left_motor, left)
+        self._drive(self.right_motor, right)
+
+    def _drive(self, motor, speed):
+        speed_sp = speed * motor.max_speed // (100 * SCALE)
+        previous = motor.speed_sp
+        if previous is not None:
+            change = speed_sp - previous
+            if -self.deadband < change < self.deadband:
+                return
+        motor.run(speed_sp)
+
+    def stop(self):
+        self.left_motor.stop()
+        self.right_motor.stop()
+
+    def run(self, period_us=10000, ticks=0, gc_interval=10, gc_budget_us=3000, buttons=None):
+        """
+        Run tick() every period_us microseconds with automatic garbage collection disabled. The motors are stopped
+        when it returns.
+        :param ticks: Stop after this many ticks, run until interrupted if 0.
+        :param gc_interval: Collect at most every this many ticks.
+        :param gc_budget_us: Only collect if at least this much of the period is left after the tick.
+        :param buttons: EvdevButtons checked after every tick, any button press stops the loop.
+        :return: Name of the button that stopped the loop, None if it ran out of ticks.
+        """
+        gc.collect()
+        gc.disable()
+        try:
+            deadline = ticks_us()
+            count = 0
+            while ticks == 0 or count < ticks:
+                start = ticks_us()
+                self.tick()
+                busy = ticks_diff(ticks_us(), start)
+                if busy > self.max_busy_us:
+                    self.max_busy_us = busy
+                count += 1
+                if buttons is not None:
+                    button = buttons.pressed()
+                    if button is not None:
+                        return button
+
+                deadline += period_us
+                if count % gc_interval == 0 and ticks_diff(deadline, ticks_us()) > gc_budget_us:
+                    start = ticks_us()
+                    gc.collect()
+                    collection = ticks_diff(ticks_us(), start)
+                    self.collections += 1
+                    if collection > self.max_collection_us:
+                        self.max_collection_us = collection
+
+                remaining = ticks_diff(deadline, ticks_us())
+                if remaining > 0:
+                    sleep_us(remaining)
+                else:
+                    self.missed += 1
+                    deadline = ticks_us()
+            return None
+        finally:
+            gc.enable()
+            self.stop()
+
+    def format_stats(self):
+        return "Ticks: {} | invalid {} | lost {} | missed deadlines {} | max busy {} us | {} collections, " \
+               "max {} us".format(self.ticks, self.invalid, self.lost, self.missed, self.max_busy_us,
+                                  self.collections, self.max_collection_us)
+
+
+def benchmark_loop(core, ticks=2000):
+    """
+    Run ticks back to back without pacing.
+    :return: (ticks per second, bytes allocated per tick or None where the interpreter can not tell).
+    """
+    mem_alloc = getattr(gc, 'mem_alloc', None)  # MicroPython only
+    gc.collect()
+    gc.disable()
+    try:
+        allocated = mem_alloc() if mem_alloc is not None else 0
+        start = ticks_us()
+        for _ in range(ticks):
+            core.tick()
+        elapsed = ticks_diff(ticks_us(), start)
+        allocated = mem_alloc() - allocated if mem_alloc is not None else None
+    finally:
+        gc.enable()
+        core.stop()
+    rate = ticks * 1000000 / elapsed if elapsed > 0 else 0
+    return rate, (allocated / ticks if allocated is not None else None)
+
+
+def self_check(frames=2000, seed=1, estimator_class=FixedPointEstimator, pid_class=FixedPointPID):
+    """
+    Compare the fixed-point estimator and PID against LinePositionEstimator and PIDController on random samples.
+    :param estimator_class: FixedPointEstimator or a subclass such as the native one of fixed_point_native.py.
+    :param pid_class: FixedPointPID or a subclass.
+    :return: (largest position difference, largest PID output difference), both as floats in positions and percent.
+    """
+    from line_position_estimator import LinePositionEstimator
+    from pid_controller import PIDController
+
+    reference = LinePositionEstimator(max_value=100)
+    estimator = estimator_class(max_value=100)
+    reference_pid = PIDController(kp=6.5, ki=0.05, kd=6.5, setpoint=4.5, output_limits=(-100, 100))
+    pid = pid_class(kp=6.5, ki=0.05, kd=6.5, setpoint=4.5)
+
+    state = seed
+    position_error = 0.0
+    output_error = 0.0
+    values = array('h', [0] * 8)
+    for _ in range(frames):
+        for i in range(8):
+            state = (state * 1103515245 + 12345) & 0x7fffffff  # Same random numbers on every interpreter
+            values[i] = state % 101
+        expected = reference.estimate(values)
+        position = estimator.estimate(values)
+        if expected is None:
+            if position != NO_LINE:
+                raise AssertionError("Line detected in {} but not by the reference".format(list(values)))
+            continue
+        position_error = max(position_error, abs(position / SCALE - expected))
+        output = pid.compute(position)
+        output_error = max(output_error, abs(output / SCALE - reference_pid.compute(position / SCALE)))
+    return position_error, output_error
+
+
+class _FrameSource:
+    """
+    Stands in for SysfsLightArray in compare_cores(), serving the frames of a list.
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+        self.values = array('h', [0] * 8)
+
+    def read(self):
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        if frame is None:
+            return False
+        for i in range(8):
+            self.values[i] = frame[i]
+        return True
+
+
+class _RecordingMotor:
+    """
+    Stands in for SysfsMotor in compare_cores(), keeping every speed_sp written instead of writing it.
+    """
+    def __init__(self, max_speed=1050):
+        self.max_speed = max_speed
+        self.speed_sp = None
+        self.written = []
+
+    def run(self, speed_sp):
+        if speed_sp == self.speed_sp:
+            return
+        self.written.append(speed_sp)
+        self.speed_sp = speed_sp
+
+    def stop(self):
+        self.written.append(None)
+        self.speed_sp = None
+
+
+def compare_cores(core_class, estimator_class=FixedPointEstimator, pid_class=FixedPointPID, ticks=2000, seed=1):
+    """
+    Run a ControlCore subclass such as the native one of fixed_point_native.py and ControlCore itself on the same
+    random frames, with lost lines and failed reads in between, against in-memory devices.
+    :return: Number of motor writes that differ between the two, 0 if they agree.
+    """
+    state = seed
+    frames = []
+    for index in range(500):
+        if index % 97 == 0:
+            frames.append(None)  # Failed read
+            continue
+        frame = []
+        for i in range(8):
+            state = (state * 1103515245 + 12345) & 0x7fffffff  # Same random numbers on every interpreter
+            # Every 50th frame shows no line
+            frame.append(90 + state % 11 if index % 50 < 3 else state % 101)
+        frames.append(frame)
+
+    writes = []
+    for core_type, estimator_type, pid_type in ((core_class, estimator_class, pid_class),
+                                                (ControlCore, FixedPointEstimator, FixedPointPID)):
+        left, right = _RecordingMotor(), _RecordingMotor()
+        core = core_type(_FrameSource(frames), left, right, estimator_type(), pid_type(6.5, 0.05, 6.5),
+                         base_speed=30)
+        for _ in range(ticks):
+            core.tick()
+        core.stop()
+        writes.append((left.written, right.written))
+
+    differences = 0
+    for actual, expected in zip(writes[0], writes[1]):
+        differences += abs(len(actual) - len(expected))
+        for a, b in zip(actual, expected):
+            if a != b:
+                differences += 1
+    return differences
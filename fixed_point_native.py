@@ -0,0 +1,123 @@
+"""
+The computing hot methods of fixed_point_core.py compiled to machine code with @micropython.native. The sensor reads
+and motor writes are system calls the native emitter can not speed up, they stay in fixed_point_core.py.
+
+Only MicroPython builds with a native code emitter can compile this module, the others raise a SyntaxError when it is
+imported and line_follower_micropython.py then runs the plain classes of fixed_point_core.py. The methods are copies
+of the ones they override and must be changed together with them. "--check" compares the estimator and the PID of
+both against the floating point code, and the native control core against the plain one tick by tick.
+
+So far this has only been run on CPython, where the decorators do nothing. It has not been checked on a MicroPython
+build yet, with or without the native emitter.
+"""
+from fixed_point_core import ControlCore, FixedPointEstimator, FixedPointPID, NO_LINE, SCALE
+
+try:
+    import micropython
+except ImportError:
+    # CPython, where the decorator changes nothing
+    class micropython:
+        @staticmethod
+        def native(function):
+            return function
+
+
+class NativeEstimator(FixedPointEstimator):
+    @micropython.native
+    def estimate(self, values):
+        tables = self.tables
+        weights = self.index_weights
+        last = self.last
+        total = 0
+        weighted_sum = 0
+        i = 0
+        while i < self.num_sensors:
+            value = values[i]
+            if value < 0:
+                value = 0
+            elif value > last:
+                value = last
+            contrast = tables[i][value]
+            total += contrast
+            weighted_sum += contrast * weights[i]
+            i += 1
+        if total == 0:
+            return NO_LINE
+        # Split the division so no intermediate leaves the small int range of a 32-bit MicroPython
+        quotient = weighted_sum // total
+        return quotient * SCALE + (weighted_sum - quotient * total) * SCALE // total
+
+
+class NativePID(FixedPointPID):
+    @micropython.native
+    def compute(self, position):
+        error = self.setpoint - position
+        output = self.kp * error // SCALE
+        if self.ki:
+            integral = self.integral + error
+            limit = self.integral_limit
+            if integral > limit:
+                integral = limit
+            elif integral < -limit:
+                integral = -limit
+            self.integral = integral
+            output += self.ki * integral // SCALE
+        output += self.kd * (error - self.previous_error) // SCALE
+        self.previous_error = error
+
+        limit = self.output_limit
+        if output > limit:
+            return limit
+        if output < -limit:
+            return -limit
+        return output
+
+
+class NativeControlCore(ControlCore):
+    @micropython.native
+    def tick(self):
+        self.ticks += 1
+        if not self.sensor.read():
+            self.invalid += 1
+            return
+        position = self.estimator.estimate(self.sensor.values)
+        base = self.base_speed
+        if position == NO_LINE:
+            self.lost += 1
+            # Turn in place towards the side the line was last seen on
+            if self.last_position == NO_LINE:
+                left = 0
+                right = 0
+            elif self.last_position < self.pid.setpoint:
+                left = base
+                right = -base
+            else:
+                left = -base
+                right = base
+        else:
+            self.last_position = position
+            correction = self.pid.compute(position)
+            left = base + correction
+            right = base - correction
+            # Scale both down proportionally if one exceeds the maximum
+            largest = left if left > 0 else -left
+            other = right if right > 0 else -right
+            if other > largest:
+                largest = other
+            if largest > self.max_speed:
+                left = left * self.max_speed // largest
+                right = right * self.max_speed // largest
+        self.left_speed = left
+        self.right_speed = right
+        self._drive(self.left_motor, left)
+        self._drive(self.right_motor, right)
+
+    @micropython.native
+    def _drive(self, motor, speed):
+        speed_sp = speed * motor.max_speed // (100 * SCALE)
+        previous = motor.speed_sp
+        if previous is not None:
+            change = speed_sp - previous
+            if -self.deadband < change < self.deadband:
+                return
+        motor.run(speed_sp)
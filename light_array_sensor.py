@@ -1,40 +1,102 @@
-from ev3dev2.sensor import Sensor
-from ev3dev2.port import LegoPort
-from ev3dev2.sound import Sound
+from line_position_estimator import LinePositionEstimator
+from startup import retry
+from collections import namedtuple
+import os
 import time
 import struct
 
+
+# One sample of the array: values is None if the bus read was invalid, position is None if no line was detected.
+SensorFrame = namedtuple('SensorFrame', ['values', 'timestamp', 'mode', 'position'])
+
+# Map bin_data_format to struct format and size
+BIN_DATA_FORMATS = {
+    'u8': ('16B', 16),   # Should be: 8 unsigned 8-bit integers (CAL mode). But the library is broken and thus to support both modes, we init the sensor in RAW mode and when switching to CAL mode, we get 16 bytes instead of 8 and discard the last 8 bytes.
+    's16': ('8h', 16),   # 8 signed 16-bit integers (RAW mode)
+}
+
+# Precompiled layouts for the fast read path, indexed by (bin_data_format, flipped).
+# A flipped sensor reverses the buffer in place, which turns the little-endian s16 values into big-endian ones
+# in reversed element order and moves the 8 valid CAL bytes to the end, so no slicing is needed afterwards.
+FAST_READ_STRUCTS = {
+    ('u8', False): struct.Struct('8B8x'),
+    ('u8', True): struct.Struct('8x8B'),
+    ('s16', False): struct.Struct('<8h'),
+    ('s16', True): struct.Struct('>8h'),
+}
+
+# Size of the fast read buffer. A flipped read reverses the whole buffer, so every format must have this length
+FAST_READ_LENGTH = max(length for _, length in BIN_DATA_FORMATS.values())
+
+
 class LightArraySensor:
     """
     A class to interact with the Mindsensors Light Sensor Array (ms-light-array) on ev3dev.
     """
-    def __init__(self, port='in1', flipped=False):
+    def __init__(self, port='in1', flipped=False, fast_read=False, device=None, sound=None, clock=time.monotonic,
+                 create_sound=None, timeout=10.0):
         """
         Initialize the Light Sensor Array.
         :param port: Port where the sensor is connected (e.g., 'in1', 'in2').
+        :param fast_read: Read bin_data through a persistent file descriptor, see enable_fast_read().
+        :param device: An already initialized ev3dev2 Sensor (or a stand-in such as a simulated sensor) to use instead
+                       of bringing up the port.
+        :param sound: Sound instance to share. Only calibrate() speaks, so by default it is created on first use.
+        :param clock: Monotonic clock used to timestamp frames.
+        :param create_sound: Function returning the Sound to use if sound is None, a new Sound if None.
+        :param timeout: Seconds to keep retrying while the sensor driver comes up.
         """
-        self.sound = Sound()
+        self.clock = clock
+        self._sound = sound
+        self._create_sound = create_sound
 
         self.flipped = flipped
         self.max_value = 100 # Values for CAL are in percentage, RAW seems to be too, but is not documented!
-
-        self.port = LegoPort(address=port)
-        self.port.mode = 'nxt-i2c'
-
-        self.sensor = None
-        for _ in range(10):
+        self.estimator = LinePositionEstimator(max_value=self.max_value)
+        # CalibrationProfile that normalizes RAW values in software, see calibration.py
+        self.calibration = None
+
+        if device is not None:
+            self.port = None
+            self.sensor = device
+            self.mode = "RAW"
+            self.sensor.mode = self.mode
+        else:
+            from ev3dev2 import DeviceNotFound
+            from ev3dev2.port import LegoPort
+
+            self.port = LegoPort(address=port)
+            self.port.mode = 'nxt-i2c'
+
+            # The sensor device appears shortly after the port mode is set and is not accessible right away, retry
+            # with short, growing delays instead of waiting a full second every time
             try:
-                self.sensor = Sensor(address=port)
-                self.mode = "RAW" # The library is broken, thus we need to initialize with RAW mode
-                self.sensor.mode = self.mode
-                print("Sensor initialized in RAW mode")
-                break
-            except PermissionError:
-                print("PermissionError during initialization. Retrying...")
-                time.sleep(1)
-
-        if self.sensor is None:
-            raise RuntimeError("Failed to initialize the sensor after 10 retries")
+                self.sensor = retry(lambda: self._connect(port), (PermissionError, DeviceNotFound), timeout=timeout)
+            except (PermissionError, DeviceNotFound):
+                raise RuntimeError("Failed to initialize the sensor within {} s".format(timeout))
+            print("Sensor initialized in RAW mode")
+
+        self._fast_fd = None
+        if fast_read:
+            self.enable_fast_read()
+
+    def _connect(self, port):
+        from ev3dev2.sensor import Sensor
+
+        sensor = Sensor(address=port)
+        self.mode = "RAW"  # The library is broken, thus we need to initialize with RAW mode
+        sensor.mode = self.mode
+        return sensor
+
+    @property
+    def sound(self):
+        if self._sound is None:
+            if self._create_sound is not None:
+                self._sound = self._create_sound()
+            else:
+                from ev3dev2.sound import Sound
+                self._sound = Sound()
+        return self._sound
 
     def calibrate_white(self):
         self.sensor.command = 'CAL-WHITE'
@@ -74,29 +136,84 @@ class LightArraySensor:
             raise ValueError("Invalid mode. Use 'CAL' or 'RAW'.")
         self.mode = mode
         self.sensor.mode = mode
+        if self._fast_fd is not None:
+            self._refresh_fast_format()
         print("Sensor mode set to: {}".format(mode))
 
-    def read_data(self):
+    def enable_fast_read(self):
+        """
+        Switch read_data() to the fast path: the bin_data file descriptor stays open, the format is cached until the
+        next set_mode() and each read goes straight into a preallocated buffer that is unpacked by a precompiled struct.
+        Reads of any other length than the format's are discarded like in the plain path.
+        """
+        if self._fast_fd is not None:
+            return
+        self._buffer = bytearray(FAST_READ_LENGTH)
+        # Anything beyond the frame lands here, so an overlong read shows in the length instead of being cut off
+        self._overflow = bytearray(1)
+        self._iov = [self._buffer, self._overflow]
+        self._fast_fd = os.open(os.path.join(self.sensor._path, 'bin_data'), os.O_RDONLY)
+        self._refresh_fast_format()
+
+    def disable_fast_read(self):
+        if self._fast_fd is None:
+            return
+        os.close(self._fast_fd)
+        self._fast_fd = None
+
+    def close(self):
+        self.disable_fast_read()
+
+    def _refresh_fast_format(self):
+        fmt = self.sensor.bin_data_format
+        if fmt not in BIN_DATA_FORMATS:
+            raise ValueError("Unsupported bin_data_format: {}".format(fmt))
+        # A single assignment, so a read in another thread (see sensor_acquisition.py) never sees a mixed layout
+        self._fast_layout = (BIN_DATA_FORMATS[fmt][1], FAST_READ_STRUCTS[(fmt, self.flipped)])
+
+    def _read_data_fast(self, warn=True):
+        expected_length, fast_struct = self._fast_layout
+        if hasattr(os, 'preadv'):
+            length = os.preadv(self._fast_fd, self._iov, 0)
+        else:
+            os.lseek(self._fast_fd, 0, os.SEEK_SET)
+            length = os.readv(self._fast_fd, self._iov)
+
+        if length != expected_length:
+            if warn:
+                print("WARNING: Expected {} bytes, but got {} bytes. Discarding invalid data.".format(
+                    expected_length, length))
+            return None
+
+        if self.flipped:
+            self._buffer.reverse()
+        data = fast_struct.unpack_from(self._buffer)
+        calibration = self.calibration
+        if calibration is not None and self.mode == "RAW":
+            return calibration.normalize(data)
+        return data
+
+    def read_data(self, warn=True):
         """
         Read the raw data from the sensor based on its current format.
+        In RAW mode with a calibration profile the values are normalized to 0..max_value per element.
+        :param warn: Print a warning when invalid data is discarded.
         :return: Null if the data is invalid, otherwise a list of values for each light sensor element.
         """
-        # Map bin_data_format to struct format and size
-        fmt_map = {
-            'u8': ('16B', 16),   # Should be: 8 unsigned 8-bit integers (CAL mode). But the library is broken and thus to support both modes, we init the sensor in RAW mode and when switching to CAL mode, we get 16 bytes instead of 8 and discard the last 8 bytes.
-            's16': ('8h', 16),   # 8 signed 16-bit integers (RAW mode)
-        }
+        if self._fast_fd is not None:
+            return self._read_data_fast(warn)
 
         fmt = self.sensor.bin_data_format
-        if fmt not in fmt_map:
+        if fmt not in BIN_DATA_FORMATS:
             raise ValueError("Unsupported bin_data_format: {}".format(fmt))
 
-        struct_fmt, expected_length = fmt_map[fmt]
+        struct_fmt, expected_length = BIN_DATA_FORMATS[fmt]
         raw = self.sensor.bin_data()
 
         if len(raw) != expected_length:
-            print("WARNING: Expected {} bytes, but got {} bytes. Discarding invalid data.".format(
-                expected_length, len(raw)))
+            if warn:
+                print("WARNING: Expected {} bytes, but got {} bytes. Discarding invalid data.".format(
+                    expected_length, len(raw)))
             return None
 
         raw_data = struct.unpack(struct_fmt, raw)
@@ -107,40 +224,41 @@ class LightArraySensor:
             raw_data = raw_data[::-1]
 
         #print("Unpacked sensor data ({}): {}".format(struct_fmt, raw_data))
+        calibration = self.calibration
+        if calibration is not None and self.mode == "RAW":
+            return calibration.normalize(raw_data)
         return raw_data
 
+    def read_frame(self):
+        """
+        Read the sensor exactly once and compute the line position from that same sample.
+        :return: A SensorFrame with the raw values, a monotonic timestamp, the mode and the line position.
+        """
+        data = self.read_data()
+        timestamp = self.clock()
+        if data is None:
+            return SensorFrame(None, timestamp, self.mode, None)
+        return SensorFrame(data, timestamp, self.mode, self.compute_line_position(data))
+
     def get_line_position(self):
         """
-        Calculate the position of the line relative to the sensor based on the current mode.
-        Low values (black) represent the line.
+        Read the sensor and calculate the position of the line relative to it.
         :return: A float representing the line position (weighted average) or None if invalid data.
         """
         data = self.read_data()
         if data is None:
             print("Invalid data received. Unable to calculate line position.")
             return None # Propagate the error
+        return self.compute_line_position(data)
 
-        # Calculate the inverted data so that low values (black) are weighted more heavily
-        inverted_data = [self.max_value - value for value in data]
-
-        biased_data = [value ** 2 for value in inverted_data] # Square the values to increase the contrast
-
-        noise_threshold = 0.1 * (self.max_value ** 2)  # Example: 10% of max biased value
-        filtered_data = [value if value > noise_threshold else 0 for value in biased_data]
-
-        edge_weights = [2 if i in [0, len(filtered_data) - 1] else 1 for i in range(len(filtered_data))]
-        weighted_filtered_data = [filtered_data[i] * edge_weights[i] for i in range(len(filtered_data))]
-
-        weighted_sum = sum(value * (index + 1) for index, value in enumerate(weighted_filtered_data))
-        total = sum(weighted_filtered_data)
-
-        if total == 0:
-            return None  # No line detected
-
-        line_position = weighted_sum / total
-        #print("Line detected at position: {}".format(line_position))
-        return line_position
-
+    def compute_line_position(self, data):
+        """
+        Calculate the position of the line from an already read sample without touching the bus.
+        Low values (black) represent the line.
+        :param data: Sequence of values for each light sensor element, as returned by read_data().
+        :return: A float representing the line position (weighted average) or None if no line is detected.
+        """
+        return self.estimator.estimate(data)
 
 if __name__ == "__main__":
     sensor = LightArraySensor(port='in1')
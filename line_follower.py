@@ -1,37 +1,85 @@
-try:
-    from ev3dev2.display import Display
-    DISPLAY_AVAILABLE = True
-except ImportError:
-    DISPLAY_AVAILABLE = False
-
-from ev3dev2.button import Button
-from ev3dev2.sound import Sound
-from light_array_sensor import LightArraySensor
-from ev3_motor import EV3Motor
+from device_backend import EV3DevBackend
 from pid_controller import PIDController
+from differential_drive import DifferentialDrive
+from debug_display import DebugRenderer, DebugSnapshot
+from loop_scheduler import LoopScheduler
+from sensor_acquisition import SensorAcquisition
+from recovery import LineRecovery
+from line_state_estimator import LineStateEstimator
+from speed_scheduler import SpeedScheduler
+from track_map import TrackMap
+from calibration import CALIBRATION_FILE, load_profile, save_profile, sweep
+from ui_events import AsyncSpeaker
+from startup import StartupReport, bring_up
+from profiler import StageProfiler
+from tuning_server import TuningServer, CommandError, DEFAULT_HOST, DEFAULT_PORT
+from telemetry import TelemetryRecorder, RateLimitedLog, FLAG_RUNNING, FLAG_VALID, FLAG_LINE
 from ev3dev2.motor import OUTPUT_A, OUTPUT_B
+import argparse
+import json
+import os
 import time
-import sys
-import select
+
+# Gains written by pid_tuner.py, loaded at startup if present
+GAINS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gains.json')
+# Track map learned on the first run, see track_map.py
+TRACK_MAP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'track_map.lftm')
+# Telemetry recordings of each run
+TELEMETRY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telemetry')
+# Hot path profile, written when profiling is switched off and on exit
+PROFILE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profile.json')
 
 class LineFollower:
-    def __init__(self):
+    def __init__(self, backend=None, startup=None):
+        """
+        :param backend: Creates the devices and provides the clock, EV3DevBackend (the real hardware) if None.
+        :param startup: StartupReport to time the bring-up and the first tick with, printed after the first tick.
+        """
+        self.startup = startup
+        if backend is None:
+            backend = EV3DevBackend()
+        self.backend = backend
+
         # Constants
         self.base_speed = 10  # Base speed for both motors
         self.max_speed = 100  # Maximum allowed motor speed
         self.scaling_factor = 1.0  # Internal variable for scaling motor speeds
-
-        # Initialize components
-        self.sensor = LightArraySensor(port='in1', flipped=False)
-        self.left_motor = EV3Motor(port=OUTPUT_A, motor_type='large')
-        self.right_motor = EV3Motor(port=OUTPUT_B, motor_type='large')
+        self.loop_period = 0.01  # Target control loop period in seconds (100 Hz)
+
+        # Initialize components, the sensor port and the motors come up concurrently
+        self.sensor, self.left_motor, self.right_motor = bring_up([
+            ('sensor', backend.create_sensor),
+            ('left motor', lambda: backend.create_motor(OUTPUT_A)),
+            ('right motor', lambda: backend.create_motor(OUTPUT_B)),
+        ], startup)
+        if startup is not None:
+            startup.mark('devices')
+        self.acquisition = None
+        self.drive = DifferentialDrive(self.left_motor, self.right_motor, deadband=0.5)
         self.pid = PIDController(kp=6.5, ki=0.0, kd=6.5, setpoint=4.5, output_limits=(-self.max_speed, self.max_speed))
-
-        self.btn = Button()
-        self.sound = Sound()
-
-        if DISPLAY_AVAILABLE:
-            self.display = Display()
+        self.recovery = LineRecovery(setpoint=self.pid.setpoint)
+        self.line_estimator = None  # The PID gets the raw line position unless a LineStateEstimator is set
+        self.actuation_latency = 0.0  # Filtered seconds from reading a frame until the motors were commanded
+        self.speed_scheduler = None  # Fixed base_speed unless a SpeedScheduler is set
+        self.track_map = None
+        self.track_map_path = None
+        self.track_map_options = None  # Keyword arguments the TrackMap was created with
+        self.calibration_path = CALIBRATION_FILE
+        self.calibration_profile = 'default'  # Name the next automatic calibration is saved under
+        self.scheduler = LoopScheduler(period=self.loop_period, clock=backend.clock, sleep=backend.sleep,
+                                       timer=backend.timer)
+
+        self.buttons = backend.create_button_events()
+        # Sound and display are only created (and ev3dev2.sound, ev3dev2.display and Pillow imported) in the speaker
+        # and renderer threads once they are used
+        self.speaker = AsyncSpeaker(create_sound=backend.create_sound)
+        self.button_actions = {
+            'enter': self.toggle_running_state,
+            'up': self.toggle_sensor_mode,
+            'down': self.auto_calibration,
+            'left': self.toggle_debug_mode,
+            'right': self.toggle_profiling,
+        }
 
         # State variables
         self.running = False
@@ -39,6 +87,171 @@ class LineFollower:
 
         self.loop_frequency = 0.0
         self.inverted_display = True
+        self.debug_frame_rate = 8  # Redraws per second of the debug screen
+        self.last_line_position = None
+        self.line_lost = False
+        self.tracking_losses = 0
+        self.correction = 0.0
+
+        self.telemetry = None
+        self.server = None
+        # Times the hot path stages while enabled, see profiler.py. Disabled it adds no work at all.
+        self.profiler = StageProfiler()
+        self.profile_path = PROFILE_FILE
+        self.log = RateLimitedLog(interval=1.0, clock=backend.clock)
+
+        self.renderer = DebugRenderer(max_value=self.sensor.max_value, frame_rate=self.debug_frame_rate,
+                                      inverted=self.inverted_display, create_display=backend.create_display)
+        if startup is not None:
+            startup.mark('setup')
+
+    def apply_gains(self, gains):
+        """
+        :param gains: Dict with any of kp, ki, kd and base_speed, and optionally speed_scheduler with the keyword
+                      arguments of a SpeedScheduler to schedule the base speed with, and track_map with the keyword
+                      arguments of a TrackMap (e.g. {} for the defaults) to follow the learned speed profile with.
+        """
+        if 'kp' in gains:
+            self.pid.kp = float(gains['kp'])
+        if 'ki' in gains:
+            self.pid.ki = float(gains['ki'])
+        if 'kd' in gains:
+            self.pid.kd = float(gains['kd'])
+        if 'base_speed' in gains:
+            self.base_speed = float(gains['base_speed'])
+        if 'speed_scheduler' in gains:
+            self.speed_scheduler = SpeedScheduler(**gains['speed_scheduler'])
+        if 'track_map' in gains:
+            self.enable_track_map(**gains['track_map'])
+
+    def load_gains(self, path=GAINS_FILE):
+        """
+        Load gains from a JSON file as written by pid_tuner.py.
+        :return: True if the file existed and was applied.
+        """
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            self.apply_gains(json.load(f))
+        print("Loaded gains from {}: Kp {} Ki {} Kd {} base speed {}".format(
+            path, self.pid.kp, self.pid.ki, self.pid.kd, self.base_speed))
+        return True
+
+    def load_calibration(self, name=None, path=CALIBRATION_FILE):
+        """
+        Normalize the RAW sensor values with a calibration profile saved by auto_calibration(), see calibration.py.
+        :param name: Profile to load, the active one if None.
+        :return: True if the profile existed and was applied.
+        """
+        self.calibration_path = path
+        profile = load_profile(name, path)
+        if profile is None:
+            return False
+        self.sensor.calibration = profile
+        self.calibration_profile = profile.name
+        print("Loaded calibration profile '{}' from {}".format(profile.name, path))
+        return True
+
+    def enable_telemetry(self, path=None):
+        """
+        Record every tick to a binary telemetry file, see telemetry.py.
+        :param path: File to write, a timestamped file in TELEMETRY_DIR if None.
+        """
+        if path is None:
+            if not os.path.isdir(TELEMETRY_DIR):
+                os.makedirs(TELEMETRY_DIR)
+            path = os.path.join(TELEMETRY_DIR, time.strftime("run-%Y%m%d-%H%M%S.lft"))
+        self.telemetry = TelemetryRecorder(path)
+        print("Recording telemetry to {}".format(path))
+
+    def enable_acquisition(self, max_age=None):
+        """
+        Read the sensor in a background thread and let each tick take the freshest sample, see sensor_acquisition.py.
+        :param max_age: Seconds after which a sample is too old to control with, three loop periods if None.
+        """
+        if max_age is None:
+            max_age = 3 * self.loop_period
+        self.acquisition = SensorAcquisition(self.sensor, max_age=max_age, clock=self.backend.clock)
+
+    def enable_line_estimator(self, **options):
+        """
+        Filter the line position and predict it forward by the measured read to actuate latency before the PID, see
+        line_state_estimator.py.
+        :param options: Keyword arguments of LineStateEstimator.
+        """
+        self.line_estimator = LineStateEstimator(**options)
+
+    def profiling_hooks(self):
+        """
+        :return: The (stage, object, method name) the profiler times, see profiler.StageProfiler.enable().
+        """
+        hooks = [
+            ('tick', self, 'tick'),
+            ('handle_button_presses', self, 'handle_button_presses'),
+        ]
+        if self.acquisition is not None:
+            # The sensor is read in the acquisition thread, the tick only takes the latest frame
+            hooks.append(('read_frame', self.acquisition, 'read_frame'))
+        else:
+            hooks.append(('read_data', self.sensor, 'read_data'))
+            hooks.append(('compute_line_position', self.sensor, 'compute_line_position'))
+        hooks += [
+            ('pid_compute', self.pid, 'compute'),
+            ('scale_motor_speeds', self, 'scale_motor_speeds'),
+            ('motor_set_speed', self.left_motor, 'set_speed'),
+            ('motor_set_speed', self.right_motor, 'set_speed'),
+            ('motor_update_speed', self.left_motor, 'update_speed'),
+            ('motor_update_speed', self.right_motor, 'update_speed'),
+            ('debug_visualization', self, 'debug_visualization'),
+        ]
+        if self.server is not None:
+            hooks.append(('tuning_server', self.server, 'process'))
+        return hooks
+
+    def enable_profiling(self):
+        """
+        Start timing the hot path stages.
+        """
+        self.profiler.enable(self.profiling_hooks())
+
+    def disable_profiling(self):
+        """
+        Stop timing, print the profile and write it to profile_path.
+        """
+        if not self.profiler.enabled:
+            return
+        self.profiler.disable()
+        print(self.profiler.format())
+        if self.profile_path is not None:
+            self.profiler.dump(self.profile_path)
+            print("Wrote profile to {}".format(self.profile_path))
+
+    def toggle_profiling(self):
+        if self.profiler.enabled:
+            self.disable_profiling()
+            self.speaker.speak("Profiling disabled")
+        else:
+            self.enable_profiling()
+            self.speaker.speak("Profiling enabled")
+
+    def enable_track_map(self, path=TRACK_MAP_FILE, **options):
+        """
+        Follow the speed profile of a learned track map, or learn one on this run if path does not exist yet.
+        The robot has to start every run at the same place. See track_map.py.
+        :param options: Keyword arguments of TrackMap. Unless given, the profile never goes above the configured
+                        base_speed and slows down to half of it in the tightest corners.
+        """
+        options.setdefault('max_speed', self.base_speed)
+        options.setdefault('min_speed', 0.5 * self.base_speed)
+        self.track_map = TrackMap(setpoint=self.pid.setpoint, **options)
+        self.track_map_options = options
+        self.track_map_path = path
+        if path is not None and os.path.exists(path):
+            self.track_map.load(path)
+            print("Loaded track map from {}: {} buckets, {:.0f} mm lap".format(
+                path, len(self.track_map.curvatures), self.track_map.lap_length))
+        else:
+            print("Mapping the track on this run")
 
     def scale_motor_speeds(self, left_speed, right_speed):
         max_current_speed = max(abs(left_speed), abs(right_speed))
@@ -57,213 +270,405 @@ class LineFollower:
 
         return left_speed, right_speed
 
-    def debug_visualization(self, sensor_data):
+    def debug_visualization(self, frame):
         """
-        Visualize sensor data and relevant system information on the EV3 display.
-        Handles None values and adjusts for RAW/CAL scaling differences.
+        Publish a sensor frame and relevant system information to the debug renderer.
+        Drawing happens in the renderer thread, so this only costs a tuple per tick.
         """
-        if not DISPLAY_AVAILABLE:
-            return
-
-        self.display.clear()
-
-        screen_width = 178
-        screen_height = 128
-
-        if sensor_data is None:
-            self.display.draw.text((5, 10), "Invalid sensor data", fill='black')
-            self.display.update()
+        if not self.renderer.available:
             return
 
-        num_sensors = len(sensor_data)
-        bar_width = screen_width // num_sensors
-        max_bar_height = 64  # Half of the screen height reserved for sensor bars
+        self.renderer.publish(DebugSnapshot(
+            frame.values, frame.position, frame.mode, self.running, self.loop_frequency,
+            self.pid.kp, self.pid.ki, self.pid.kd, self.drive.left_speed, self.drive.right_speed, self.scaling_factor))
 
-        for i, value in enumerate(sensor_data):
-            normalized_value = max(0, min(value, self.sensor.max_value))  # Clamp to [0, max_value]
-            bar_height = int(((self.sensor.max_value - normalized_value) / self.sensor.max_value) * max_bar_height)
+    def toggle_running_state(self):
+        self.running = not self.running
+        if self.running:
+            if self.speed_scheduler is not None:
+                self.speed_scheduler.reset()
+            self.speaker.speak("Line following enabled")
+        else:
+            self.drive.stop()
+            self.speaker.speak("Line following disabled")
 
-            if self.inverted_display:
-                x1 = screen_width - ((i + 1) * bar_width)
-                x2 = x1 + bar_width - 2
-            else:
-                x1 = i * bar_width
-                x2 = x1 + bar_width - 2
+    def toggle_sensor_mode(self):
+        new_mode = "RAW" if self.sensor.mode == "CAL" else "CAL"
+        self.sensor.set_mode(new_mode)
+        if new_mode == "CAL":
+            self.speaker.speak("Calibration mode enabled")
+        else:
+            self.speaker.speak("Raw sensor data mode enabled")
 
-            y1 = screen_height // 2 - bar_height
-            y2 = screen_height // 2
+    def auto_calibration(self, name=None):
+        """
+        Calibrate the sensor by sweeping it over the line with the motors, then save and use the profile.
+        The robot has to stand centered over the line.
+        :param name: Profile to save it as, e.g. the surface or the lighting, the current profile name if None.
+        :return: True if the calibration succeeded.
+        """
+        self.running = False
+        self.drive.stop()
+        self.speaker.speak("Calibrating")
+        # The sweep reads the sensor itself, so the acquisition thread must not read it at the same time
+        acquiring = self.acquisition is not None and self.acquisition.running
+        if acquiring:
+            self.acquisition.stop()
+        try:
+            profile = sweep(self.sensor, self.drive, self.backend.clock, self.backend.sleep)
+        except RuntimeError as e:
+            print(e)
+            self.speaker.speak("Calibration failed")
+            return False
+        finally:
+            if acquiring:
+                self.acquisition.start()
+
+        profile.name = name if name is not None else self.calibration_profile
+        self.calibration_profile = profile.name
+        self.sensor.calibration = profile
+        if self.calibration_path is not None:
+            save_profile(profile, path=self.calibration_path)
+        print("Calibration profile '{}': minimums {} maximums {}".format(
+            profile.name, profile.minimums, profile.maximums))
+        self.speaker.speak("Calibration complete")
+        return True
 
-            self.display.draw.rectangle((x1, screen_height // 2 - max_bar_height, x2, y2), outline='black')
-            self.display.draw.rectangle((x1, y1, x2, y2), fill='black')
+    def toggle_debug_mode(self):
+        self.debug_mode = not self.debug_mode
+        if self.debug_mode:
+            self.renderer.start()
+        else:
+            self.renderer.stop()
+        if self.debug_mode:
+            self.speaker.speak("Debug mode enabled")
+        else:
+            self.speaker.speak("Debug mode disabled")
 
-        line_position = self.sensor.get_line_position()
+    def handle_button_presses(self):
+        """
+        Handle the button presses queued by the input thread, a single queue check per tick when nothing happened.
+        """
+        event = self.buttons.poll()
+        while event is not None:
+            if event.pressed:
+                action = self.button_actions.get(event.name)
+                if action is not None:
+                    action()
+            event = self.buttons.poll()
+
+    def enable_tuning_server(self, host=DEFAULT_HOST, port=DEFAULT_PORT, decimation=10):
+        """
+        Accept tuning commands and stream telemetry over TCP, see tuning_server.py and tuning_client.py.
+        :param host: Interface to listen on, '0.0.0.0' to accept unauthenticated commands from the whole network.
+        :param decimation: Offer telemetry to subscribers every this many ticks.
+        """
+        self.server = TuningServer(host=host, port=port, decimation=decimation)
+        self.server.start()
+        print("Tuning server listening on {}:{}".format(*self.server.address))
 
-        if line_position is not None:
-            if self.inverted_display:
-                line_x = screen_width - int((line_position / num_sensors) * screen_width)
+    def apply_command(self, command):
+        """
+        Apply a validated tuning server command, called between two ticks.
+        :return: Dict merged into the reply.
+        """
+        name = command['cmd']
+        if name == 'set':
+            if 'kp' in command:
+                self.pid.kp = command['kp']
+            if 'ki' in command:
+                self.pid.ki = command['ki']
+            if 'kd' in command:
+                self.pid.kd = command['kd']
+            if 'base_speed' in command:
+                self.base_speed = command['base_speed']
+            if 'setpoint' in command:
+                self.pid.setpoint = command['setpoint']
+                self.recovery.setpoint = command['setpoint']
+            self.log.log('set', "Updated Kp {} Ki {} Kd {} base speed {} setpoint {}".format(
+                self.pid.kp, self.pid.ki, self.pid.kd, self.base_speed, self.pid.setpoint))
+        elif name == 'mode':
+            if command['mode'] != self.sensor.mode:
+                self.toggle_sensor_mode()
+        elif name == 'start':
+            if not self.running:
+                self.toggle_running_state()
+        elif name == 'stop':
+            if self.running:
+                self.toggle_running_state()
+        elif name == 'calibrate':
+            if self.running:
+                raise CommandError("Stop line following before calibrating")
+            if command['target'] == 'sweep':
+                if not self.auto_calibration(command.get('profile')):
+                    raise CommandError("Calibration failed")
+            elif command['target'] == 'white':
+                self.sensor.calibrate_white()
+            else:
+                self.sensor.calibrate_black()
+        elif name == 'stats':
+            return {'stats': self.scheduler.stats()}
+        elif name == 'reset_stats':
+            self.scheduler.reset_stats()
+        elif name == 'profile':
+            enabled = command.get('enabled', not self.profiler.enabled)
+            if enabled:
+                self.enable_profiling()
             else:
-                line_x = int((line_position / num_sensors) * screen_width)
+                self.disable_profiling()
+            return {'profiling': self.profiler.enabled, 'profile': self.profiler.stats()}
+        return self.parameters()
+
+    def parameters(self):
+        return {
+            'kp': self.pid.kp,
+            'ki': self.pid.ki,
+            'kd': self.pid.kd,
+            'base_speed': self.base_speed,
+            'setpoint': self.pid.setpoint,
+            'mode': self.sensor.mode,
+            'calibration': self.sensor.calibration.name if self.sensor.calibration is not None else None,
+            'running': self.running,
+        }
+
+    def publish_telemetry(self, frame):
+        self.server.publish({
+            't': frame.timestamp,
+            'values': frame.values,
+            'position': frame.position,
+            'correction': self.correction,
+            'left_speed': self.drive.left_speed,
+            'right_speed': self.drive.right_speed,
+            'loop_frequency': self.scheduler.loop_frequency,
+            'running': self.running,
+        })
+
+    def tick(self):
+        """
+        One sense -> compute -> actuate cycle, with the time of each phase recorded by the scheduler.
+        """
+        scheduler = self.scheduler
 
-            self.display.draw.line((line_x, 0, line_x, max_bar_height), fill='black', width=2)
-            self.display.draw.text((5, 94), "Line Pos: {:.2f} | Freq: {:.1f} Hz".format(line_position, self.loop_frequency), fill='black')
-        else:
-            self.display.draw.text((5, 94), "Line Pos: N/A | Freq: {:.1f} Hz".format(self.loop_frequency), fill='black')
+        self.handle_button_presses()
+        if self.server is not None:
+            self.server.process(self.apply_command)
+        scheduler.mark('ui')
 
-        self.display.draw.text((5, 66), "Mode: {} | State: {}".format(
-            self.sensor.mode,
-            "Run" if self.running else "Stop"), fill='black')
+        # One sample per tick, read here or taken from the acquisition thread, the position comes from that same sample
+        if self.acquisition is not None:
+            frame = self.acquisition.read_frame()
+        else:
+            frame = self.sensor.read_frame()
+        sensor_data = frame.values
+        line_position = frame.position
+        scheduler.mark('sensor')
+
+        if self.debug_mode and self.renderer.available:
+            self.loop_frequency = scheduler.loop_frequency
+            self.debug_visualization(frame)
+            scheduler.mark('display')
+
+        if self.running:
+            if self.track_map is not None:
+                self.track_map.update(self.left_motor.get_position(), self.right_motor.get_position(), line_position)
+            self.control(frame)
+        else:
+            self.correction = 0.0
+            self.drive.stop()
+            scheduler.mark('motor')
+            self.last_line_position = line_position
+
+        if self.server is not None and self.server.telemetry_due():
+            self.publish_telemetry(frame)
+
+        if self.telemetry is not None:
+            flags = FLAG_RUNNING if self.running else 0
+            if sensor_data is not None:
+                flags |= FLAG_VALID
+            if line_position is not None:
+                flags |= FLAG_LINE
+            pid = self.pid
+            self.telemetry.record(frame.timestamp, sensor_data, line_position,
+                                  pid.proportional_term, pid.integral_term, pid.derivative_term, self.correction,
+                                  self.drive.left_speed, self.drive.right_speed, self.scaling_factor, flags)
+
+    def control(self, frame):
+        """
+        Compute and apply the motor speeds for a frame while running.
+        """
+        scheduler = self.scheduler
+        line_position = frame.position
+        self.correction = 0.0
 
-        self.display.draw.text((5, 80), "Kp: {:.2f} Ki: {:.2f} Kd: {:.2f}".format(self.pid.kp, self.pid.ki, self.pid.kd), fill='black')
+        if frame.values is None:
+            self.log.log('invalid', "Skipping control update due to invalid sensor data.")
+            return
 
-        left_motor_speed = self.left_motor.motor.speed
-        right_motor_speed = self.right_motor.motor.speed
-        self.display.draw.text((5, 108), "L: {} R: {} | Scale: {:.2f}".format(
-            left_motor_speed,
-            right_motor_speed,
-            self.scaling_factor), fill='black')
+        if self.line_estimator is not None:
+            line_position = self.line_estimator.update(frame.timestamp, line_position, self.actuation_latency)
+
+        if line_position is None:
+            if self.last_line_position is not None:
+                if not self.line_lost:
+                    self.line_lost = True
+                    self.tracking_losses += 1
+                    self.recovery.begin(frame.timestamp, self.last_line_position, self.drive.left_speed,
+                                        self.drive.right_speed)
+                if self.speed_scheduler is not None:
+                    self.base_speed = self.speed_scheduler.line_lost(frame.timestamp)
+                if self.recovery.direction > 0:
+                    self.log.log('lost', "Tracking lost. Trying to recover to the left.")
+                else:
+                    self.log.log('lost', "Tracking lost. Trying to recover to the right.")
+                self.drive.set_speeds(*self.recovery.speeds(frame.timestamp, self.base_speed, self.max_speed))
+                scheduler.mark('motor')
+            return
 
-        self.display.update()
+        if self.line_lost:
+            self.line_lost = False
+            self.recovery.end(frame.timestamp, line_position, self.pid)
+        self.recovery.observe(frame.timestamp, line_position)
+        self.correction = self.pid.compute(line_position)
+        if self.track_map is not None and self.track_map.ready:
+            self.base_speed = self.track_map.speed()
+        elif self.speed_scheduler is not None:
+            self.schedule_speed(frame.timestamp, line_position)
 
-    def toggle_running_state(self):
-        if self.btn.enter:
-            self.running = not self.running
-            if self.running:
-                self.sound.speak("Line following enabled")
-            else:
-                self.left_motor.stop()
-                self.right_motor.stop()
-                self.sound.speak("Line following disabled")
-            time.sleep(0.5)  # Debounce
-    
-    def toggle_sensor_mode(self):
-        if self.btn.up:
-            new_mode = "RAW" if self.sensor.mode == "CAL" else "CAL"
-            self.sensor.set_mode(new_mode)
-            if new_mode == "CAL":
-                self.sound.speak("Calibration mode enabled")
-            else:
-                self.sound.speak("Raw sensor data mode enabled")
-            time.sleep(0.5)  # Debounce
+        left_speed = self.base_speed + self.correction
+        right_speed = self.base_speed - self.correction
 
-    def manual_calibration(self):
-        if self.btn.down:
-            self.sound.speak("Entering manual calibration mode.")
-            self.sensor.calibrate()
-            self.sound.speak("Manual calibration complete.")
-            time.sleep(0.5)  # Debounce
+        left_speed, right_speed = self.scale_motor_speeds(left_speed, right_speed)
+        scheduler.mark('pid')
 
-    def toggle_debug_mode(self):
-        if self.btn.left:
-            self.debug_mode = not self.debug_mode
-            if self.debug_mode:
-                self.sound.speak("Debug mode enabled")
-            else:
-                self.sound.speak("Debug mode disabled")
-            time.sleep(0.5)  # Debounce
+        self.drive.set_speeds(left_speed, right_speed)
+        scheduler.mark('motor')
+        if self.line_estimator is not None:
+            self.actuation_latency += 0.1 * (self.backend.clock() - frame.timestamp - self.actuation_latency)
 
-    def handle_button_presses(self):
-        self.toggle_running_state()
-        self.toggle_sensor_mode()
-        self.manual_calibration()
-        self.toggle_debug_mode()
-
-
-    def check_for_command(self):
-        """
-        Check for a command from the SSH terminal to update PID gains or robot speed.
-        """
-        if select.select([sys.stdin], [], [], 0)[0]:
-            user_input = sys.stdin.readline().strip()
-            try:
-                if user_input.startswith("p"):
-                    self.pid.kp = float(user_input[1:])
-                    print("Updated Kp to {}".format(self.pid.kp))
-                elif user_input.startswith("i"):
-                    self.pid.ki = float(user_input[1:])
-                    print("Updated Ki to {}".format(self.pid.ki))
-                elif user_input.startswith("d"):
-                    self.pid.kd = float(user_input[1:])
-                    print("Updated Kd to {}".format(self.pid.kd))
-                elif user_input.startswith("s"):
-                    self.base_speed = float(user_input[1:])
-                    print("Updated base speed to {}".format(self.base_speed))
-                else:
-                    print("Invalid command. Use p, i, d, or s followed by a value.")
-            except ValueError:
-                print("Invalid value. Please enter a numeric value after p, i, d, or s.")
+        self.last_line_position = line_position
 
+    def schedule_speed(self, timestamp, line_position):
+        """
+        Set the base speed for this tick from the speed scheduler, and the gains of its speed band for the next one.
+        """
+        self.base_speed = self.speed_scheduler.update(timestamp, line_position, self.correction)
+        gains = self.speed_scheduler.gains_for(self.base_speed)
+        if gains is not None:
+            self.pid.kp = gains.get('kp', self.pid.kp)
+            self.pid.kd = gains.get('kd', self.pid.kd)
 
-    def follow_line(self):
+    def follow_line(self, duration=None, stop_condition=None):
         """
-        Core function for line following.
+        Core function for line following, runs tick() at the scheduler's fixed rate until interrupted.
         Visualization will only be used if display is available.
+        :param duration: Stop after this many seconds on the backend's clock, run forever if None.
+        :param stop_condition: Optional function checked after every tick, stops the loop when it returns True.
         """
         try:
-            last_line_position = None
-            loop_start_time = time.time()
-            loop_counter = 0
-
-            while True:
-                self.handle_button_presses()
-                self.check_for_command()
-
-                sensor_data = self.sensor.read_data()
-                line_position = self.sensor.get_line_position()
-
-                if self.debug_mode and DISPLAY_AVAILABLE:
-                    loop_counter += 1
-                    elapsed_time = time.time() - loop_start_time
-                    if elapsed_time >= 1.0:  # Update frequency every second
-                        self.loop_frequency = loop_counter / elapsed_time
-                        loop_start_time = time.time()
-                        loop_counter = 0
-
-                    self.debug_visualization(sensor_data)
-
-                if self.running:
-                    if sensor_data is None:
-                        print("Skipping control update due to invalid sensor data.")
-                        continue
-
-                    if line_position is None:
-                        if last_line_position is not None:
-                            if last_line_position < 4.5:
-                                print("Tracking lost. Trying to recover to the left.")
-                                self.left_motor.set_speed(self.base_speed)
-                                self.right_motor.set_speed(-self.base_speed)
-                            else:
-                                print("Tracking lost. Trying to recover to the right.")
-                                self.left_motor.set_speed(-self.base_speed)
-                                self.right_motor.set_speed(self.base_speed)
-                        continue
-
-                    correction = self.pid.compute(line_position)
-
-                    left_speed = self.base_speed + correction
-                    right_speed = self.base_speed - correction
-
-                    left_speed, right_speed = self.scale_motor_speeds(left_speed, right_speed)
-
-                    self.left_motor.set_speed(left_speed)
-                    self.right_motor.set_speed(right_speed)
-                else:
-                    self.left_motor.stop()
-                    self.right_motor.stop()
+            self.last_line_position = None
+            self.scheduler.start()
+            end_time = None if duration is None else self.scheduler.clock() + duration
 
-                last_line_position = line_position
-                #time.sleep(0.01)
+            if self.debug_mode:
+                self.renderer.start()
+            self.buttons.start()
+            if self.acquisition is not None:
+                self.acquisition.start()
+
+            while end_time is None or self.scheduler.clock() < end_time:
+                self.scheduler.begin_tick()
+                self.tick()
+                self.scheduler.end_tick()
+                if self.startup is not None:
+                    self.startup.mark('first tick')
+                    print(self.startup.format())
+                    self.startup = None
+                if stop_condition is not None and stop_condition():
+                    break
         except KeyboardInterrupt:
-            self.left_motor.stop()
-            self.right_motor.stop()
-            if DISPLAY_AVAILABLE:
-                self.display.clear()
-                self.display.text_pixels("Exiting...", x=0, y=0, text_color='white')
-                self.display.update()
-            self.sound.speak("Goodbye")
-
-
-def main():
-    follower = LineFollower()
+            pass
+        finally:
+            # Whatever ended the loop, the motors must not keep running
+            self.shutdown()
+
+    def shutdown(self):
+        self.drive.stop()
+        self.buttons.stop()
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            print(self.acquisition.format_stats())
+        if self.server is not None:
+            self.server.stop()
+        if self.telemetry is not None:
+            self.telemetry.close()
+            if self.telemetry.dropped:
+                print("Telemetry dropped {} records".format(self.telemetry.dropped))
+        self.renderer.stop()
+        display = self.renderer.display
+        if display is not None:
+            display.clear()
+            display.text_pixels("Exiting...", x=0, y=0, text_color='white')
+            display.update()
+        print(self.scheduler.format_stats())
+        self.disable_profiling()
+        if self.recovery.losses:
+            print(self.recovery.format_stats())
+        if self.line_estimator is not None:
+            print(self.line_estimator.format_stats())
+        if self.track_map is not None and self.track_map.ready and self.track_map_path is not None \
+                and not os.path.exists(self.track_map_path):
+            self.track_map.save(self.track_map_path)
+            print("Saved track map to {}".format(self.track_map_path))
+        self.speaker.speak("Goodbye")
+        self.speaker.stop()
+
+def add_arguments(parser):
+    """
+    Add the options of main() to an argparse parser, see set_up().
+    """
+    parser.add_argument('--track-map', action='store_true',
+                        help="Learn the track on the first run and follow its speed profile on the next ones, up to "
+                             "the configured base speed, see track_map.py. Also enabled by a track_map key in "
+                             "gains.json")
+    parser.add_argument('--tuning-server', action='store_true',
+                        help="Accept tuning commands from tuning_client.py, see tuning_server.py")
+    parser.add_argument('--tuning-host', default=DEFAULT_HOST,
+                        help="Interface the tuning server listens on, 0.0.0.0 accepts unauthenticated commands from "
+                             "every host on the network")
+    parser.add_argument('--tuning-port', type=int, default=DEFAULT_PORT)
+
+
+def set_up(follower, args, acquisition=True):
+    """
+    Load the saved gains and calibration and enable what main() runs with.
+    :param args: Options parsed by a parser with add_arguments().
+    :param acquisition: Read the sensor in the acquisition thread.
+    """
+    follower.load_gains()
+    follower.load_calibration()
+    if acquisition:
+        follower.enable_acquisition()
+    if args.track_map and follower.track_map is None:
+        follower.enable_track_map()
+    follower.enable_telemetry()
+    if args.tuning_server:
+        follower.enable_tuning_server(host=args.tuning_host, port=args.tuning_port)
+
+
+def main(start=None):
+    """
+    :param start: time.perf_counter() at launch, to include the imports in the startup report.
+    """
+    parser = argparse.ArgumentParser(description="Follow a line with the EV3.")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    startup = StartupReport(start)
+    if start is not None:
+        startup.mark('imports')
+    follower = LineFollower(startup=startup)
+    set_up(follower, args)
+    startup.mark('configuration')
     follower.follow_line()
 
 
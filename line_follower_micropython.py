@@ -1,5 +1,96 @@
 #!/usr/bin/env micropython
-from line_follower import main
+"""
+Line follower for MicroPython on the EV3, running the allocation-free fixed-point core of fixed_point_core.py.
+
+    micropython line_follower_micropython.py              # Follow the line until Ctrl-C
+    micropython line_follower_micropython.py --check      # Compare the cores with each other and the float code
+    micropython line_follower_micropython.py --benchmark  # Loop rate on the real devices, the motors will turn
+
+The robot waits for the enter button before it starts following. Any button stops the motors: enter again resumes,
+backspace or any other button exits.
+
+The same commands work with python3. So far they have only been run with python3, not on MicroPython. Gains are read from gains.json and the active calibration profile from
+calibration.json, as written by pid_tuner.py and calibration.py.
+"""
+import json
+import sys
+
+from fixed_point_core import *
+
+try:
+    from fixed_point_native import NativeEstimator, NativePID, NativeControlCore
+except SyntaxError:
+    # This MicroPython build has no native code emitter, run the plain bytecode classes
+    NativeEstimator, NativePID, NativeControlCore = FixedPointEstimator, FixedPointPID, ControlCore
+
+# No os.path on MicroPython
+DIRECTORY = __file__.rsplit('/', 1)[0] if '/' in __file__ else '.'
+
+
+def load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def create_core(port='in1', left_port='outA', right_port='outB', flipped=False, root=SYS_CLASS):
+    gains = load_json(DIRECTORY + '/gains.json') or {}
+    estimator_options = {'flipped': flipped}
+    calibration = load_json(DIRECTORY + '/calibration.json')
+    if calibration is not None and calibration.get('active') in calibration['profiles']:
+        profile = calibration['profiles'][calibration['active']]
+        estimator_options['minimums'] = profile['minimums']
+        estimator_options['maximums'] = profile['maximums']
+        print("Using calibration profile '{}'".format(calibration['active']))
+
+    return NativeControlCore(SysfsLightArray(port, root), SysfsMotor(left_port, root), SysfsMotor(right_port, root),
+                             NativeEstimator(**estimator_options),
+                             NativePID(gains.get('kp', 6.5), gains.get('ki', 0.0), gains.get('kd', 6.5)),
+                             base_speed=gains.get('base_speed', 10))
+
+
+def follow(core, buttons):
+    """
+    Follow the line between presses of the enter button until another button is pressed.
+    """
+    print("Press enter to start or another button to exit")
+    while buttons.pressed(-1) == 'enter':
+        core.pid.reset()
+        core.last_position = NO_LINE
+        print("Following the line, press enter to pause or another button to exit")
+        if core.run(buttons=buttons) != 'enter':
+            return
+        print("Paused, press enter to resume or another button to exit")
+
+
+def main():
+    if '--check' in sys.argv:
+        for estimator_class, pid_class in ((FixedPointEstimator, FixedPointPID), (NativeEstimator, NativePID)):
+            position_error, output_error = self_check(estimator_class=estimator_class, pid_class=pid_class)
+            print("{}: largest difference to the floating point code: position {:.4f} | PID output {:.4f} %".format(
+                estimator_class.__name__, position_error, output_error))
+        differences = compare_cores(NativeControlCore, NativeEstimator, NativePID)
+        print("{}: {} of the motor writes differ from ControlCore".format(NativeControlCore.__name__, differences))
+        return
+
+    core = create_core()
+    if '--benchmark' in sys.argv:
+        rate, allocated = benchmark_loop(core)
+        print("{:.0f} ticks/s | {} bytes allocated per tick".format(rate, allocated))
+        return
+
+    buttons = EvdevButtons()
+    try:
+        follow(core, buttons)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        buttons.close()
+        core.stop()
+    print(core.format_stats())
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
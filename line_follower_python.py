@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
+import time
+
+START = time.perf_counter()
+
 from line_follower import main
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(START)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Alpha-beta tracking of the line position and its lateral velocity, between the sensor and the PID.
+
+Run directly to compare following with and without the estimator in the simulator:
+    python3 line_state_estimator.py --track rounded --kd 15 --speed 60
+"""
+import argparse
+
+
+class LineStateEstimator:
+    """
+    Tracks the line position and lateral velocity with an alpha-beta filter, a steady-state Kalman filter for a
+    constant velocity model with fixed gains.
+
+    Every frame first predicts the state forward to its timestamp, then corrects position and velocity by alpha and
+    beta times the difference to the measured position. The position handed to the PID is the estimate predicted
+    forward by the latency from reading the sensor to the motors acting on it, so the controller steers for where
+    the line will be rather than where it was, and the filtering keeps the sensor noise out of the derivative term.
+
+    A measurement further than gate from the prediction is rejected as an outlier (a glare, a crossing line) and the
+    prediction used instead, unless it happens max_outliers times in a row, which means the line really jumped and
+    the filter starts over from the measurement. Frames without a line are bridged by the prediction for max_coast
+    seconds before the line counts as lost.
+
+    update() only does a constant number of float operations, there are no buffers to fill.
+    """
+    def __init__(self, alpha=0.5, beta=0.05, gate=2.5, max_outliers=2, max_coast=0.02, lead=0.05, min_position=1.0,
+                 max_position=8.0):
+        """
+        :param alpha: Position correction gain, 0 to 1. Lower filters more but follows the line later.
+        :param beta: Velocity correction gain, alpha ** 2 / (2 - alpha) is critically damped, lower keeps the noise out
+        of the velocity that the prediction multiplies by the latency.
+        :param gate: Largest distance in positions of a measurement from the prediction that is not an outlier.
+        :param max_outliers: Consecutive outliers after which the measurement is believed and the filter restarts.
+        :param max_coast: Seconds without a line that are bridged by the prediction. Keep it short, in a sharp corner
+        the recovery of the follower brings the line back sooner than coasting on the old velocity.
+        :param lead: Seconds to predict ahead in addition to the latency passed to update(), about the time constant
+        of the motors.
+        :param min_position: Smallest position the array can report, predictions are clamped to it.
+        :param max_position: Largest position the array can report.
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.gate = gate
+        self.max_outliers = max_outliers
+        self.max_coast = max_coast
+        self.lead = lead
+        self.min_position = min_position
+        self.max_position = max_position
+
+        self.outliers = 0  # Measurements rejected in total
+        self.coasted = 0  # Frames without a line bridged by the prediction
+        self.restarts = 0  # Restarts after max_outliers consecutive outliers
+        self.reset()
+
+    def reset(self):
+        self.position = None  # Filtered position at last_time, None before the first measurement
+        self.velocity = 0.0  # Positions per second
+        self.last_time = None
+        self.last_measurement = None  # Time of the last accepted measurement
+        self._consecutive_outliers = 0
+
+    def update(self, timestamp, position, latency=0.0):
+        """
+        :param timestamp: Time the frame was read.
+        :param position: Measured line position, None if no line was detected.
+        :param latency: Seconds from reading the frame until the motors act on the output.
+        :return: The position predicted at the time the motors act, None if the line is lost.
+        """
+        if self.position is None:
+            if position is None:
+                return None
+            self.position = position
+            self.velocity = 0.0
+            self.last_time = timestamp
+            self.last_measurement = timestamp
+            return self._predict(latency)
+
+        dt = timestamp - self.last_time
+        predicted = self.position + self.velocity * dt if dt > 0 else self.position
+
+        if position is None:
+            if timestamp - self.last_measurement > self.max_coast:
+                self.reset()
+                return None
+            self.coasted += 1
+            self._advance(timestamp, predicted)
+            return self._predict(latency)
+
+        residual = position - predicted
+        if residual > self.gate or residual < -self.gate:
+            self._consecutive_outliers += 1
+            if self._consecutive_outliers <= self.max_outliers:
+                self.outliers += 1
+                self._advance(timestamp, predicted)
+                return self._predict(latency)
+            self.restarts += 1
+            self.reset()
+            return self.update(timestamp, position, latency)
+
+        self._consecutive_outliers = 0
+        self.last_measurement = timestamp
+        if dt > 0:
+            self.velocity += self.beta * residual / dt
+        self._advance(timestamp, predicted + self.alpha * residual)
+        return self._predict(latency)
+
+    def _advance(self, timestamp, position):
+        if position < self.min_position:
+            position = self.min_position
+        elif position > self.max_position:
+            position = self.max_position
+        self.position = position
+        self.last_time = timestamp
+
+    def _predict(self, latency):
+        position = self.position + self.velocity * (latency + self.lead)
+        if position < self.min_position:
+            return self.min_position
+        if position > self.max_position:
+            return self.max_position
+        return position
+
+    def format_stats(self):
+        return "Line state: {} outliers rejected | {} restarts | {} frames coasted".format(
+            self.outliers, self.restarts, self.coasted)
+
+
+def compare(track='rounded', duration=60.0, speed=60, kd=15.0, sensor_noise=3.0, estimator_options=None):
+    """
+    Run the same simulated scenario with the raw line position and with the estimator in between.
+    :return: List of (label, world summary, estimator or None).
+    """
+    from line_follower import LineFollower
+    from simulation import SimulationBackend, TRACKS, run_simulation
+    import contextlib
+    import io
+
+    track = TRACKS[track]()
+    results = []
+    for label in ("raw", "estimated"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            follower = LineFollower(backend=SimulationBackend(track=track, sensor_noise=sensor_noise))
+            follower.debug_mode = False
+            follower.apply_gains({'kd': kd, 'base_speed': speed})
+            if label == "estimated":
+                follower.enable_line_estimator(**(estimator_options or {}))
+            summary = run_simulation(follower, duration)
+        results.append((label, summary, follower.line_estimator))
+    return results
+
+
+def main():
+    from simulation import TRACKS
+
+    parser = argparse.ArgumentParser(description="Compare following with and without the line state estimator.")
+    parser.add_argument('--track', default='rounded', choices=sorted(TRACKS))
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--speed', type=float, default=60.0)
+    parser.add_argument('--kd', type=float, default=15.0)
+    parser.add_argument('--noise', type=float, default=3.0, help="Standard deviation of the simulated sensor noise")
+    parser.add_argument('--alpha', type=float, default=0.5)
+    parser.add_argument('--beta', type=float, default=0.05)
+    parser.add_argument('--lead', type=float, default=0.05)
+    parser.add_argument('--max-coast', type=float, default=0.02)
+    args = parser.parse_args()
+
+    options = {'alpha': args.alpha, 'beta': args.beta, 'lead': args.lead, 'max_coast': args.max_coast}
+    for label, summary, estimator in compare(args.track, args.duration, args.speed, args.kd, args.noise, options):
+        lap_time = sum(summary['lap_times']) / len(summary['lap_times']) if summary['lap_times'] else float('nan')
+        print("{:<9} | laps {:2d} | lap time {:6.2f} s | RMS error {:5.1f} mm | max error {:5.1f} mm | "
+              "off track {}".format(label, summary['laps'], lap_time, summary['rms_error'], summary['max_error'],
+                                    summary['off_track']))
+        if estimator is not None:
+            print("          | {}".format(estimator.format_stats()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import math
+import time
+
+
+class RunningStats:
+    """
+    Count, mean, standard deviation, minimum and maximum of a stream of values without storing them.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.total_squares += value * value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def stddev(self):
+        if self.count < 2:
+            return 0.0
+        variance = (self.total_squares - self.total * self.total / self.count) / (self.count - 1)
+        return math.sqrt(max(0.0, variance))
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'stddev': self.stddev,
+            'min': self.minimum,
+            'max': self.maximum,
+        }
+
+
+class LoopScheduler:
+    """
+    Runs a control loop at a fixed period using monotonic deadlines and records timing statistics:
+    tick start latency against the deadline, period jitter, missed deadlines and the time spent in each phase.
+
+    Usage per tick: begin_tick(), mark('<phase>') after each phase, end_tick() which sleeps until the next deadline.
+    """
+    def __init__(self, period=0.01, phases=('ui', 'sensor', 'display', 'pid', 'motor'), clock=time.monotonic, sleep=time.sleep,
+                 timer=None):
+        """
+        :param period: Target tick period in seconds. 0 runs free without sleeping, but still records statistics.
+        :param phases: Names of the phases to break the tick time down into.
+        :param clock: Monotonic clock returning seconds, the deadlines are scheduled on it.
+        :param sleep: Function sleeping for the given number of seconds.
+        :param timer: Clock used to measure the busy and phase times. Defaults to clock, a simulation with a virtual
+                      clock passes a real one here to still get the actual cost of each phase.
+        """
+        self.period = period
+        self.phases = tuple(phases)
+        self.clock = clock
+        self.sleep = sleep
+        self.timer = timer if timer is not None else clock
+
+        self.loop_frequency = 0.0
+        self._deadline = None
+        self._tick_timer_start = None
+        self._last_tick_start = None
+        self._last_mark = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.missed_deadlines = 0
+        self.latency = RunningStats()
+        self.interval = RunningStats()
+        self.busy = RunningStats()
+        self.phase_stats = dict((phase, RunningStats()) for phase in self.phases)
+        # Also called between ticks (e.g. by the tuning server), so the frequency window restarts now
+        self._frequency_window_start = self.clock()
+        self._frequency_window_ticks = 0
+
+    def start(self):
+        """
+        Set the first deadline to now. Called automatically by the first begin_tick().
+        """
+        self._deadline = self.clock()
+        self._last_tick_start = None
+        self._frequency_window_start = self._deadline
+        self._frequency_window_ticks = 0
+
+    def begin_tick(self):
+        if self._deadline is None:
+            self.start()
+        now = self.clock()
+        self.latency.add(max(0.0, now - self._deadline))
+        if self._last_tick_start is not None:
+            self.interval.add(now - self._last_tick_start)
+        self._last_tick_start = now
+        self._tick_timer_start = self._last_mark = self.timer()
+
+    def mark(self, phase):
+        """
+        Attribute the time since the previous mark (or the start of the tick) to phase.
+        """
+        now = self.timer()
+        self.phase_stats[phase].add(now - self._last_mark)
+        self._last_mark = now
+
+    def end_tick(self):
+        """
+        Finish the tick, update the statistics and sleep until the next deadline.
+        If the loop fell more than a period behind, the schedule is resynchronized instead of bursting to catch up.
+        """
+        self.busy.add(self.timer() - self._tick_timer_start)
+        now = self.clock()
+        self.ticks += 1
+
+        self._frequency_window_ticks += 1
+        elapsed = now - self._frequency_window_start
+        if elapsed >= 1.0:  # Update frequency every second
+            self.loop_frequency = self._frequency_window_ticks / elapsed
+            self._frequency_window_start = now
+            self._frequency_window_ticks = 0
+
+        self._deadline += self.period
+        if self.period <= 0:
+            self._deadline = now
+            return
+
+        if now > self._deadline:
+            self.missed_deadlines += 1
+            if now - self._deadline > self.period:
+                self._deadline = now
+            return
+
+        self.sleep(self._deadline - now)
+
+    def stats(self):
+        return {
+            'period': self.period,
+            'ticks': self.ticks,
+            'missed_deadlines': self.missed_deadlines,
+            'loop_frequency': self.loop_frequency,
+            'latency': self.latency.as_dict(),
+            'interval': self.interval.as_dict(),
+            'jitter': self.interval.stddev,
+            'busy': self.busy.as_dict(),
+            'phases': dict((phase, stats.as_dict()) for phase, stats in self.phase_stats.items()),
+        }
+
+    def format_stats(self):
+        ms = 1000.0
+        lines = [
+            "Ticks: {} | Target: {:.1f} Hz | Actual: {:.1f} Hz | Missed deadlines: {}".format(
+                self.ticks, 1.0 / self.period if self.period > 0 else 0.0, self.loop_frequency, self.missed_deadlines),
+            "Interval: mean {:.3f} ms | jitter {:.3f} ms | max {:.3f} ms".format(
+                self.interval.mean * ms, self.interval.stddev * ms, (self.interval.maximum or 0.0) * ms),
+            "Latency: mean {:.3f} ms | max {:.3f} ms".format(
+                self.latency.mean * ms, (self.latency.maximum or 0.0) * ms),
+            "Busy: mean {:.3f} ms | max {:.3f} ms".format(self.busy.mean * ms, (self.busy.maximum or 0.0) * ms),
+        ]
+        for phase in self.phases:
+            stats = self.phase_stats[phase]
+            lines.append("  {:<8} mean {:.3f} ms | max {:.3f} ms".format(
+                phase, stats.mean * ms, (stats.maximum or 0.0) * ms))
+        return "\n".join(lines)
@@ -1,48 +1,147 @@
+import time
+
+
 class PIDController:
     """
     A simple PID Controller class.
+
+    By default every call to compute() is one time step, exactly like the original controller, so existing tunings keep
+    working. With time_aware=True the integral and derivative are scaled by the elapsed time between calls, so the
+    gains keep their meaning when the loop rate changes. Optionally the derivative is low-pass filtered and the
+    integral is protected against windup.
     """
+    __slots__ = (
+        'kp', 'ki', 'kd', 'setpoint', 'output_limits',
+        'time_aware', 'derivative_time_constant', 'anti_windup', 'back_calculation_gain', 'clock',
+        'proportional_term', 'integral_term', 'derivative_term',
+        '_integral', '_previous_error', '_last_output', '_derivative', '_last_time',
+    )
+
+    ANTI_WINDUP_MODES = (None, 'clamp', 'back-calculation')
+
+    def __init__(self, kp, ki, kd, setpoint=0, output_limits=(None, None), time_aware=False,
+                 derivative_time_constant=0.0, anti_windup=None, back_calculation_gain=1.0, clock=time.monotonic):
+        """
+        :param time_aware: Scale the integral and derivative by the elapsed time (seconds) instead of per call.
+        :param derivative_time_constant: Time constant of the first-order low-pass on the derivative term, in the
+                                         same unit as dt (seconds if time_aware, calls otherwise). 0 disables it.
+        :param anti_windup: None (unbounded integral), 'clamp' (conditional integration: stop integrating while the
+                            output saturates in the direction of the error) or 'back-calculation' (bleed the integral
+                            by the amount the output exceeds its limits).
+        :param back_calculation_gain: Tracking gain for 'back-calculation'.
+        :param clock: Monotonic clock used when time_aware and no dt is passed.
+        """
+        if anti_windup not in self.ANTI_WINDUP_MODES:
+            raise ValueError("Invalid anti windup mode. Use None, 'clamp' or 'back-calculation'.")
 
-    def __init__(self, kp, ki, kd, setpoint=0, output_limits=(None, None)):
         self.kp = kp
         self.ki = ki
         self.kd = kd
         self.setpoint = setpoint
         self.output_limits = output_limits
 
-        self._integral = 0
-        self._previous_error = 0
-        self._last_output = 0
+        self.time_aware = time_aware
+        self.derivative_time_constant = derivative_time_constant
+        self.anti_windup = anti_windup
+        self.back_calculation_gain = back_calculation_gain
+        self.clock = clock
+
+        self.reset()
+
+    def compute(self, current_value, dt=None):
+        """
+        :param current_value: The measured process value.
+        :param dt: Elapsed time since the previous call. Only used if time_aware, measured with the clock if None.
+        :return: The controller output.
+        """
+        return self.update(self.setpoint - current_value, dt)
 
-    def compute(self, current_value):
-        error = self.setpoint - current_value
+    def update(self, error, dt=None):
+        """
+        Advance the controller by one step with an already computed error.
+        """
+        if self.time_aware:
+            if dt is None:
+                now = self.clock()
+                dt = 0.0 if self._last_time is None else now - self._last_time
+                self._last_time = now
+        else:
+            dt = 1
 
         proportional = self.kp * error
 
-        self._integral += error
+        previous_integral = self._integral
+        if self.time_aware:
+            self._integral += error * dt
+        else:
+            self._integral += error
         integral = self.ki * self._integral
 
-        derivative = self.kd * (error - self._previous_error)
+        if self.time_aware:
+            raw_derivative = (error - self._previous_error) / dt if dt > 0 else 0.0
+        else:
+            raw_derivative = error - self._previous_error
+        if self.derivative_time_constant > 0:
+            alpha = dt / (self.derivative_time_constant + dt)
+            self._derivative += alpha * (raw_derivative - self._derivative)
+        else:
+            self._derivative = raw_derivative
+        derivative = self.kd * self._derivative
         self._previous_error = error
 
         output = proportional + integral + derivative
 
+        unclamped_output = output
         min_output, max_output = self.output_limits
         if min_output is not None:
             output = max(min_output, output)
         if max_output is not None:
             output = min(max_output, output)
 
+        if output != unclamped_output and self.anti_windup is not None and self.ki != 0:
+            if self.anti_windup == 'clamp':
+                # Only integrate if it moves the output back towards the allowed range
+                if (unclamped_output > output) == (error > 0):
+                    self._integral = previous_integral
+            else:
+                self._integral += self.back_calculation_gain * (output - unclamped_output) / self.ki * dt
+            integral = self.ki * self._integral
+
+        self.proportional_term = proportional
+        self.integral_term = integral
+        self.derivative_term = derivative
         self._last_output = output
         return output
 
-    def reset(self):
+    def compute_many(self, errors, dts=None):
+        """
+        Run the controller over a sequence of errors, e.g. to replay a recorded log with different gains.
+        The controller state carries over between calls, use reset() first for an independent replay.
+        :param errors: Iterable of errors (setpoint - value).
+        :param dts: Iterable of time steps, required for a deterministic replay if time_aware.
+        :return: List of outputs.
+        """
+        update = self.update
+        if dts is None:
+            return [update(error) for error in errors]
+        return [update(error, dt) for error, dt in zip(errors, dts)]
+
+    def reset(self, previous_error=0):
+        """
+        :param previous_error: Error the next derivative is computed against, e.g. the current error when taking over
+                               control after the controller was paused, so the first output has no derivative kick.
+        """
         self._integral = 0
-        self._previous_error = 0
+        self._previous_error = previous_error
         self._last_output = 0
+        self._derivative = 0
+        self._last_time = None
+        self.proportional_term = 0
+        self.integral_term = 0
+        self.derivative_term = 0
 
     def set_setpoint(self, setpoint):
         self.setpoint = setpoint
 
     def set_output_limits(self, min_output, max_output):
-        self.output_limits = (min_output, max_output)
\ No newline at end of file
+        self.output_limits = (min_output, max_output)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Offline PID gain tuner.
+
+Runs headless LineFollower episodes in the simulator on all cores and searches kp, ki, kd and base_speed with a grid,
+random sampling and a coordinate descent refinement. Every result is cached by a hash of its parameters, so an
+interrupted search resumes where it stopped. The best gains are written to gains.json, which the robot loads at startup.
+
+Example:
+    python3 pid_tuner.py --track rounded --strategy all --samples 64
+"""
+from multiprocessing import Pool, cpu_count
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import math
+import os
+import random
+
+PARAMETERS = ('kp', 'ki', 'kd', 'base_speed')
+
+DEFAULT_SPACE = {
+    'kp': (1.0, 20.0),
+    'ki': (0.0, 0.5),
+    'kd': (0.0, 30.0),
+    'base_speed': (10.0, 60.0),
+}
+
+# Score weights: seconds of lap time per millimeter of RMS error and per tracking loss
+RMS_WEIGHT = 0.5
+LOSS_WEIGHT = 2.0
+OFF_TRACK_PENALTY = 1000.0
+
+_tracks = {}
+
+
+def get_track(name):
+    """
+    Rasterizing a track is expensive, so each worker process builds every track only once.
+    """
+    from simulation import TRACKS
+
+    if name not in _tracks:
+        _tracks[name] = TRACKS[name]()
+    return _tracks[name]
+
+
+def run_episode(params, track='oval', duration=60.0, seed=0):
+    """
+    Run one headless episode with the given gains.
+    :return: The simulation summary extended with tracking_losses and score.
+    """
+    from line_follower import LineFollower
+    from simulation import SimulationBackend, run_simulation
+
+    backend = SimulationBackend(track=get_track(track), seed=seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        follower = LineFollower(backend=backend)
+        follower.debug_mode = False
+        follower.apply_gains(params)
+        summary = run_simulation(follower, duration)
+
+    summary['tracking_losses'] = follower.tracking_losses
+    summary['score'] = score(summary, backend.world.track_length, duration)
+    return summary
+
+
+def score(summary, track_length, duration):
+    """
+    Lower is better: the (extrapolated) lap time plus penalties for tracking error and lost line.
+    """
+    if summary['off_track']:
+        return OFF_TRACK_PENALTY + duration - summary['time']
+    if summary['lap_times']:
+        lap_time = sum(summary['lap_times']) / len(summary['lap_times'])
+    else:
+        lap_time = summary['time'] * track_length / max(summary['distance'], 1.0)
+    return lap_time + RMS_WEIGHT * summary['rms_error'] + LOSS_WEIGHT * summary['tracking_losses']
+
+
+def parameter_key(params, track, duration, seed):
+    data = json.dumps({'params': params, 'track': track, 'duration': duration, 'seed': seed}, sort_keys=True)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def _evaluate_task(task):
+    key, params, track, duration, seed = task
+    return key, params, run_episode(params, track, duration, seed)
+
+
+class Tuner:
+    """
+    Evaluates parameter sets in a process pool and caches the results in a JSON lines file.
+    """
+    def __init__(self, track='oval', duration=60.0, seed=0, cache_path='tuning_cache.jsonl', workers=None):
+        self.track = track
+        self.duration = duration
+        self.seed = seed
+        self.cache_path = cache_path
+        self.workers = workers or cpu_count()
+        self.results = {}
+
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        self.results[entry['key']] = entry
+            print("Loaded {} cached results from {}".format(len(self.results), cache_path))
+
+    def evaluate(self, candidates):
+        """
+        :param candidates: List of parameter dicts.
+        :return: List of (score, params) in the order of candidates.
+        """
+        candidates = [dict((name, round(float(params[name]), 4)) for name in PARAMETERS) for params in candidates]
+        keys = [parameter_key(params, self.track, self.duration, self.seed) for params in candidates]
+
+        tasks = []
+        for key, params in zip(keys, candidates):
+            if key not in self.results and key not in [task[0] for task in tasks]:
+                tasks.append((key, params, self.track, self.duration, self.seed))
+
+        if tasks:
+            cache = open(self.cache_path, 'a') if self.cache_path else None
+            try:
+                with Pool(min(self.workers, len(tasks))) as pool:
+                    for done, (key, params, summary) in enumerate(pool.imap_unordered(_evaluate_task, tasks), 1):
+                        entry = {'key': key, 'params': params, 'summary': summary}
+                        self.results[key] = entry
+                        if cache is not None:
+                            cache.write(json.dumps(entry) + "\n")
+                            cache.flush()
+                        print("[{}/{}] score {:.2f} | {}".format(done, len(tasks), summary['score'], format_params(params)))
+            finally:
+                if cache is not None:
+                    cache.close()
+
+        return [(self.results[key]['summary']['score'], params) for key, params in zip(keys, candidates)]
+
+    def best(self):
+        """
+        :return: (score, params) of the best result evaluated with this track, duration and seed, or None.
+        """
+        best = None
+        for entry in self.results.values():
+            if entry['key'] != parameter_key(entry['params'], self.track, self.duration, self.seed):
+                continue
+            candidate = (entry['summary']['score'], entry['params'])
+            if best is None or candidate[0] < best[0]:
+                best = candidate
+        return best
+
+
+def format_params(params):
+    return " ".join("{} {:.3f}".format(name, params[name]) for name in PARAMETERS)
+
+
+def grid_candidates(space, steps=3):
+    axes = []
+    for name in PARAMETERS:
+        low, high = space[name]
+        if steps == 1 or low == high:
+            axes.append([(low + high) / 2.0])
+        else:
+            axes.append([low + (high - low) * i / (steps - 1) for i in range(steps)])
+    return [dict(zip(PARAMETERS, values)) for values in itertools.product(*axes)]
+
+
+def random_candidates(space, samples, seed=0):
+    rng = random.Random(seed)
+    return [dict((name, rng.uniform(*space[name])) for name in PARAMETERS) for _ in range(samples)]
+
+
+def coordinate_descent(tuner, start, space, iterations=6, initial_step=0.25, min_step=0.01):
+    """
+    Refine start by trying a step up and down in every parameter in parallel, moving to the best neighbour and
+    halving the step (as a fraction of each parameter's range) when no neighbour improves.
+    :return: (score, params) of the best point found.
+    """
+    best_score, best = tuner.evaluate([start])[0]
+    step = initial_step
+    for _ in range(iterations):
+        if step < min_step:
+            break
+        neighbours = []
+        for name in PARAMETERS:
+            low, high = space[name]
+            for direction in (-1, 1):
+                candidate = dict(best)
+                candidate[name] = max(low, min(high, best[name] + direction * step * (high - low)))
+                if candidate[name] != best[name]:
+                    neighbours.append(candidate)
+
+        results = tuner.evaluate(neighbours)
+        score, params = min(results, key=lambda result: result[0])
+        if score < best_score:
+            best_score, best = score, params
+            print("Descent improved to {:.2f} | {}".format(best_score, format_params(best)))
+        else:
+            step /= 2.0
+    return best_score, best
+
+
+def write_gains(params, path):
+    with open(path, 'w') as f:
+        json.dump(dict((name, params[name]) for name in PARAMETERS), f, indent=2)
+        f.write("\n")
+
+
+def main():
+    from simulation import TRACKS
+
+    parser = argparse.ArgumentParser(description="Tune the line follower gains in the simulator.")
+    parser.add_argument('--track', default='oval', choices=sorted(TRACKS))
+    parser.add_argument('--duration', type=float, default=60.0, help="Simulated seconds per episode")
+    parser.add_argument('--strategy', default='all', choices=('grid', 'random', 'descent', 'all'))
+    parser.add_argument('--grid-steps', type=int, default=3)
+    parser.add_argument('--samples', type=int, default=32, help="Random samples")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache', default='tuning_cache.jsonl')
+    parser.add_argument('--output', default='gains.json')
+    args = parser.parse_args()
+
+    tuner = Tuner(args.track, args.duration, args.seed, args.cache, args.workers)
+    space = DEFAULT_SPACE
+
+    if args.strategy in ('grid', 'all'):
+        tuner.evaluate(grid_candidates(space, args.grid_steps))
+    if args.strategy in ('random', 'all'):
+        tuner.evaluate(random_candidates(space, args.samples, args.seed))
+    if args.strategy in ('descent', 'all'):
+        best = tuner.best()
+        start = best[1] if best is not None else {'kp': 6.5, 'ki': 0.0, 'kd': 6.5, 'base_speed': 10.0}
+        coordinate_descent(tuner, start, space)
+
+    best = tuner.best()
+    if best is None or math.isinf(best[0]):
+        print("No usable result.")
+        return
+    print("Best score {:.2f} | {}".format(best[0], format_params(best[1])))
+    write_gains(best[1], args.output)
+    print("Wrote {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Opt-in profiling of the control loop's hot path.
+
+A StageProfiler times methods of the live objects (the sensor's read_data, the PID's compute, the motors' set_speed,
+...) by putting a timing wrapper on the instance while it is enabled. Disabling removes the wrappers again, so a
+disabled profiler costs nothing at all, and it can be toggled at runtime between two ticks. Each stage keeps a count,
+the total and largest time in nanoseconds and a log-linear histogram, from which the percentiles are estimated.
+"""
+import json
+import time
+
+try:
+    clock_ns = time.perf_counter_ns
+except AttributeError:
+    # No perf_counter_ns before Python 3.7 (e.g. ev3dev stretch)
+    def clock_ns():
+        return int(time.perf_counter() * 1e9)
+
+# Four buckets per power of two, so a bucket is at most 25% wide. The last one collects everything above half an hour.
+SUB_BUCKETS = 4
+HISTOGRAM_SIZE = 160
+
+
+def bucket_index(ns):
+    bits = ns.bit_length()
+    if bits <= 2:
+        return ns
+    index = (bits - 2) * SUB_BUCKETS + ((ns >> (bits - 3)) & 3)
+    return index if index < HISTOGRAM_SIZE else HISTOGRAM_SIZE - 1
+
+
+def bucket_upper_bound(index):
+    """
+    :return: Smallest duration in nanoseconds above all durations counted in bucket index.
+    """
+    if index < SUB_BUCKETS:
+        return index + 1
+    bits = index // SUB_BUCKETS + 2
+    return (SUB_BUCKETS + index % SUB_BUCKETS + 1) << (bits - 3)
+
+
+class StageStats:
+    """
+    Count, total, maximum and histogram of the durations of one stage, in nanoseconds.
+    """
+    __slots__ = ('count', 'total', 'maximum', 'histogram')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+        self.histogram = [0] * HISTOGRAM_SIZE
+
+    def add(self, ns):
+        self.count += 1
+        self.total += ns
+        if ns > self.maximum:
+            self.maximum = ns
+        self.histogram[bucket_index(ns)] += 1
+
+    @property
+    def mean(self):
+        return self.total / float(self.count) if self.count else 0.0
+
+    def percentile(self, fraction):
+        """
+        :param fraction: 0 to 1, e.g. 0.99.
+        :return: Upper bound in nanoseconds of the bucket the percentile falls into, never above the maximum.
+        """
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return min(self.maximum, bucket_upper_bound(index))
+        return self.maximum
+
+    def as_dict(self):
+        us = 1e-3
+        return {
+            'count': self.count,
+            'total_us': self.total * us,
+            'mean_us': self.mean * us,
+            'p50_us': self.percentile(0.5) * us,
+            'p90_us': self.percentile(0.9) * us,
+            'p99_us': self.percentile(0.99) * us,
+            'max_us': self.maximum * us,
+            # [upper bound in microseconds, count] of the non-empty buckets
+            'histogram': [[bucket_upper_bound(index) * us, count] for index, count in enumerate(self.histogram)
+                          if count],
+        }
+
+
+class StageProfiler:
+    """
+    Times the calls of methods of objects, grouped into named stages, while enabled.
+    """
+    def __init__(self, clock=clock_ns):
+        """
+        :param clock: Function returning integer nanoseconds.
+        """
+        self.clock = clock
+        self.stages = {}  # Stage name -> StageStats, kept across enable() and disable()
+        self._order = []  # Stage names in the order they were first profiled
+        self._installed = []  # Functions undoing each wrap
+
+    @property
+    def enabled(self):
+        return bool(self._installed)
+
+    def stage(self, name):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+            self._order.append(name)
+        return stats
+
+    def enable(self, hooks):
+        """
+        Start timing the given methods.
+        :param hooks: List of (stage name, object, method name). Several methods can share a stage, e.g. the same
+                      method of both motors.
+        """
+        if self._installed:
+            return
+        for stage, owner, name in hooks:
+            self._wrap(self.stage(stage), owner, name)
+
+    def _wrap(self, stats, owner, name):
+        function = getattr(owner, name)
+        clock = self.clock
+        add = stats.add
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add(clock() - start)
+
+        if hasattr(owner, '__dict__'):
+            replaced = vars(owner).get(name)
+            setattr(owner, name, timed)
+            if replaced is None:
+                self._installed.append(lambda: delattr(owner, name))
+            else:
+                self._installed.append(lambda: setattr(owner, name, replaced))
+            return
+
+        # Objects with __slots__ (e.g. PIDController) take no instance attributes, they are switched to a subclass with
+        # the method replaced instead
+        original = owner.__class__
+        owner.__class__ = type(original.__name__, (original,), {
+            '__slots__': (),
+            name: lambda self, *args, **kwargs: timed(*args, **kwargs),
+        })
+        self._installed.append(lambda: setattr(owner, '__class__', original))
+
+    def disable(self):
+        """
+        Stop timing, every method is called directly again. The statistics are kept.
+        """
+        for restore in reversed(self._installed):
+            restore()
+        self._installed = []
+
+    def reset(self):
+        for stats in self.stages.values():
+            stats.reset()
+
+    def stats(self):
+        return dict((name, self.stages[name].as_dict()) for name in self._order)
+
+    def format(self):
+        us = 1e-3
+        lines = ["{:<24} {:>9} {:>10} {:>10} {:>10} {:>10}".format(
+            "Stage", "calls", "mean us", "p50 us", "p99 us", "max us")]
+        for name in self._order:
+            stats = self.stages[name]
+            lines.append("{:<24} {:>9} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                name, stats.count, stats.mean * us, stats.percentile(0.5) * us, stats.percentile(0.99) * us,
+                stats.maximum * us))
+        return "\n".join(lines)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2, sort_keys=True)
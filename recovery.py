@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Line loss recovery.
+
+Run directly to compare the recovery strategies in the simulator:
+    python3 recovery.py --track rectangle --speeds 20 30 40
+"""
+import argparse
+import time
+
+MODES = ('pivot', 'arc')
+
+
+class LineRecovery:
+    """
+    Steers the robot back to the line while the sensor does not see it.
+
+    While the line is tracked, observe() keeps a fixed-size history of positions and timestamps. When the line is
+    lost, the lateral velocity of the line under the sensor is estimated from that history by a least squares fit and
+    used to predict on which side the line left, and so where it will reappear.
+
+    'arc' mode turns towards that side on an arc that starts from the last commanded turn, plus more the faster the
+    line was moving away, and tightens over time until it turns as fast as a pivot. The outer wheel speeds up instead
+    of the inner one reversing, so the robot keeps moving along the track while it searches. On reacquisition the PID is reset so neither the
+    integral collected before the loss nor a derivative across the gap disturbs the hand-off.
+    'pivot' mode is the original behavior: spin in place at base speed towards the side of the last position.
+    """
+    def __init__(self, setpoint=4.5, mode='arc', history_size=16, velocity_window=0.05, min_turn=0.5, turn_rate=4.0,
+                 velocity_gain=0.02, max_recovery_time=1.0, num_sensors=8):
+        """
+        :param mode: 'arc' or 'pivot', see above.
+        :param history_size: Number of tracked positions kept.
+        :param velocity_window: Seconds of history the velocity is estimated from.
+        :param min_turn: Smallest turn an arc recovery starts with. The wheels differ by 2 * turn * base speed, so 0
+                         drives straight and 1 turns as fast as a pivot at base speed.
+        :param turn_rate: Increase of the turn per second lost.
+        :param velocity_gain: Additional initial turn per position unit per second of lateral velocity.
+        :param max_recovery_time: Recoveries taking longer than this many seconds count as failed.
+        """
+        if mode not in MODES:
+            raise ValueError("Invalid recovery mode. Use one of: {}".format(", ".join(MODES)))
+        self.setpoint = setpoint
+        self.mode = mode
+        self.velocity_window = velocity_window
+        self.min_turn = min_turn
+        self.turn_rate = turn_rate
+        self.velocity_gain = velocity_gain
+        self.max_recovery_time = max_recovery_time
+        self.num_sensors = num_sensors
+
+        self.history_size = history_size
+        self._positions = [0.0] * history_size
+        self._timestamps = [0.0] * history_size
+        self._count = 0  # Total positions observed, the next one goes to index _count % history_size
+
+        self.lost_since = None
+        self.direction = 0  # 1 to turn with the left wheel faster, -1 with the right one
+        self.velocity = 0.0
+        self.predicted_position = None  # Where the line is expected to reappear
+        self._start_turn = 0.0
+
+        self.losses = 0
+        self.recoveries = 0
+        self.failures = 0  # Recoveries that took longer than max_recovery_time
+        self.predictions_correct = 0  # Reacquisitions on the predicted side
+        self.time_lost = 0.0
+        self.longest_loss = 0.0
+
+    def observe(self, timestamp, position):
+        """
+        Record a tracked line position, called on every tick with a line.
+        """
+        index = self._count % self.history_size
+        self._positions[index] = position
+        self._timestamps[index] = timestamp
+        self._count += 1
+
+    def estimate_velocity(self, now=None):
+        """
+        :param now: Only use positions within velocity_window before this time, before the newest position if None.
+        :return: Least squares slope of the recent positions in position units per second, 0 with too little history.
+        """
+        count = min(self._count, self.history_size)
+        if count < 2:
+            return 0.0
+        newest = (self._count - 1) % self.history_size
+        if now is None:
+            now = self._timestamps[newest]
+
+        samples = []
+        for age in range(count):
+            index = (newest - age) % self.history_size
+            if now - self._timestamps[index] > self.velocity_window and len(samples) >= 2:
+                break
+            samples.append((self._timestamps[index], self._positions[index]))
+
+        mean_t = sum(t for t, _ in samples) / len(samples)
+        mean_p = sum(p for _, p in samples) / len(samples)
+        variance = sum((t - mean_t) ** 2 for t, _ in samples)
+        if variance <= 0:
+            return 0.0
+        return sum((t - mean_t) * (p - mean_p) for t, p in samples) / variance
+
+    def begin(self, timestamp, last_position, left_speed=0.0, right_speed=0.0):
+        """
+        Start a recovery when the line was lost.
+        :param last_position: The last detected line position.
+        :param left_speed: The speeds commanded on the last tick with a line, the arc starts from their turn.
+        """
+        self.lost_since = timestamp
+        self.losses += 1
+
+        last = last_position
+        self.velocity = self.estimate_velocity()
+        predicted = last
+        if self._count:
+            predicted += self.velocity * (timestamp - self._timestamps[(self._count - 1) % self.history_size])
+
+        # The line reappears at the edge it left over, position < setpoint turns with the left wheel faster
+        if self.mode == 'pivot':
+            self.direction = 1 if last < self.setpoint else -1
+        else:
+            self.direction = 1 if predicted < self.setpoint else -1
+        self.predicted_position = 1.0 if self.direction > 0 else float(self.num_sensors)
+
+        outer = max(abs(left_speed), abs(right_speed))
+        last_turn = abs(left_speed - right_speed) / (2.0 * outer) if outer > 0 else 0.0
+        self._start_turn = max(self.min_turn, last_turn) + self.velocity_gain * abs(self.velocity)
+
+    def speeds(self, timestamp, base_speed, max_speed=100):
+        """
+        :return: (left, right) motor speeds to recover with.
+        """
+        if self.mode == 'pivot':
+            outer = base_speed
+            inner = -base_speed
+        else:
+            turn = min(1.0, self._start_turn + self.turn_rate * (timestamp - self.lost_since))
+            outer = min(max_speed, base_speed * (1.0 + turn))
+            inner = outer - 2.0 * base_speed * turn
+        if self.direction > 0:
+            return outer, inner
+        return inner, outer
+
+    def end(self, timestamp, position, pid):
+        """
+        Finish the recovery when the line was found again and hand control back to the PID.
+        """
+        duration = timestamp - self.lost_since
+        self.lost_since = None
+        self.time_lost += duration
+        self.longest_loss = max(self.longest_loss, duration)
+        if duration <= self.max_recovery_time:
+            self.recoveries += 1
+        else:
+            self.failures += 1
+        if (position < self.setpoint) == (self.predicted_position < self.setpoint):
+            self.predictions_correct += 1
+
+        # Recent history is from before the loss and must not feed the next velocity estimate
+        self._count = 0
+        if self.mode != 'pivot':
+            pid.reset(previous_error=pid.setpoint - position)
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'losses': self.losses,
+            'recoveries': self.recoveries,
+            'failures': self.failures,
+            'predictions_correct': self.predictions_correct,
+            'time_lost': self.time_lost,
+            'longest_loss': self.longest_loss,
+        }
+
+    def format_stats(self):
+        return "Recovery ({}): {} losses | {} recovered | {} failed | {} predicted | lost {:.2f} s, longest {:.2f} s".format(
+            self.mode, self.losses, self.recoveries, self.failures, self.predictions_correct, self.time_lost,
+            self.longest_loss)
+
+
+def compare(track='rectangle', speeds=(20, 30, 40), duration=60.0, kp=6.5, kd=6.5):
+    """
+    Run the same simulated scenario with every recovery mode.
+    :return: List of (base speed, mode, world summary, recovery stats).
+    """
+    from line_follower import LineFollower
+    from simulation import SimulationBackend, TRACKS, run_simulation
+    import contextlib
+    import io
+
+    track = TRACKS[track]()
+    results = []
+    for speed in speeds:
+        for mode in MODES:
+            with contextlib.redirect_stdout(io.StringIO()):
+                follower = LineFollower(backend=SimulationBackend(track=track))
+                follower.debug_mode = False
+                follower.apply_gains({'kp': kp, 'kd': kd, 'base_speed': speed})
+                follower.recovery.mode = mode
+                summary = run_simulation(follower, duration)
+            results.append((speed, mode, summary, follower.recovery.stats()))
+    return results
+
+
+def main():
+    from simulation import TRACKS
+
+    parser = argparse.ArgumentParser(description="Compare the line loss recovery modes in the simulator.")
+    parser.add_argument('--track', default='rectangle', choices=sorted(TRACKS))
+    parser.add_argument('--speeds', type=float, nargs='+', default=[20, 30, 40])
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--kp', type=float, default=6.5)
+    parser.add_argument('--kd', type=float, default=6.5)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for speed, mode, summary, stats in compare(args.track, args.speeds, args.duration, args.kp, args.kd):
+        lap_time = sum(summary['lap_times']) / len(summary['lap_times']) if summary['lap_times'] else float('nan')
+        print("speed {:5.1f} | {:<5} | laps {:2d} | lap time {:6.2f} s | losses {:3d} | lost {:6.2f} s | "
+              "failed {:2d} | off track {}".format(speed, mode, summary['laps'], lap_time, stats['losses'],
+                                                  stats['time_lost'], stats['failures'], summary['off_track']))
+    print("Done in {:.1f} s".format(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+from light_array_sensor import SensorFrame
+from telemetry import RateLimitedLog
+from threading import Event, Thread
+import time
+
+
+class SensorAcquisition:
+    """
+    Reads a LightArraySensor continuously in a background thread, so the bus transaction overlaps with the control
+    loop's computation and motor writes instead of blocking it.
+
+    Every valid sample, with its line position already computed, is published into one of two slots together with a
+    sequence number. The thread always fills the slot the reader is not pointed at and then flips the published index,
+    so read_frame() never waits and never sees a half written sample.
+
+    Failed reads (wrong length, PermissionError and other OSErrors) are retried in the acquisition thread instead of
+    turning into invalid ticks. A frame is only reported as invalid once the newest sample is older than max_age.
+    """
+    def __init__(self, sensor, max_age=0.05, interval=0.0, retry_delay=0.002, clock=time.monotonic):
+        """
+        :param sensor: The LightArraySensor to read, its clock must be the same as clock.
+        :param max_age: Samples older than this many seconds are stale and reported as invalid frames.
+        :param interval: Minimum seconds between two reads, 0 to read as fast as the sensor answers.
+        :param retry_delay: Seconds to wait after a failed read before retrying.
+        """
+        self.sensor = sensor
+        self.max_age = max_age
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.clock = clock
+
+        self._slots = [None, None]
+        self._published = 0
+        self._sequence = 0  # Sequence number of the published sample, 0 before the first one
+        self._consumed = 0  # Sequence number of the last sample returned by read_frame()
+
+        self.reads = 0
+        self.read_errors = 0  # Reads that raised or returned invalid data and were retried
+        self.dropped = 0  # Samples overwritten before the control loop consumed them
+        self.duplicates = 0  # Ticks that got the same sample as the previous tick
+        self.stale = 0  # Ticks on which the newest sample was older than max_age
+
+        self.log = RateLimitedLog(interval=1.0, clock=clock)
+        self._stop_event = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, name='SensorAcquisition')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        sensor = self.sensor
+        stop_event = self._stop_event
+        while not stop_event.is_set():
+            mode = sensor.mode
+            try:
+                data = sensor.read_data(warn=False)
+                if data is None:
+                    self.log.log('invalid', "Invalid sensor data. Retrying...")
+            except OSError as e:  # Including PermissionError while the port is being set up
+                data = None
+                self.log.log('error', "Sensor read failed: {}. Retrying...".format(e))
+            timestamp = self.clock()
+            self.reads += 1
+
+            # A mode switch during the read may have returned data of the previous mode
+            if data is None or sensor.mode != mode:
+                self.read_errors += 1
+                stop_event.wait(self.retry_delay)
+                continue
+
+            sequence = self._sequence + 1
+            slot = 1 - self._published
+            self._slots[slot] = (sequence, SensorFrame(data, timestamp, mode, sensor.compute_line_position(data)))
+            self._published = slot
+            self._sequence = sequence
+
+            if self.interval > 0:
+                stop_event.wait(self.interval)
+
+    def latest(self):
+        """
+        :return: (sequence number, SensorFrame) of the newest sample without marking it consumed, (0, None) before
+                 the first sample.
+        """
+        slot = self._slots[self._published]
+        if slot is None:
+            return 0, None
+        return slot
+
+    def read_frame(self):
+        """
+        Return the freshest sample without waiting for the bus, a drop-in replacement for LightArraySensor.read_frame().
+        :return: The newest SensorFrame, or an invalid frame (values None) if there is no sample younger than max_age.
+        """
+        sequence, frame = self.latest()
+        now = self.clock()
+        if frame is None or now - frame.timestamp > self.max_age:
+            self.stale += 1
+            return SensorFrame(None, now, self.sensor.mode, None)
+
+        if sequence == self._consumed:
+            self.duplicates += 1
+        elif sequence > self._consumed + 1 and self._consumed:
+            self.dropped += sequence - self._consumed - 1
+        self._consumed = sequence
+        return frame
+
+    def format_stats(self):
+        return "Acquisition: {} reads | {} errors | {} dropped | {} duplicates | {} stale".format(
+            self.reads, self.read_errors, self.dropped, self.duplicates, self.stale)
@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+"""
+Hardware-free simulation backend for LineFollower.
+
+A track is rasterized into a grayscale image, a simulated light array samples it at the sensor pose and returns
+RAW/CAL data like the real ms-light-array, and the simulated motors drive a differential-drive kinematic model.
+Time is virtual: the control loop's sleeps advance the world, so a run is deterministic and faster than real time.
+"""
+from ev3dev2.motor import OUTPUT_A, OUTPUT_B
+from ev3_motor import EV3Motor
+from light_array_sensor import LightArraySensor
+from ui_events import ButtonEvents, BUTTON_CODES
+import math
+import random
+import struct
+import time
+
+
+class Track:
+    """
+    A rasterized track, one byte per pixel (0 black line, 255 white floor).
+    Tracks built from a centerline keep it for lap timing and tracking error measurements.
+    """
+    def __init__(self, width, height, resolution=2.0, pixels=None, centerline=None):
+        """
+        :param width: Width in pixels.
+        :param height: Height in pixels.
+        :param resolution: Millimeters per pixel.
+        :param pixels: Row-major bytearray of width * height pixels, all white if None.
+        :param centerline: Closed list of (x, y) points in millimeters along the middle of the line, or None.
+        """
+        self.width = width
+        self.height = height
+        self.resolution = resolution
+        self.pixels = pixels if pixels is not None else bytearray([255]) * (width * height)
+        self.centerline = centerline
+
+    @classmethod
+    def from_centerline(cls, points, line_width=20.0, margin=200.0, resolution=2.0):
+        """
+        Rasterize a closed polyline.
+        :param points: List of (x, y) points in millimeters, the last one connects back to the first.
+        :param line_width: Width of the black line in millimeters.
+        :param margin: White border around the line in millimeters.
+        """
+        min_x = min(x for x, _ in points)
+        min_y = min(y for _, y in points)
+        points = [(x - min_x + margin, y - min_y + margin) for x, y in points]
+        width = int(math.ceil((max(x for x, _ in points) + margin) / resolution))
+        height = int(math.ceil((max(y for _, y in points) + margin) / resolution))
+
+        track = cls(width, height, resolution, centerline=points)
+        for i in range(len(points)):
+            x1, y1 = points[i]
+            x2, y2 = points[(i + 1) % len(points)]
+            track.draw_line(x1, y1, x2, y2, line_width)
+        return track
+
+    @classmethod
+    def oval(cls, straight=1000.0, radius=300.0, segments_per_curve=48, **kwargs):
+        """
+        A stadium shaped track: two straights joined by half circles, driven counterclockwise.
+        """
+        points = []
+        for side in (0, 1):
+            cx = straight if side == 0 else 0.0
+            for i in range(segments_per_curve + 1):
+                angle = -math.pi / 2 + math.pi * side + math.pi * i / segments_per_curve
+                points.append((cx + radius * math.cos(angle), radius + radius * math.sin(angle)))
+        return cls.from_centerline(points, **kwargs)
+
+    @classmethod
+    def rectangle(cls, width=1200.0, height=800.0, corner_radius=0.0, segments_per_corner=12, **kwargs):
+        """
+        A rectangular track driven counterclockwise, with sharp corners if corner_radius is 0.
+        """
+        points = []
+        corners = ((width, 0.0), (width, height), (0.0, height), (0.0, 0.0))
+        for side, (x, y) in enumerate(corners):
+            if corner_radius <= 0:
+                points.append((x, y))
+                continue
+            cx = x - corner_radius if x > 0 else corner_radius
+            cy = y - corner_radius if y > 0 else corner_radius
+            start_angle = -math.pi / 2 + side * math.pi / 2
+            for i in range(segments_per_corner + 1):
+                angle = start_angle + (math.pi / 2) * i / segments_per_corner
+                points.append((cx + corner_radius * math.cos(angle), cy + corner_radius * math.sin(angle)))
+        return cls.from_centerline(points, **kwargs)
+
+    @classmethod
+    def load_pgm(cls, path, resolution=2.0):
+        """
+        Load a binary (P5) 8-bit PGM image, e.g. a photo or scan of the real course.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        fields = []
+        position = 0
+        while len(fields) < 4:
+            while data[position:position + 1].isspace():
+                position += 1
+            if data[position:position + 1] == b'#':
+                position = data.index(b'\n', position)
+                continue
+            end = position
+            while not data[end:end + 1].isspace():
+                end += 1
+            fields.append(data[position:end])
+            position = end
+        if fields[0] != b'P5' or int(fields[3]) != 255:
+            raise ValueError("Only binary 8-bit PGM images are supported")
+        width, height = int(fields[1]), int(fields[2])
+        return cls(width, height, resolution, bytearray(data[position + 1:position + 1 + width * height]))
+
+    def save_pgm(self, path):
+        with open(path, 'wb') as f:
+            f.write("P5\n{} {}\n255\n".format(self.width, self.height).encode())
+            f.write(self.pixels)
+
+    def draw_line(self, x1, y1, x2, y2, line_width):
+        """
+        Draw a black line segment by stamping discs along it, coordinates in millimeters.
+        """
+        radius = line_width / 2.0 / self.resolution
+        length = math.hypot(x2 - x1, y2 - y1)
+        steps = max(1, int(length / (self.resolution / 2.0)))
+        r = int(math.ceil(radius))
+        for step in range(steps + 1):
+            cx = (x1 + (x2 - x1) * step / steps) / self.resolution
+            cy = (y1 + (y2 - y1) * step / steps) / self.resolution
+            for py in range(max(0, int(cy) - r), min(self.height, int(cy) + r + 2)):
+                row = py * self.width
+                for px in range(max(0, int(cx) - r), min(self.width, int(cx) + r + 2)):
+                    if (px - cx) ** 2 + (py - cy) ** 2 <= radius * radius:
+                        self.pixels[row + px] = 0
+
+    def intensity(self, x, y):
+        """
+        Bilinear interpolated brightness (0..255) at a point in millimeters, white outside of the image.
+        """
+        fx = x / self.resolution
+        fy = y / self.resolution
+        px = int(math.floor(fx))
+        py = int(math.floor(fy))
+        if px < 0 or py < 0 or px >= self.width - 1 or py >= self.height - 1:
+            return 255.0
+        ax = fx - px
+        ay = fy - py
+        i = py * self.width + px
+        p = self.pixels
+        top = p[i] + (p[i + 1] - p[i]) * ax
+        bottom = p[i + self.width] + (p[i + self.width + 1] - p[i + self.width]) * ax
+        return top + (bottom - top) * ay
+
+
+class SimulatedMotor:
+    """
+    Stand-in for an ev3dev2 LargeMotor. The speed follows speed_sp with a first-order lag like the motor's speed
+    regulation, position and speed are reported in tacho counts (degrees).
+    """
+    max_speed = 1050
+    count_per_rot = 360
+
+    def __init__(self, time_constant=0.05):
+        self.time_constant = time_constant
+        self.speed_sp = 0
+        self.stop_action = 'coast'
+        self.commands = 0
+        self._running = False
+        self._speed = 0.0
+        self._position = 0.0
+
+    def on(self, speed, brake=True, block=False):
+        if hasattr(speed, 'to_native_units'):
+            speed = speed.to_native_units(self)
+        else:
+            speed = speed / 100.0 * self.max_speed
+        self.speed_sp = int(round(speed))
+        self.stop_action = 'hold' if brake else 'coast'
+        self._running = True
+        self.commands += 1
+
+    def off(self, brake=True):
+        self.stop_action = 'hold' if brake else 'coast'
+        self._running = False
+        self.commands += 1
+
+    def reset(self):
+        self.off(brake=False)
+        self._position = 0.0
+
+    @property
+    def position(self):
+        return int(round(self._position))
+
+    @position.setter
+    def position(self, value):
+        self._position = float(value)
+
+    @property
+    def speed(self):
+        return int(round(self._speed))
+
+    def advance(self, dt):
+        if self._running:
+            target = self.speed_sp
+            time_constant = self.time_constant
+        else:
+            target = 0.0
+            time_constant = self.time_constant / 4.0 if self.stop_action != 'coast' else self.time_constant * 4.0
+        self._speed += (target - self._speed) * min(1.0, dt / time_constant)
+        self._position += self._speed * dt
+
+
+class SimulatedLightArray:
+    """
+    Stand-in for the ev3dev2 Sensor of the ms-light-array. Samples the track under the simulated robot on every
+    bin_data() call: 8 signed 16-bit values in RAW mode, 16 bytes of which the first 8 are percentages in CAL mode
+    (mirroring what the real driver returns after switching from RAW).
+    """
+    def __init__(self, world, white=95, black=8, noise=1.0, seed=0):
+        """
+        :param white: RAW value over the white floor, a number or one value per element.
+        :param black: RAW value over the black line, a number or one value per element.
+        :param noise: Standard deviation of the Gaussian noise added to each RAW value.
+        """
+        self.world = world
+        self.whites = list(white) if isinstance(white, (list, tuple)) else [white] * 8
+        self.blacks = list(black) if isinstance(black, (list, tuple)) else [black] * 8
+        self.noise = noise
+        self.mode = 'RAW'
+        self.command = None
+        self.reads = 0
+        self._random = random.Random(seed)
+
+    @property
+    def bin_data_format(self):
+        return 's16' if self.mode == 'RAW' else 'u8'
+
+    def bin_data(self, fmt=None):
+        self.reads += 1
+        gauss = self._random.gauss
+        values = []
+        for brightness, white, black in zip(self.world.sample_sensor(), self.whites, self.blacks):
+            value = black + (white - black) * brightness / 255.0
+            if self.noise:
+                value += gauss(0.0, self.noise)
+            values.append(value)
+
+        if self.mode == 'RAW':
+            raw = bytearray(struct.pack('<8h', *[int(round(value)) for value in values]))
+        else:
+            cal = [max(0, min(100, int(round((value - black) * 100.0 / (white - black)))))
+                   for value, white, black in zip(values, self.whites, self.blacks)]
+            raw = bytearray(struct.pack('8B', *cal)) + bytearray(8)
+        if fmt is None:
+            return raw
+        return struct.unpack(fmt, raw)
+
+
+class SimulatedButtons(ButtonEvents):
+    """
+    Button event queue for the simulation, press() queues a complete press and release.
+    """
+    NAMES = tuple(BUTTON_CODES.values())
+
+    def __init__(self, clock):
+        ButtonEvents.__init__(self, debounce=0.0, clock=clock)
+
+    def press(self, name):
+        if name not in self.NAMES:
+            raise ValueError("Invalid button. Use one of: {}".format(", ".join(self.NAMES)))
+        self.push(name, True)
+        self.push(name, False)
+
+
+class SimulatedSound:
+    """
+    Stand-in for ev3dev2 Sound that records what would have been said.
+    """
+    def __init__(self):
+        self.spoken = []
+
+    def speak(self, text, *args, **kwargs):
+        self.spoken.append(text)
+
+    def beep(self, *args, **kwargs):
+        pass
+
+
+class SimulatedDisplay:
+    """
+    In-memory stand-in for ev3dev2 Display. Requires Pillow.
+    """
+    def __init__(self, width=178, height=128):
+        from PIL import Image, ImageDraw
+
+        self.image = Image.new('1', (width, height), 'white')
+        self.draw = ImageDraw.Draw(self.image)
+        self.updates = 0
+
+    def clear(self):
+        self.draw.rectangle((0, 0) + self.image.size, fill='white')
+
+    def text_pixels(self, text, clear_screen=True, x=0, y=0, text_color='black', font=None):
+        if clear_screen:
+            self.clear()
+        self.draw.text((x, y), text, fill=text_color)
+
+    def update(self):
+        self.updates += 1
+
+
+class SimulatedWorld:
+    """
+    Differential-drive robot on a track. Positions are in millimeters, the heading in radians (counterclockwise).
+    Element 0 of the light array is on the right side of the robot, like the real unflipped sensor.
+    """
+    def __init__(self, track, wheel_radius=28.0, wheel_base=120.0, sensor_offset=80.0, sensor_pitch=8.0,
+                 motor_time_constant=0.05, max_step=0.002, off_track_distance=150.0):
+        """
+        :param wheel_radius: Radius of the driven wheels in millimeters.
+        :param wheel_base: Distance between the wheels in millimeters.
+        :param sensor_offset: Distance of the light array ahead of the wheel axle in millimeters.
+        :param sensor_pitch: Spacing of the light array elements in millimeters.
+        :param max_step: Longest integration step in seconds.
+        :param off_track_distance: Distance from the centerline (if known) at which the robot counts as off track.
+        """
+        self.track = track
+        self.wheel_radius = wheel_radius
+        self.wheel_base = wheel_base
+        self.sensor_offset = sensor_offset
+        self.sensor_pitch = sensor_pitch
+        self.max_step = max_step
+        self.off_track_distance = off_track_distance
+
+        self.left_motor = SimulatedMotor(motor_time_constant)
+        self.right_motor = SimulatedMotor(motor_time_constant)
+
+        self.time = 0.0
+        self.distance = 0.0
+        self.lap_times = []
+        self.off_track = False
+        self._lap_start = 0.0
+        self._lap_start_distance = 0.0
+        self._error_squares = 0.0
+        self._error_time = 0.0
+        self.max_error = 0.0
+
+        self._segment_lengths = None
+        self._segment_index = 0
+        if track.centerline is not None:
+            points = track.centerline
+            self._segment_lengths = [
+                math.hypot(points[(i + 1) % len(points)][0] - x, points[(i + 1) % len(points)][1] - y)
+                for i, (x, y) in enumerate(points)
+            ]
+            self.track_length = sum(self._segment_lengths)
+            self._segment_starts = []
+            total = 0.0
+            for length in self._segment_lengths:
+                self._segment_starts.append(total)
+                total += length
+            self.place_on_centerline(0)
+        else:
+            self.track_length = None
+            self.x = self.y = self.heading = 0.0
+
+        self._progress = 0.0
+        self.lateral_error = 0.0
+
+    def place_on_centerline(self, index):
+        """
+        Put the robot on the centerline point index, facing along the track, with the sensor over the line.
+        """
+        points = self.track.centerline
+        x1, y1 = points[index]
+        x2, y2 = points[(index + 1) % len(points)]
+        self.heading = math.atan2(y2 - y1, x2 - x1)
+        self.x = x1 - self.sensor_offset * math.cos(self.heading)
+        self.y = y1 - self.sensor_offset * math.sin(self.heading)
+        self._segment_index = index
+
+    def sensor_points(self):
+        cos_h = math.cos(self.heading)
+        sin_h = math.sin(self.heading)
+        cx, cy = self.sensor_center()
+        points = []
+        for i in range(8):
+            lateral = (i - 3.5) * self.sensor_pitch  # Positive is to the left
+            points.append((cx - lateral * sin_h, cy + lateral * cos_h))
+        return points
+
+    def sample_sensor(self):
+        """
+        :return: Brightness (0..255) under each light array element.
+        """
+        intensity = self.track.intensity
+        return [intensity(x, y) for x, y in self.sensor_points()]
+
+    def advance(self, dt):
+        """
+        Integrate the motors and the robot pose over dt seconds.
+        """
+        elapsed = dt
+        while dt > 1e-12:
+            step = min(dt, self.max_step)
+            self.left_motor.advance(step)
+            self.right_motor.advance(step)
+
+            left_velocity = math.radians(self.left_motor._speed) * self.wheel_radius
+            right_velocity = math.radians(self.right_motor._speed) * self.wheel_radius
+            velocity = (left_velocity + right_velocity) / 2.0
+            angular_velocity = (right_velocity - left_velocity) / self.wheel_base
+
+            heading = self.heading + angular_velocity * step / 2.0
+            self.x += velocity * math.cos(heading) * step
+            self.y += velocity * math.sin(heading) * step
+            self.heading += angular_velocity * step
+            self.distance += abs(velocity) * step
+            self.time += step
+            dt -= step
+
+        if self._segment_lengths is not None:
+            self._update_progress(elapsed)
+
+    def _update_progress(self, elapsed):
+        """
+        Locate the sensor along the centerline to measure the tracking error and time laps.
+        """
+        points = self.track.centerline
+        count = len(points)
+        cx, cy = self.sensor_center()
+
+        best = None
+        for offset in range(-3, 12):  # The robot moves at most a few segments per tick
+            i = (self._segment_index + offset) % count
+            x1, y1 = points[i]
+            x2, y2 = points[(i + 1) % count]
+            length = self._segment_lengths[i]
+            if length == 0:
+                continue
+            t = ((cx - x1) * (x2 - x1) + (cy - y1) * (y2 - y1)) / (length * length)
+            t = max(0.0, min(1.0, t))
+            px = x1 + (x2 - x1) * t
+            py = y1 + (y2 - y1) * t
+            distance = math.hypot(cx - px, cy - py)
+            if best is None or distance < best[0]:
+                side = 1.0 if (x2 - x1) * (cy - y1) - (y2 - y1) * (cx - x1) >= 0 else -1.0
+                best = (distance, i, t, side)
+
+        distance, i, t, side = best
+        self._segment_index = i
+        self.lateral_error = side * distance
+        self._error_squares += distance * distance * elapsed
+        self._error_time += elapsed
+        self.max_error = max(self.max_error, distance)
+        if distance > self.off_track_distance:
+            self.off_track = True
+
+        progress = self._segment_starts[i] + t * self._segment_lengths[i]
+        if progress - self._progress < -self.track_length / 2.0 \
+                and self.distance - self._lap_start_distance > self.track_length / 2.0:
+            self.lap_times.append(self.time - self._lap_start)
+            self._lap_start = self.time
+            self._lap_start_distance = self.distance
+        self._progress = progress
+
+    def sensor_center(self):
+        return (self.x + self.sensor_offset * math.cos(self.heading),
+                self.y + self.sensor_offset * math.sin(self.heading))
+
+    @property
+    def rms_error(self):
+        """
+        Time weighted RMS distance of the sensor center from the centerline in millimeters.
+        """
+        return math.sqrt(self._error_squares / self._error_time) if self._error_time else 0.0
+
+    def summary(self):
+        return {
+            'time': self.time,
+            'distance': self.distance,
+            'laps': len(self.lap_times),
+            'lap_times': list(self.lap_times),
+            'rms_error': self.rms_error,
+            'max_error': self.max_error,
+            'off_track': self.off_track,
+        }
+
+
+# Named tracks for the command line tools
+TRACKS = {
+    'oval': lambda: Track.oval(),
+    'rounded': lambda: Track.rectangle(corner_radius=150.0),
+    'rectangle': lambda: Track.rectangle(),
+}
+
+
+class SimulationBackend:
+    """
+    Device backend for LineFollower that runs against a SimulatedWorld instead of the EV3 hardware.
+    The loop is scheduled on the world's virtual clock, the phases are still timed with the real perf_counter.
+    """
+    timer = staticmethod(time.perf_counter)
+
+    def __init__(self, track=None, world=None, left_port=OUTPUT_A, right_port=OUTPUT_B, display=False,
+                 sensor_noise=1.0, seed=0, sensor_white=95, sensor_black=8):
+        """
+        :param track: Track to drive on, an oval if None. Ignored if world is given.
+        :param world: An already configured SimulatedWorld.
+        :param left_port: Motor port LineFollower uses for the left wheel.
+        :param right_port: Motor port LineFollower uses for the right wheel.
+        :param display: Provide an in-memory display (requires Pillow), otherwise run headless.
+        :param sensor_noise: Standard deviation of the simulated sensor noise.
+        :param seed: Seed of the sensor noise.
+        :param sensor_white: Simulated RAW value over the floor, a number or one value per element.
+        :param sensor_black: Simulated RAW value over the line, a number or one value per element.
+        """
+        self.world = world if world is not None else SimulatedWorld(track if track is not None else Track.oval())
+        self.left_port = left_port
+        self.right_port = right_port
+        self.display = display
+        self.sensor_noise = sensor_noise
+        self.seed = seed
+        self.sensor_white = sensor_white
+        self.sensor_black = sensor_black
+
+        self.sound = SimulatedSound()
+        self.buttons = SimulatedButtons(self.clock)
+
+    def clock(self):
+        return self.world.time
+
+    def sleep(self, seconds):
+        self.world.advance(seconds)
+
+    def create_sound(self):
+        return self.sound
+
+    def create_sensor(self):
+        device = SimulatedLightArray(self.world, white=self.sensor_white, black=self.sensor_black,
+                                     noise=self.sensor_noise, seed=self.seed)
+        return LightArraySensor(device=device, sound=self.sound, clock=self.clock)
+
+    def create_motor(self, port):
+        if port == self.left_port:
+            return EV3Motor(port, motor=self.world.left_motor)
+        if port == self.right_port:
+            return EV3Motor(port, motor=self.world.right_motor)
+        raise ValueError("No simulated motor on port {}".format(port))
+
+    def create_button_events(self):
+        return self.buttons
+
+    def create_display(self):
+        return SimulatedDisplay() if self.display else None
+
+
+def run_simulation(follower, duration):
+    """
+    Run a LineFollower built on a SimulationBackend for duration seconds of simulated time.
+    :return: The world summary (laps, lap times, tracking error, ...).
+    """
+    follower.running = True
+    follower.follow_line(duration=duration, stop_condition=lambda: follower.backend.world.off_track)
+    return follower.backend.world.summary()
+
+
+if __name__ == "__main__":
+    from line_follower import LineFollower
+
+    follower = LineFollower(backend=SimulationBackend())
+    follower.debug_mode = False
+
+    start = time.perf_counter()
+    summary = run_simulation(follower, duration=180.0)
+    elapsed = time.perf_counter() - start
+
+    print("Simulated {:.1f} s in {:.2f} s ({:.1f}x real time)".format(summary['time'], elapsed, summary['time'] / elapsed))
+    print("Laps: {} | Lap times: {}".format(summary['laps'], ", ".join("{:.2f}".format(t) for t in summary['lap_times'])))
+    print("RMS error: {:.1f} mm | Max error: {:.1f} mm | Off track: {}".format(
+        summary['rms_error'], summary['max_error'], summary['off_track']))
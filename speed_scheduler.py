@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Curvature-aware base speed scheduling.
+
+Run directly to compare fixed and scheduled speeds in the simulator:
+    python3 speed_scheduler.py --track rounded
+"""
+import argparse
+import bisect
+import json
+
+
+class SpeedScheduler:
+    """
+    Chooses the base speed every tick from an estimate of the track curvature under the robot.
+
+    The curvature estimate combines the low-pass filtered derivative of the line position (the line sweeping across
+    the array) with the filtered magnitude of the PID output (how hard the controller has to steer), each normalized
+    by a scale at which the robot should be at min_speed. On straights both are small and the speed rises towards
+    max_speed, when they grow the speed drops. Speed changes are rate limited, with a higher limit for braking than
+    for accelerating, so the robot slows down quickly when a corner begins and speeds up gradually after it.
+
+    Optionally a gain table schedules kp and kd by speed band, since a faster robot usually needs more damping.
+    """
+    def __init__(self, min_speed=20.0, max_speed=60.0, derivative_scale=40.0, correction_scale=40.0,
+                 time_constant=0.05, acceleration=150.0, deceleration=400.0, gain_table=None):
+        """
+        :param min_speed: Base speed in the sharpest corners and while the line is lost.
+        :param max_speed: Base speed on straights.
+        :param derivative_scale: Filtered line position rate (positions per second) that counts as a full corner.
+        :param correction_scale: Filtered PID output magnitude that counts as a full corner.
+        :param time_constant: Time constant in seconds of the low-pass filters on both inputs.
+        :param acceleration: Maximum speed increase per second.
+        :param deceleration: Maximum speed decrease per second.
+        :param gain_table: Optional list of (upper speed bound, gains dict with kp and/or kd), see gains_for().
+        """
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.derivative_scale = derivative_scale
+        self.correction_scale = correction_scale
+        self.time_constant = time_constant
+        self.acceleration = acceleration
+        self.deceleration = deceleration
+
+        self.gain_table = sorted(gain_table, key=lambda band: band[0]) if gain_table else None
+        self._bounds = [band[0] for band in self.gain_table] if self.gain_table else None
+
+        self.reset()
+
+    def reset(self):
+        self.speed = self.min_speed
+        self.curvature = 0.0
+        self._derivative = 0.0
+        self._correction = 0.0
+        self._last_position = None
+        self._last_time = None
+
+    def _advance(self, timestamp):
+        """
+        :return: Seconds since the previous update, 0 on the first one.
+        """
+        dt = 0.0 if self._last_time is None else timestamp - self._last_time
+        self._last_time = timestamp
+        return dt
+
+    def _limit(self, target, dt):
+        if target > self.speed:
+            self.speed = min(target, self.speed + self.acceleration * dt)
+        else:
+            self.speed = max(target, self.speed - self.deceleration * dt)
+        return self.speed
+
+    def update(self, timestamp, position, correction):
+        """
+        Advance the scheduler with a tick's line position and PID output.
+        :return: The base speed to use.
+        """
+        dt = self._advance(timestamp)
+        if dt > 0:
+            alpha = dt / (self.time_constant + dt)
+            if self._last_position is not None:
+                self._derivative += alpha * ((position - self._last_position) / dt - self._derivative)
+            self._correction += alpha * (abs(correction) - self._correction)
+        self._last_position = position
+
+        self.curvature = min(1.0, abs(self._derivative) / self.derivative_scale +
+                             self._correction / self.correction_scale)
+        target = self.max_speed - (self.max_speed - self.min_speed) * self.curvature
+        return self._limit(target, dt)
+
+    def line_lost(self, timestamp):
+        """
+        Brake towards min_speed while the line is lost.
+        :return: The base speed to use.
+        """
+        dt = self._advance(timestamp)
+        self._last_position = None
+        self.curvature = 1.0
+        return self._limit(self.min_speed, dt)
+
+    def gains_for(self, speed):
+        """
+        :return: The gains dict of the first band whose upper bound is at least speed (the last band above all
+                 bounds), None without a gain table.
+        """
+        if self.gain_table is None:
+            return None
+        index = min(bisect.bisect_left(self._bounds, speed), len(self.gain_table) - 1)
+        return self.gain_table[index][1]
+
+
+def compare(track='rounded', duration=60.0, fixed_speeds=(10, 30, 50), scheduler_options=None):
+    """
+    Run the same simulated scenario with fixed base speeds and with the speed scheduler.
+    :return: List of (label, world summary).
+    """
+    from line_follower import LineFollower
+    from simulation import SimulationBackend, TRACKS, run_simulation
+    import contextlib
+    import io
+
+    track = TRACKS[track]()
+    scenarios = [("fixed {}".format(speed), speed, None) for speed in fixed_speeds]
+    scenarios.append(("scheduled", None, SpeedScheduler(**(scheduler_options or {}))))
+
+    results = []
+    for label, speed, scheduler in scenarios:
+        with contextlib.redirect_stdout(io.StringIO()):
+            follower = LineFollower(backend=SimulationBackend(track=track))
+            follower.debug_mode = False
+            if speed is not None:
+                follower.base_speed = speed
+            if scheduler is not None:
+                follower.speed_scheduler = scheduler
+            summary = run_simulation(follower, duration)
+        results.append((label, summary))
+    return results
+
+
+def main():
+    from simulation import TRACKS
+
+    parser = argparse.ArgumentParser(description="Compare fixed and scheduled base speeds in the simulator.")
+    parser.add_argument('--track', default='rounded', choices=sorted(TRACKS))
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--min-speed', type=float, default=20.0)
+    parser.add_argument('--max-speed', type=float, default=60.0)
+    parser.add_argument('--gain-table', type=json.loads, default=None,
+                        help='JSON list of [upper speed, {"kp": ..., "kd": ...}] bands')
+    args = parser.parse_args()
+
+    options = {'min_speed': args.min_speed, 'max_speed': args.max_speed, 'gain_table': args.gain_table}
+    for label, summary in compare(args.track, args.duration, scheduler_options=options):
+        lap_time = sum(summary['lap_times']) / len(summary['lap_times']) if summary['lap_times'] else float('nan')
+        print("{:<10} | laps {:2d} | lap time {:6.2f} s | RMS error {:5.1f} mm | max error {:5.1f} mm | "
+              "off track {}".format(label, summary['laps'], lap_time, summary['rms_error'], summary['max_error'],
+                                    summary['off_track']))
+
+
+if __name__ == "__main__":
+    main()
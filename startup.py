@@ -0,0 +1,98 @@
+from threading import Thread
+import time
+
+
+class StartupReport:
+    """
+    Times the phases of the start up, from the launch of the program to the first control tick.
+    Each mark() closes the phase that began at the previous mark, or at start for the first one.
+    """
+    def __init__(self, start=None, clock=time.perf_counter):
+        """
+        :param start: clock() time the start up began, e.g. taken before the imports, now if None.
+        """
+        self.clock = clock
+        self.start = clock() if start is None else start
+        self.phases = []  # (name, seconds)
+        self._last = self.start
+
+    def mark(self, name):
+        now = self.clock()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def add(self, name, seconds):
+        """
+        Record a phase timed elsewhere, e.g. one of several devices brought up in parallel, without closing a phase.
+        """
+        self.phases.append((name, seconds))
+
+    @property
+    def total(self):
+        return self._last - self.start
+
+    def format(self):
+        return "Startup: {} | total {:.3f} s".format(
+            " | ".join("{} {:.3f} s".format(name, seconds) for name, seconds in self.phases), self.total)
+
+
+def retry(function, exceptions, timeout=10.0, initial_delay=0.01, max_delay=0.5, clock=time.monotonic,
+          sleep=time.sleep):
+    """
+    Call function until it does not raise one of exceptions, waiting twice as long after every failure.
+    :param exceptions: Exception class or tuple of classes to retry on, anything else is raised immediately.
+    :param timeout: Give up after this many seconds and raise the last exception.
+    :param initial_delay: Seconds to wait after the first failure.
+    :param max_delay: Longest wait between two attempts.
+    :return: The result of function.
+    """
+    deadline = clock() + timeout
+    delay = initial_delay
+    while True:
+        try:
+            return function()
+        except exceptions:
+            remaining = deadline - clock()
+            if remaining <= 0:
+                raise
+            sleep(min(delay, remaining))
+            delay = min(max_delay, delay * 2)
+
+
+def bring_up(tasks, report=None):
+    """
+    Run independent device initializations concurrently, each in its own thread. Bringing up an ev3dev device is
+    mostly waiting for sysfs and the drivers, so the total time is that of the slowest device rather than the sum.
+    :param tasks: List of (name, function) pairs.
+    :param report: Optional StartupReport to add the time of each task to.
+    :return: List of the functions' results in the order of tasks.
+    :raises: The exception of the first failed task, after all tasks finished.
+    """
+    results = [None] * len(tasks)
+    errors = [None] * len(tasks)
+    durations = [0.0] * len(tasks)
+
+    def run(index, function):
+        start = time.perf_counter()
+        try:
+            results[index] = function()
+        except Exception as e:
+            errors[index] = e
+        durations[index] = time.perf_counter() - start
+
+    threads = []
+    for index, (name, function) in enumerate(tasks):
+        thread = Thread(target=run, args=(index, function), name='BringUp-{}'.format(name))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if report is not None:
+        for (name, _), seconds in zip(tasks, durations):
+            report.add(name, seconds)
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
@@ -0,0 +1,734 @@
+#!/usr/bin/env python3
+"""
+Record every sysfs access of a run on the EV3 and replay it deterministically against a fake /sys/class tree.
+
+A recording captures each read and write of a device attribute (bin_data, bin_data_format, the motors' speed_sp,
+command, duty_cycle_sp, ...) with a timestamp, both through ev3dev2 and through the persistent file descriptors of
+the fast paths, plus every button event and tuning server command the control loop received. A replay builds a fake
+tree from the trace (in tmpfs, see fake_sysfs.py), runs the unmodified LineFollower.follow_line on it and serves
+every read the next recorded value, while comparing the writes to the recorded ones. Time is virtual during a
+replay, so it is deterministic and runs as fast as the code allows, which makes it a regression benchmark on real
+sensor data:
+
+    python3 sysfs_trace.py record run.trace --tuning-server               # On the EV3, Ctrl-C to stop
+    python3 sysfs_trace.py replay run.trace --save before.trace           # On any Linux machine
+    python3 sysfs_trace.py replay run.trace --reference before.trace      # After a change, compare the outputs
+
+record takes the options of line_follower.py and runs like it, except that the sensor is read by the control loop
+instead of the acquisition thread. Commands of the tuning server are recorded and applied again at the same frame.
+
+The trace is a text file of JSON lines: a header, then one list per event starting with its kind and time.
+"""
+from ev3dev2 import Device
+from device_backend import EV3DevBackend
+from light_array_sensor import LightArraySensor
+from simulation import SimulatedSound
+from ui_events import ButtonEvent, ButtonEvents
+from tuning_server import CommandError, TuningServer
+from collections import deque
+from threading import Lock
+import argparse
+import json
+import os
+import stat
+import time
+
+TRACE_VERSION = 1
+# Reads of this attribute count the sensor frames, the time base button events are replayed on
+FRAME_ATTRIBUTE = 'bin_data'
+# Modules reading and writing attributes through file descriptors instead of ev3dev2
+FAST_PATH_MODULES = ('light_array_sensor', 'ev3_motor')
+
+
+def encode(data):
+    # Attribute contents are bytes, latin-1 maps each byte to one character and back
+    return bytes(data).decode('latin-1')
+
+
+def decode(text):
+    return text.encode('latin-1')
+
+
+class _TracedFile:
+    """
+    Stands in for the io.FileIO ev3dev2 opens an attribute with and reports every call to the recorder.
+    """
+    def __init__(self, recorder, key, attribute):
+        self._recorder = recorder
+        self._key = key
+        self._file = attribute
+
+    def read(self, size=-1):
+        self._recorder.before_read(self._key)
+        data = self._file.read(size)
+        self._recorder.read(self._key, 'read', data)
+        return data
+
+    def write(self, data):
+        self._recorder.write(self._key, 'write', data)
+        return self._file.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._recorder.count(self._key, 'seek')
+        return self._file.seek(offset, whence)
+
+    def close(self):
+        self._recorder.count(self._key, 'close')
+        self._file.close()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class _TracedOs:
+    """
+    Stands in for the os module in FAST_PATH_MODULES and reports the calls on attribute file descriptors to the
+    recorder. Everything else is passed on to os untouched.
+    """
+    def __init__(self, recorder):
+        self._recorder = recorder
+        self._keys = {}  # Traced file descriptor -> key
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+    def open(self, path, flags, *args, **kwargs):
+        fd = os.open(path, flags, *args, **kwargs)
+        key = self._recorder.key(path)
+        if key is not None:
+            self._keys[fd] = key
+            self._recorder.opened(key)
+        return fd
+
+    def close(self, fd):
+        key = self._keys.pop(fd, None)
+        if key is not None:
+            self._recorder.count(key, 'close')
+        os.close(fd)
+
+    def preadv(self, fd, buffers, offset, *args):
+        key = self._keys.get(fd)
+        if key is None:
+            return os.preadv(fd, buffers, offset, *args)
+        self._recorder.before_read(key)
+        length = os.preadv(fd, buffers, offset, *args)
+        self._recorder.read(key, 'preadv', b''.join(bytes(buffer) for buffer in buffers)[:length])
+        return length
+
+    def readv(self, fd, buffers):
+        key = self._keys.get(fd)
+        if key is None:
+            return os.readv(fd, buffers)
+        self._recorder.before_read(key)
+        length = os.readv(fd, buffers)
+        self._recorder.read(key, 'readv', b''.join(bytes(buffer) for buffer in buffers)[:length])
+        return length
+
+    def lseek(self, fd, position, how):
+        key = self._keys.get(fd)
+        if key is not None:
+            self._recorder.count(key, 'lseek')
+        return os.lseek(fd, position, how)
+
+    def pwrite(self, fd, data, offset):
+        key = self._keys.get(fd)
+        if key is not None:
+            self._recorder.write(key, 'pwrite', data)
+        return os.pwrite(fd, data, offset)
+
+
+class SysfsRecorder:
+    """
+    Records the attribute accesses of all ev3dev2 devices and the fast paths, and the button events and tuning server
+    commands the control loop applies, while installed.
+
+    The first time an attribute of a device is opened, all readable attributes of the device are snapshotted, so a
+    replay can rebuild the device for ev3dev2 to find. Every call on an attribute is counted per attribute and
+    operation. Events are written as they happen, a lock keeps the acquisition thread's reads and the control loop's
+    writes apart.
+    """
+    def __init__(self, path=None, clock=time.monotonic):
+        """
+        :param path: Trace file to write, only count the calls if None.
+        """
+        self.path = path
+        self.clock = clock
+        self.frames = 0  # Reads of FRAME_ATTRIBUTE so far
+        self.calls = {}  # (key, operation) -> count
+        self._devices = set()  # Device directories already snapshotted
+        self._lock = Lock()
+        self._file = None
+        self._start = None
+        self._root = None
+        self._patched = None
+
+    def install(self):
+        """
+        Start recording, before the devices are created.
+        """
+        if self._patched is not None:
+            return
+        import importlib
+
+        self._root = os.path.abspath(Device.DEVICE_ROOT_PATH)
+        self._start = self.clock()
+        if self.path is not None:
+            self._file = open(self.path, 'w')
+            self._file.write(json.dumps({'version': TRACE_VERSION, 'root': self._root}) + "\n")
+
+        recorder = self
+        attribute_file_open = Device._attribute_file_open
+        poll = ButtonEvents.poll
+        process = TuningServer.process
+
+        def traced_attribute_file_open(device, name):
+            attribute = attribute_file_open(device, name)
+            key = recorder.key(os.path.join(device._path, name))
+            recorder.opened(key)
+            return _TracedFile(recorder, key, attribute)
+
+        def traced_poll(events):
+            event = poll(events)
+            if event is not None:
+                recorder.button(event)
+            return event
+
+        def traced_process(server, handler):
+            def traced_handler(command):
+                recorder.command(command)
+                return handler(command)
+            return process(server, traced_handler)
+
+        Device._attribute_file_open = traced_attribute_file_open
+        ButtonEvents.poll = traced_poll
+        TuningServer.process = traced_process
+        modules = [importlib.import_module(name) for name in FAST_PATH_MODULES]
+        traced_os = _TracedOs(self)
+        for module in modules:
+            module.os = traced_os
+        self._patched = (attribute_file_open, poll, process, modules)
+
+    def uninstall(self):
+        if self._patched is None:
+            return
+        attribute_file_open, poll, process, modules = self._patched
+        Device._attribute_file_open = attribute_file_open
+        ButtonEvents.poll = poll
+        TuningServer.process = process
+        for module in modules:
+            module.os = os
+        self._patched = None
+
+    def close(self):
+        self.uninstall()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def key(self, path):
+        """
+        :return: The path relative to the device root (e.g. 'lego-sensor/sensor0/bin_data'), None if outside of it.
+        """
+        path = os.path.abspath(path)
+        if not path.startswith(self._root + os.sep):
+            return None
+        return path[len(self._root) + 1:]
+
+    def _emit(self, event):
+        # Called with the lock held
+        if self._file is not None:
+            self._file.write(json.dumps(event) + "\n")
+
+    def _count(self, key, operation):
+        # Called with the lock held
+        self.calls[key, operation] = self.calls.get((key, operation), 0) + 1
+
+    def count(self, key, operation):
+        with self._lock:
+            self._count(key, operation)
+
+    def opened(self, key):
+        device = os.path.dirname(key)
+        with self._lock:
+            self._count(key, 'open')
+            if device in self._devices:
+                return
+            self._devices.add(device)
+            self._emit(['device', self.clock() - self._start, device, self._snapshot(device)])
+
+    def _snapshot(self, device):
+        """
+        :return: Dict of attribute name -> [permission bits, contents] of the device's readable attributes.
+        """
+        path = os.path.join(self._root, device)
+        attributes = {}
+        for name in sorted(os.listdir(path)):
+            attribute = os.path.join(path, name)
+            if not os.path.isfile(attribute) or os.path.islink(attribute):
+                continue
+            mode = stat.S_IMODE(os.stat(attribute).st_mode)
+            try:
+                with open(attribute, 'rb') as f:
+                    contents = f.read()
+            except OSError:
+                contents = b''  # Write-only or not readable in the current mode
+            attributes[name] = [mode, encode(contents)]
+        return attributes
+
+    def before_read(self, key):
+        pass
+
+    def read(self, key, operation, data):
+        with self._lock:
+            self._count(key, operation)
+            if key.endswith('/' + FRAME_ATTRIBUTE):
+                self.frames += 1
+            self._emit(['r', self.clock() - self._start, key, encode(data)])
+
+    def write(self, key, operation, data):
+        if isinstance(data, str):
+            data = data.encode()
+        with self._lock:
+            self._count(key, operation)
+            self._emit(['w', self.clock() - self._start, key, encode(data), self.frames])
+
+    def button(self, event):
+        with self._lock:
+            self._emit(['button', self.clock() - self._start, event.name, event.pressed, self.frames])
+
+    def command(self, command):
+        with self._lock:
+            self._emit(['command', self.clock() - self._start, command, self.frames])
+
+    def note(self, metadata):
+        """
+        Store the configuration of the run, e.g. the gains, for the replay.
+        """
+        with self._lock:
+            self._emit(['meta', self.clock() - self._start, metadata])
+
+    def format_calls(self, ticks, limit=12):
+        """
+        :param ticks: Control loop ticks to divide the counts by.
+        :return: The most frequent calls per tick, one line each.
+        """
+        ticks = max(1, ticks)
+        total = sum(self.calls.values())
+        lines = ["Attribute calls: {:.2f} per tick".format(total / float(ticks))]
+        for (key, operation), count in sorted(self.calls.items(), key=lambda item: -item[1])[:limit]:
+            lines.append("  {:<40} {:<7} {:8.2f} per tick".format(key, operation, count / float(ticks)))
+        return "\n".join(lines)
+
+
+def load_trace(path):
+    """
+    :return: Dict with the header, the device snapshots, the reads and writes in order, the button events, the tuning
+             server commands and the metadata of the run.
+    """
+    trace = {'devices': {}, 'reads': [], 'writes': [], 'buttons': [], 'commands': [], 'metadata': {}}
+    with open(path) as f:
+        trace['header'] = json.loads(f.readline())
+        if trace['header'].get('version') != TRACE_VERSION:
+            raise ValueError("{} is not a version {} sysfs trace".format(path, TRACE_VERSION))
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            kind = event[0]
+            if kind == 'r':
+                trace['reads'].append((event[1], event[2], decode(event[3])))
+            elif kind == 'w':
+                trace['writes'].append((event[1], event[2], decode(event[3]), event[4]))
+            elif kind == 'button':
+                trace['buttons'].append((event[1], event[2], event[3], event[4]))
+            elif kind == 'command':
+                trace['commands'].append((event[1], event[2], event[3]))
+            elif kind == 'device':
+                trace['devices'][event[2]] = dict((name, (mode, decode(contents)))
+                                                  for name, (mode, contents) in event[3].items())
+            elif kind == 'meta':
+                trace['metadata'].update(event[2])
+    return trace
+
+
+class SysfsReplay(SysfsRecorder):
+    """
+    Replays a trace: builds a fake sysfs tree of the recorded devices and, while installed, puts the next recorded
+    value of an attribute into its file right before the code under test reads it. Attributes that run out of
+    recorded values keep their last one. The virtual clock is advanced by the sleeps of the control loop and moved
+    forward to the recorded time of every read served. The writes of the code under test are kept for
+    compare_writes() and, like everything else, recorded to path if given, so the replay itself can be replayed or
+    compared against.
+    """
+    def __init__(self, trace, path=None, root=None):
+        """
+        :param trace: Trace file to replay, or a trace loaded by load_trace().
+        :param path: Trace file to record the replay to, not recorded if None.
+        :param root: Directory to build the fake tree in, a new temporary one (in tmpfs if available) if None.
+        """
+        from fake_sysfs import FakeSysfs
+
+        SysfsRecorder.__init__(self, path, clock=self._virtual_clock)
+        self.trace = trace if isinstance(trace, dict) else load_trace(trace)
+        self.metadata = self.trace['metadata']
+        self.time = 0.0  # Virtual time since the start of the recording, see before_read()
+        self.writes = []  # (key, value, frames) written by the code under test
+        self.unrecorded = set()  # Attributes read that have no recorded value
+        self.total_frames = sum(1 for _, key, _ in self.trace['reads'] if key.endswith('/' + FRAME_ATTRIBUTE))
+
+        self._values = {}  # Key -> deque of (recorded time, value) of the reads
+        for timestamp, key, value in self.trace['reads']:
+            self._values.setdefault(key, deque()).append((timestamp, value))
+        self._current = {}  # Key -> contents of its file
+        self._fds = {}  # Key -> file descriptor the replay writes the values through
+
+        self.sysfs = FakeSysfs(root)
+        for device, attributes in sorted(self.trace['devices'].items()):
+            class_name, name = device.split('/', 1)
+            writable = [attribute for attribute, (mode, _) in attributes.items() if mode & stat.S_IWGRP]
+            self.sysfs.add_device(class_name, name, dict((attribute, contents) for attribute, (_, contents)
+                                                         in attributes.items()), writable)
+            for attribute, (_, contents) in attributes.items():
+                key = device + '/' + attribute
+                self._fds[key] = os.open(os.path.join(self.sysfs.root, key), os.O_RDWR)
+                self._current[key] = contents
+
+    def _virtual_clock(self):
+        return self.time
+
+    def install(self):
+        self.sysfs.install()
+        SysfsRecorder.install(self)
+
+    def close(self):
+        SysfsRecorder.close(self)
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+        self.sysfs.cleanup()
+
+    @property
+    def finished(self):
+        """
+        True once all recorded sensor frames were read.
+        """
+        return self.frames >= self.total_frames
+
+    def before_read(self, key):
+        values = self._values.get(key)
+        if not values:
+            if key not in self._current:
+                self.unrecorded.add(key)
+            return
+        timestamp, value = values.popleft() if len(values) > 1 else values[0]
+        # The clock follows the recorded reads, so timing dependent decisions (e.g. the line recovery) repeat too
+        if timestamp > self.time:
+            self.time = timestamp
+        if value != self._current.get(key):
+            fd = self._fds[key]
+            os.pwrite(fd, value, 0)
+            os.ftruncate(fd, len(value))
+            self._current[key] = value
+
+    def write(self, key, operation, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.writes.append((key, bytes(data), self.frames))
+        SysfsRecorder.write(self, key, operation, data)
+        # The code wrote the file, the next read has to restore the recorded value even if it is the same as before
+        self._current.pop(key, None)
+
+
+class ReplayButtons(ButtonEvents):
+    """
+    Delivers the recorded button events at the sensor frame they were received on.
+    """
+    def __init__(self, replay):
+        ButtonEvents.__init__(self, debounce=0.0, clock=replay.clock)
+        self.replay = replay
+        self._events = deque((frames, name, pressed) for _, name, pressed, frames in replay.trace['buttons'])
+
+    def poll(self):
+        if self._events and self._events[0][0] <= self.replay.frames:
+            frames, name, pressed = self._events.popleft()
+            event = ButtonEvent(name, pressed, self.clock())
+            self.replay.button(event)
+            return event
+        return None
+
+
+class ReplayCommands:
+    """
+    Stands in for the tuning server of the recorded run and applies the recorded commands at the sensor frame they
+    were applied on.
+    """
+    def __init__(self, replay):
+        self.replay = replay
+        self._commands = deque((frames, command) for _, command, frames in replay.trace['commands'])
+        self.commands_applied = 0
+
+    def process(self, handler):
+        count = 0
+        while self._commands and self._commands[0][0] <= self.replay.frames:
+            frames, command = self._commands.popleft()
+            self.replay.command(command)
+            try:
+                handler(command)
+            except CommandError:
+                pass  # Rejected in the recorded run as well
+            count += 1
+        self.commands_applied += count
+        return count
+
+    def telemetry_due(self):
+        return False
+
+    def stop(self):
+        pass
+
+
+def compare_writes(expected, actual):
+    """
+    Compare the writes of two runs attribute by attribute, in the order they were written.
+    :param expected: List of (key, value, frames), e.g. the recorded writes.
+    :param actual: List of (key, value, frames), e.g. SysfsReplay.writes.
+    :return: Dict of key -> dict with the number of expected and actual writes, how many of them differ, the first
+             difference as (index, frames, expected value, actual value) or None, and the largest difference of
+             numeric values.
+    """
+    def by_key(writes):
+        result = {}
+        for key, value, frames in writes:
+            result.setdefault(key, []).append((value, frames))
+        return result
+
+    expected, actual = by_key(expected), by_key(actual)
+    differences = {}
+    for key in sorted(set(expected) | set(actual)):
+        left, right = expected.get(key, []), actual.get(key, [])
+        different = abs(len(left) - len(right))
+        first = None
+        largest = 0.0
+        for index, ((left_value, frames), (right_value, _)) in enumerate(zip(left, right)):
+            if left_value == right_value:
+                continue
+            different += 1
+            if first is None:
+                first = (index, frames, left_value, right_value)
+            try:
+                largest = max(largest, abs(float(left_value) - float(right_value)))
+            except ValueError:
+                pass
+        if first is None and len(left) != len(right):
+            index = min(len(left), len(right))
+            longer = left if len(left) > len(right) else right
+            first = (index, longer[index][1], left[index][0] if index < len(left) else None,
+                     right[index][0] if index < len(right) else None)
+        differences[key] = {'expected': len(left), 'actual': len(right), 'different': different, 'first': first,
+                            'largest': largest}
+    return differences
+
+
+def format_differences(differences):
+    lines = []
+    diverged = dict((key, value) for key, value in differences.items() if value['different'])
+    lines.append("Output divergence: {} of {} written attributes differ".format(len(diverged), len(differences)))
+    for key, difference in sorted(diverged.items(), key=lambda item: item[1]['first'][1]):
+        index, frames, expected, actual = difference['first']
+        lines.append("  {:<40} {} of {}/{} writes differ, first at write {} (frame {}): {!r} -> {!r}{}".format(
+            key, difference['different'], difference['expected'], difference['actual'], index, frames, expected,
+            actual, " | largest difference {:g}".format(difference['largest']) if difference['largest'] else ""))
+    return "\n".join(lines)
+
+
+def configuration(follower):
+    """
+    :return: The parts of a LineFollower's configuration a replay needs to decide the same.
+    """
+    backend = follower.backend
+    calibration = follower.sensor.calibration
+    track_map = follower.track_map
+    return {
+        'parameters': follower.parameters(),
+        'calibration': calibration.to_dict() if calibration is not None else None,
+        'calibration_name': calibration.name if calibration is not None else None,
+        'loop_period': follower.loop_period,
+        'fast_read': follower.sensor._fast_fd is not None,
+        'sensor_port': getattr(backend, 'sensor_port', 'in1'),
+        'sensor_flipped': getattr(backend, 'sensor_flipped', False),
+        'direct_drive': getattr(backend, 'direct_drive', False),
+        'feed_forward_points': getattr(backend, 'feed_forward_points', None),
+        # The options of the track map and, if one was loaded, its curvatures, a map learned on the run is learned again
+        'track_map': None if track_map is None else {
+            'options': follower.track_map_options,
+            'bucket_length': track_map.bucket_length,
+            'curvatures': list(track_map.curvatures) if track_map.ready else None,
+        },
+    }
+
+
+def configure(follower, metadata, gains=None):
+    """
+    Apply the recorded configuration to a LineFollower created on a ReplayBackend.
+    :param gains: Dict of kp, ki, kd and base_speed to use instead of the recorded ones.
+    """
+    from calibration import CalibrationProfile
+
+    parameters = metadata.get('parameters', {})
+    follower.apply_gains(parameters)
+    if 'setpoint' in parameters:
+        follower.pid.setpoint = follower.recovery.setpoint = parameters['setpoint']
+    follower.apply_gains(gains or {})
+    follower.running = parameters.get('running', False)
+    if metadata.get('calibration') is not None:
+        follower.sensor.calibration = CalibrationProfile.from_dict(metadata['calibration_name'],
+                                                                   metadata['calibration'])
+    follower.loop_period = follower.scheduler.period = metadata.get('loop_period', follower.loop_period)
+    if metadata.get('fast_read'):
+        follower.sensor.enable_fast_read()
+    track_map = metadata.get('track_map')
+    if track_map is not None:
+        follower.enable_track_map(path=None, **track_map['options'])
+        if track_map['curvatures'] is not None:
+            follower.track_map.follow(track_map['curvatures'], track_map['bucket_length'])
+    # A replay must not overwrite the saved calibration profiles or the profile of the robot
+    follower.calibration_path = None
+    follower.profile_path = None
+
+
+class ReplayBackend(EV3DevBackend):
+    """
+    EV3DevBackend on the fake tree of a SysfsReplay, with the replay's virtual clock and the recorded buttons.
+    """
+    timer = staticmethod(time.perf_counter)
+
+    def __init__(self, replay):
+        metadata = replay.metadata
+        EV3DevBackend.__init__(self, sensor_port=metadata.get('sensor_port', 'in1'),
+                               sensor_flipped=metadata.get('sensor_flipped', False),
+                               direct_drive=metadata.get('direct_drive', False),
+                               feed_forward_points=metadata.get('feed_forward_points'))
+        self.replay = replay
+        self._sound = SimulatedSound()
+
+    def clock(self):
+        return self.replay.time
+
+    def sleep(self, seconds):
+        self.replay.time += seconds
+
+    def create_sensor(self):
+        return LightArraySensor(port=self.sensor_port, flipped=self.sensor_flipped, create_sound=self.create_sound,
+                                clock=self.clock)
+
+    def create_button_events(self):
+        return ReplayButtons(self.replay)
+
+    def create_display(self):
+        return None
+
+
+def record(path, args, duration=None):
+    """
+    Run the line follower on the EV3 like line_follower.main() and record it to path. The only difference is that
+    the acquisition thread is left out, so every tick reads the sensor itself and a replay reads the same frames.
+    :param args: Options of line_follower.main(), see line_follower.add_arguments().
+    """
+    from line_follower import LineFollower, set_up
+
+    recorder = SysfsRecorder(path)
+    recorder.install()
+    try:
+        follower = LineFollower()
+        set_up(follower, args, acquisition=False)
+        recorder.note(configuration(follower))
+        print("Recording sysfs trace to {}".format(path))
+        follower.follow_line(duration)
+    finally:
+        recorder.close()
+    print(recorder.format_calls(follower.scheduler.ticks))
+
+
+def replay(trace, path=None, gains=None, max_ticks=None):
+    """
+    Replay a trace with the current code.
+    :param trace: Trace file or a trace loaded by load_trace().
+    :param path: Trace file to record the replay to.
+    :param gains: Dict of gains to use instead of the recorded ones.
+    :param max_ticks: Stop after this many ticks, twice the recorded frames if None.
+    :return: (SysfsReplay, LineFollower, elapsed wall time in seconds).
+    """
+    import contextlib
+    import io
+    from line_follower import LineFollower
+
+    sysfs_replay = SysfsReplay(trace, path)
+    if max_ticks is None:
+        max_ticks = 2 * sysfs_replay.total_frames + 100
+    sysfs_replay.install()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            follower = LineFollower(backend=ReplayBackend(sysfs_replay))
+            follower.debug_mode = False
+            configure(follower, sysfs_replay.metadata, gains)
+            if sysfs_replay.trace['commands']:
+                follower.server = ReplayCommands(sysfs_replay)
+            sysfs_replay.note(configuration(follower))
+            start = time.perf_counter()
+            follower.follow_line(stop_condition=lambda: sysfs_replay.finished or
+                                 follower.scheduler.ticks >= max_ticks)
+            elapsed = time.perf_counter() - start
+    finally:
+        sysfs_replay.close()
+    return sysfs_replay, follower, elapsed
+
+
+def main():
+    from line_follower import add_arguments
+
+    parser = argparse.ArgumentParser(description="Record and replay the sysfs accesses of a line follower run.")
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record', help="Follow the line on the EV3 and record a trace")
+    record_parser.add_argument('trace')
+    record_parser.add_argument('--duration', type=float, default=None, help="Stop after this many seconds")
+    add_arguments(record_parser)
+    replay_parser = subparsers.add_parser('replay', help="Replay a trace against a fake sysfs tree")
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--save', default=None, help="Record the replay to this trace file")
+    replay_parser.add_argument('--reference', default=None,
+                               help="Compare the outputs to this trace instead of the replayed one")
+    replay_parser.add_argument('--repeat', type=int, default=1, help="Replay this many times for the throughput")
+    for name in ('kp', 'ki', 'kd', 'base_speed'):
+        replay_parser.add_argument('--' + name.replace('_', '-'), type=float, default=None,
+                                   help="Use this instead of the recorded value")
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.trace, args, args.duration)
+        return
+    if args.command != 'replay':
+        parser.print_help()
+        return
+
+    trace = load_trace(args.trace)
+    gains = dict((name, getattr(args, name)) for name in ('kp', 'ki', 'kd', 'base_speed')
+                 if getattr(args, name) is not None)
+    rates = []
+    for repetition in range(args.repeat):
+        sysfs_replay, follower, elapsed = replay(trace, args.save if repetition == 0 else None, gains)
+        rates.append(follower.scheduler.ticks / elapsed)
+    ticks = follower.scheduler.ticks
+    print("Replayed {} of {} frames in {} ticks | {:.0f} ticks/s (best of {}) | {:.1f} s of recorded run".format(
+        sysfs_replay.frames, sysfs_replay.total_frames, ticks, max(rates), args.repeat,
+        trace['reads'][-1][0] if trace['reads'] else 0.0))
+    print(sysfs_replay.format_calls(ticks))
+    if sysfs_replay.unrecorded:
+        print("Read without recorded values: {}".format(", ".join(sorted(sysfs_replay.unrecorded))))
+
+    reference = load_trace(args.reference) if args.reference is not None else trace
+    expected = [(key, value, frames) for _, key, value, frames in reference['writes']]
+    print(format_differences(compare_writes(expected, sysfs_replay.writes)))
+
+
+if __name__ == "__main__":
+    main()
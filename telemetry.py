@@ -0,0 +1,132 @@
+from threading import Event, Thread
+import struct
+import time
+
+# File header: magic, format version, record size
+HEADER = struct.Struct('<4sHH')
+MAGIC = b'LFTL'
+VERSION = 1
+
+# One record per control tick: timestamp, 8 sensor values, line position (NaN if none), PID P/I/D terms, PID output,
+# left and right motor commands, scaling factor, flags and padding to keep the records 4-byte aligned.
+RECORD = struct.Struct('<d8h8fB3x')
+
+FLAG_RUNNING = 1
+FLAG_VALID = 2  # The sensor read returned valid data
+FLAG_LINE = 4  # A line was detected
+
+NO_VALUES = (0,) * 8
+NAN = float('nan')
+
+
+class TelemetryRecorder:
+    """
+    Appends fixed-size binary records to a preallocated ring buffer and flushes them to a file in batches from a
+    background thread. record() only packs into the buffer, so it is cheap enough to leave on in competition runs.
+    If the flush thread falls a whole buffer behind, the oldest records are dropped and counted.
+    """
+    def __init__(self, path, capacity=4096, flush_interval=0.5):
+        """
+        :param path: File to write, a header is written first, then the records.
+        :param capacity: Number of records the ring buffer holds.
+        :param flush_interval: Seconds between flushes.
+        """
+        self.path = path
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+
+        self._buffer = bytearray(capacity * RECORD.size)
+        self._view = memoryview(self._buffer)
+        self._written = 0  # Total records recorded, only advanced by record()
+        self._flushed = 0  # Total records written to the file or dropped
+        self.dropped = 0
+
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self._stop_event = Event()
+        self._thread = Thread(target=self._run, name='TelemetryRecorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, timestamp, values, position, proportional, integral, derivative, output, left_speed, right_speed,
+               scaling_factor, flags):
+        """
+        :param values: The 8 sensor values, or None if the read was invalid.
+        :param position: The line position, or None if no line was detected.
+        """
+        written = self._written
+        RECORD.pack_into(self._buffer, (written % self.capacity) * RECORD.size, timestamp,
+                         *(values if values is not None else NO_VALUES),
+                         position if position is not None else NAN,
+                         proportional, integral, derivative, output, left_speed, right_speed, scaling_factor, flags)
+        self._written = written + 1
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        written = self._written
+        start = self._flushed
+        if written - start > self.capacity:
+            self.dropped += written - start - self.capacity
+            start = written - self.capacity
+        if start == written:
+            return
+
+        first = start % self.capacity
+        last = written % self.capacity
+        size = RECORD.size
+        if first < last:
+            chunks = [bytes(self._view[first * size:last * size])]
+        else:
+            chunks = [bytes(self._view[first * size:]), bytes(self._view[:last * size])]
+
+        # Records overwritten while copying are torn, drop them
+        overrun = min(self._written + 1 - self.capacity - start, written - start)
+        if overrun > 0:
+            data = b''.join(chunks)[overrun * size:]
+            self.dropped += overrun
+        else:
+            data = b''.join(chunks)
+
+        self._file.write(data)
+        self._file.flush()
+        self._flushed = written
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+
+    @property
+    def records(self):
+        return self._written
+
+
+class RateLimitedLog:
+    """
+    Prints a message at most once per interval for each key and reports how many repeats were suppressed,
+    so per-tick conditions do not block the loop on the terminal.
+    """
+    def __init__(self, interval=1.0, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self._last = {}
+        self._suppressed = {}
+
+    def log(self, key, message):
+        now = self.clock()
+        last = self._last.get(key)
+        if last is not None and now - last < self.interval:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return
+        suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            message = "{} ({} similar messages suppressed)".format(message, suppressed)
+        self._last[key] = now
+        print(message)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Offline analysis of telemetry recorded by telemetry.TelemetryRecorder. Requires NumPy.
+
+Files are memory-mapped as NumPy structured arrays without copying, all statistics are vectorized, and the line
+position estimate and the PID controller can be replayed over the recorded raw sensor frames with different noise
+thresholds or gains to see what they would have commanded. The line state estimator can be replayed the same way to
+see how well it predicts the recorded positions and how much it calms the derivative term.
+
+Example:
+    python3 telemetry_analysis.py telemetry/*.lft --kp 8 --kd 10
+"""
+from line_position_estimator import LinePositionEstimator
+from line_state_estimator import LineStateEstimator
+from recovery import MODES
+from telemetry import HEADER, MAGIC, RECORD, FLAG_RUNNING, FLAG_VALID, FLAG_LINE
+import argparse
+import os
+import numpy as np
+
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('values', '<i2', (8,)),
+    ('position', '<f4'),
+    ('proportional', '<f4'),
+    ('integral', '<f4'),
+    ('derivative', '<f4'),
+    ('output', '<f4'),
+    ('left_speed', '<f4'),
+    ('right_speed', '<f4'),
+    ('scaling_factor', '<f4'),
+    ('flags', 'u1'),
+    ('padding', 'V3'),
+])
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+
+def load(path):
+    """
+    Memory-map a telemetry file. A partially written last record is ignored.
+    :return: Read-only structured array with RECORD_DTYPE.
+    """
+    with open(path, 'rb') as f:
+        magic, version, record_size = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("{} is not a telemetry file".format(path))
+    if record_size != RECORD_DTYPE.itemsize:
+        raise ValueError("Unsupported record size {} (version {})".format(record_size, version))
+
+    count = (os.path.getsize(path) - HEADER.size) // record_size
+    if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER.size, shape=(count,))
+
+
+def controlled(records):
+    """
+    :return: Mask of the ticks on which the PID ran (running, valid data and a line detected).
+    """
+    required = FLAG_RUNNING | FLAG_VALID | FLAG_LINE
+    return (records['flags'] & required) == required
+
+
+def loop_rate_histogram(records, bins=50):
+    """
+    :return: (counts, bin_edges) of the instantaneous loop rate in Hz.
+    """
+    intervals = np.diff(records['timestamp'])
+    intervals = intervals[intervals > 0]
+    return np.histogram(1.0 / intervals, bins=bins)
+
+
+def error_spectrum(records, setpoint=4.5):
+    """
+    Amplitude spectrum of the position error over the controlled ticks, assuming the mean loop period.
+    :return: (frequencies in Hz, amplitudes).
+    """
+    mask = controlled(records)
+    error = setpoint - records['position'][mask].astype(np.float64)
+    if len(error) < 2:
+        return np.zeros(0), np.zeros(0)
+    period = np.mean(np.diff(records['timestamp'][mask]))
+    amplitudes = np.abs(np.fft.rfft(error - error.mean())) / len(error)
+    return np.fft.rfftfreq(len(error), period), amplitudes
+
+
+def oscillation_frequency(records, setpoint=4.5):
+    """
+    :return: Frequency (Hz) of the strongest non-DC component of the position error, or None.
+    """
+    frequencies, amplitudes = error_spectrum(records, setpoint)
+    if len(amplitudes) < 2:
+        return None
+    return float(frequencies[1 + np.argmax(amplitudes[1:])])
+
+
+def _segments(mask):
+    """
+    :return: Arrays of start and end (exclusive) indices of the runs of True in mask.
+    """
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def corner_overshoot(records, setpoint=4.5, threshold=1.5, settle_time=0.5):
+    """
+    Treat every stretch where the error exceeds threshold as a corner and measure how far the error swings to the
+    other side within settle_time seconds after it.
+    :return: List of dicts with start time, duration, peak error and overshoot per corner.
+    """
+    mask = controlled(records)
+    error = setpoint - records['position'][mask].astype(np.float64)
+    timestamps = records['timestamp'][mask]
+
+    corners = []
+    starts, ends = _segments(np.abs(error) > threshold)
+    for start, end in zip(starts, ends):
+        peak_index = start + np.argmax(np.abs(error[start:end]))
+        sign = np.sign(error[peak_index])
+        window_end = np.searchsorted(timestamps, timestamps[end - 1] + settle_time)
+        after = error[end:window_end]
+        overshoot = float(max(0.0, np.max(-sign * after))) if len(after) else 0.0
+        corners.append({
+            'time': float(timestamps[start]),
+            'duration': float(timestamps[end - 1] - timestamps[start]),
+            'peak_error': float(error[peak_index]),
+            'overshoot': overshoot,
+        })
+    return corners
+
+
+def recovery_time(records):
+    """
+    :return: Dict with the number of line losses while running, the total and the longest time spent recovering.
+    """
+    running = (records['flags'] & FLAG_RUNNING) != 0
+    lost = running & ((records['flags'] & FLAG_VALID) != 0) & ((records['flags'] & FLAG_LINE) == 0)
+    starts, ends = _segments(lost)
+    timestamps = records['timestamp']
+    # A loss lasts until the next tick after it
+    stop_times = timestamps[np.minimum(ends, len(timestamps) - 1)]
+    durations = stop_times - timestamps[starts]
+    return {
+        'losses': len(starts),
+        'total': float(durations.sum()) if len(durations) else 0.0,
+        'longest': float(durations.max()) if len(durations) else 0.0,
+    }
+
+
+def replay_positions(records, max_value=100, noise_ratio=0.1, edge_weight=2):
+    """
+    Re-run the line position estimate over the recorded raw frames, e.g. with a different noise threshold.
+    :return: Float array of positions, NaN where no line would have been detected.
+    """
+    estimator = LinePositionEstimator(max_value=max_value, noise_ratio=noise_ratio, edge_weight=edge_weight)
+    return estimator.estimate_batch(records['values'])
+
+
+def replay_line_state(records, latency=0.0, positions=None, **options):
+    """
+    Run a LineStateEstimator over the recorded line positions, as the follower would have on these ticks.
+    :param latency: Read to actuate latency passed to every update, the recorded runs do not store it.
+    :param positions: Line positions per tick to use instead of the recorded ones, NaN where no line was detected.
+    :param options: Keyword arguments of LineStateEstimator.
+    :return: (estimator, float array of predicted positions, NaN where the line would have counted as lost).
+    """
+    estimator = LineStateEstimator(**options)
+    active = FLAG_RUNNING | FLAG_VALID
+    predictions = np.full(len(records), np.nan)
+    if positions is None:
+        positions = np.where(records['flags'] & FLAG_LINE, records['position'], np.nan)
+    for index, (timestamp, position, flags) in enumerate(zip(records['timestamp'].tolist(),
+                                                            np.asarray(positions, dtype=np.float64).tolist(),
+                                                            records['flags'].tolist())):
+        if flags & active != active:
+            continue
+        prediction = estimator.update(timestamp, None if position != position else position, latency)
+        if prediction is not None:
+            predictions[index] = prediction
+    return estimator, predictions
+
+
+def line_state_errors(records, predictions, horizon):
+    """
+    Compare the predictions to the positions recorded horizon seconds later, and to simply holding the current position.
+    :param horizon: Seconds the predictions look ahead, latency plus lead of the estimator.
+    :return: Dict with the RMS prediction error of the estimator and of the raw position, and the RMS tick to tick
+             change of both, which is what the derivative term amplifies.
+    """
+    mask = controlled(records)
+    timestamps = records['timestamp'][mask]
+    positions = records['position'][mask].astype(np.float64)
+    predictions = predictions[mask]
+    if len(timestamps) < 3:
+        return {}
+    future = np.interp(timestamps + horizon, timestamps, positions)
+    # The last ticks have no recorded future to compare with
+    valid = (timestamps + horizon <= timestamps[-1]) & ~np.isnan(predictions)
+    return {
+        'prediction_rms': float(np.sqrt(np.mean((predictions[valid] - future[valid]) ** 2))),
+        'hold_rms': float(np.sqrt(np.mean((positions[valid] - future[valid]) ** 2))),
+        'estimated_change_rms': float(np.sqrt(np.nanmean(np.diff(predictions) ** 2))),
+        'raw_change_rms': float(np.sqrt(np.mean(np.diff(positions) ** 2))),
+    }
+
+
+def replay_pid(positions, kp, ki, kd, setpoint=4.5, output_limits=(-100, 100), active=None, reset_on_reacquire=True):
+    """
+    Vectorized replay of the default (per-call) PIDController mode. Like on the robot, the controller only advances
+    on ticks with a detected line, and when the line is found again after a loss it is reset the way LineRecovery.end()
+    does: the integral restarts and the first derivative after the gap is zero.
+    :param positions: Line positions per tick, NaN where no line was detected.
+    :param active: Mask of the ticks the controller saw (running with valid data), all ticks if None. Other ticks
+                   neither advance the controller nor count as a loss.
+    :param reset_on_reacquire: False to keep the state across losses, as the 'pivot' recovery mode does.
+    :return: Float array of outputs, NaN where the controller would not have run.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    line = ~np.isnan(positions)
+    if active is None:
+        active = np.ones(len(positions), dtype=bool)
+    mask = line & active
+    error = setpoint - positions[mask]
+
+    integral = np.cumsum(error)
+    derivative = np.diff(error, prepend=0.0)
+    if reset_on_reacquire and len(error):
+        # A loss only starts once the line was seen, and ends on the next active tick with a line
+        seen = line[active]
+        lost = ~seen & (np.cumsum(seen) > 0)
+        reacquired = (seen & np.concatenate(([False], lost[:-1])))[seen]
+        starts = np.flatnonzero(reacquired)
+        segment = np.cumsum(reacquired)
+        offsets = np.concatenate(([0.0], integral[starts] - error[starts]))
+        integral = integral - offsets[segment]
+        derivative[starts] = 0.0
+    output = kp * error + ki * integral + kd * derivative
+
+    min_output, max_output = output_limits
+    if min_output is not None:
+        output = np.maximum(min_output, output)
+    if max_output is not None:
+        output = np.minimum(max_output, output)
+
+    outputs = np.full(len(positions), np.nan)
+    outputs[mask] = output
+    return outputs
+
+
+def summarize(records, setpoint=4.5):
+    if len(records) < 2:
+        return {'records': len(records)}
+    intervals = np.diff(records['timestamp'])
+    corners = corner_overshoot(records, setpoint)
+    mask = controlled(records)
+    error = setpoint - records['position'][mask].astype(np.float64)
+    return {
+        'records': len(records),
+        'duration': float(records['timestamp'][-1] - records['timestamp'][0]),
+        'loop_rate': float(1.0 / np.mean(intervals)) if np.mean(intervals) > 0 else 0.0,
+        'loop_rate_p01': float(1.0 / np.percentile(intervals, 99)) if np.percentile(intervals, 99) > 0 else 0.0,
+        'rms_error': float(np.sqrt(np.mean(error ** 2))) if len(error) else 0.0,
+        'oscillation_frequency': oscillation_frequency(records, setpoint),
+        'corners': len(corners),
+        'mean_overshoot': float(np.mean([corner['overshoot'] for corner in corners])) if corners else 0.0,
+        'recovery': recovery_time(records),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze line follower telemetry files.")
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--setpoint', type=float, default=4.5)
+    parser.add_argument('--noise-ratio', type=float, default=None, help="Replay the position estimate with this threshold")
+    parser.add_argument('--kp', type=float, default=None, help="Replay the PID with these gains")
+    parser.add_argument('--ki', type=float, default=0.0)
+    parser.add_argument('--kd', type=float, default=0.0)
+    parser.add_argument('--recovery-mode', choices=MODES, default='arc',
+                        help="Recovery mode of the run, 'pivot' keeps the PID state across line losses")
+    parser.add_argument('--estimator', action='store_true', help="Replay the line state estimator")
+    parser.add_argument('--latency', type=float, default=0.01, help="Read to actuate latency for the estimator replay")
+    parser.add_argument('--lead', type=float, default=0.05)
+    parser.add_argument('--alpha', type=float, default=0.5)
+    parser.add_argument('--beta', type=float, default=0.05)
+    args = parser.parse_args()
+
+    for path in args.paths:
+        records = load(path)
+        summary = summarize(records, args.setpoint)
+        print(path)
+        for key in sorted(summary):
+            print("  {:<22} {}".format(key, summary[key]))
+
+        if args.estimator:
+            estimator, predictions = replay_line_state(records, args.latency, alpha=args.alpha, beta=args.beta,
+                                                       lead=args.lead)
+            errors = line_state_errors(records, predictions, args.latency + args.lead)
+            if errors:
+                print("  line state: prediction RMS {:.3f} (holding {:.3f}) | tick to tick change RMS {:.3f} "
+                      "(raw {:.3f})".format(errors['prediction_rms'], errors['hold_rms'],
+                                            errors['estimated_change_rms'], errors['raw_change_rms']))
+            print("  {}".format(estimator.format_stats()))
+
+        if args.noise_ratio is None and args.kp is None:
+            continue
+        positions = replay_positions(records, noise_ratio=args.noise_ratio if args.noise_ratio is not None else 0.1)
+        # The controller only ran on ticks with valid data while running
+        active = FLAG_RUNNING | FLAG_VALID
+        positions[(records['flags'] & active) != active] = np.nan
+        recorded = records['position'].astype(np.float64)
+        changed = np.sum(np.isnan(positions) != np.isnan(recorded))
+        print("  replayed positions: {} ticks change between line / no line".format(changed))
+        if args.kp is not None:
+            if args.estimator:
+                # The robot feeds the estimator's output to the PID and counts the line as lost when it gives none
+                _, positions = replay_line_state(records, args.latency, positions, alpha=args.alpha, beta=args.beta,
+                                                 lead=args.lead)
+            outputs = replay_pid(positions, args.kp, args.ki, args.kd, args.setpoint,
+                                 active=(records['flags'] & active) == active,
+                                 reset_on_reacquire=args.recovery_mode != 'pivot')
+            valid = controlled(records) & ~np.isnan(outputs)
+            difference = outputs[valid] - records['output'][valid]
+            if len(difference):
+                print("  replayed PID: RMS output difference {:.3f}, max {:.3f}".format(
+                    float(np.sqrt(np.mean(difference ** 2))), float(np.max(np.abs(difference)))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Distance-indexed track map learned by odometry, for lap-over-lap speed profiling.
+
+Run directly to map a simulated track and compare the following laps with and without the map:
+    python3 track_map.py --track rounded
+"""
+from array import array
+import argparse
+import math
+import os
+import struct
+
+# File header: magic, format version, bucket length in millimeters, number of buckets
+HEADER = struct.Struct('<4sHfI')
+MAGIC = b'LFTM'
+VERSION = 1
+
+MAPPING = 'mapping'
+FOLLOWING = 'following'
+
+
+class TrackMap:
+    """
+    Learns the curvature of a closed track as a function of the distance driven and plans a speed profile from it.
+
+    Odometry integrates the wheel encoders into distance and heading. The heading of the line under the sensor is the
+    robot heading plus the angle from the axle to the line, so the map records the curvature of the line ahead of
+    the robot rather than the robot's own wiggles. Curvature is averaged per distance bucket and kept in an array of
+    floats, a few bytes per bucket and so a few KB per lap.
+
+    While mapping, odometry also tracks the robot's x and y, and the lap is closed where the robot passes closest to
+    its starting point after turning most of a full circle, which assumes a simple loop without crossings. The robot
+    must start every run at the same place. On the following laps the position along the map is the driven distance
+    modulo the lap length, corrected every few buckets by matching the last measured curvatures against the map to
+    cancel odometry drift. speed() is then a single array lookup by bucket.
+
+    The speed profile limits the lateral acceleration in every bucket and then propagates braking and acceleration
+    limits around the loop, so the robot slows down before known corners instead of in them.
+    """
+    def __init__(self, bucket_length=20.0, wheel_radius=28.0, wheel_base=120.0, sensor_offset=80.0,
+                 sensor_pitch=8.0, setpoint=4.5, max_degrees_per_second=1050.0, min_speed=20.0, max_speed=80.0,
+                 lateral_acceleration=300.0, braking=1000.0, acceleration=500.0, window=16, search=5,
+                 closure_radius=150.0):
+        """
+        :param bucket_length: Length of a map bucket in millimeters.
+        :param wheel_radius: Wheel radius in millimeters.
+        :param wheel_base: Distance between the wheels in millimeters.
+        :param sensor_offset: Distance of the light array ahead of the axle in millimeters.
+        :param sensor_pitch: Spacing of the light array elements in millimeters.
+        :param max_degrees_per_second: Wheel speed at 100% speed, converts the profile into speed percentages.
+        :param lateral_acceleration: Maximum lateral acceleration in corners in mm/s^2.
+        :param braking: Maximum deceleration in mm/s^2.
+        :param acceleration: Maximum acceleration in mm/s^2.
+        :param window: Buckets of measured curvature matched against the map to correct drift.
+        :param search: Largest drift correction in buckets per match.
+        :param closure_radius: Distance in millimeters from the start within which the mapping lap may close.
+        """
+        self.bucket_length = bucket_length
+        self.wheel_base = wheel_base
+        self.sensor_offset = sensor_offset
+        self.sensor_pitch = sensor_pitch
+        self.setpoint = setpoint
+        self.mm_per_degree = 2.0 * math.pi * wheel_radius / 360.0
+        self.mm_per_speed = max_degrees_per_second * self.mm_per_degree / 100.0  # mm/s per percent of speed
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.lateral_acceleration = lateral_acceleration
+        self.braking = braking
+        self.acceleration = acceleration
+        self.window = window
+        self.search = search
+        self.closure_radius = closure_radius
+
+        self.curvatures = array('f')  # 1/mm per bucket
+        self.profile = array('f')  # Speed in percent per bucket
+        self.state = MAPPING
+        self.laps = 0
+        self.corrections = 0  # Drift corrections applied, in buckets
+
+        self._recent = array('f', [0.0] * window)  # Curvatures of the last buckets driven while following
+        self._recent_count = 0
+        self.reset_odometry()
+
+    def reset_odometry(self):
+        """
+        Start measuring from the current place, which must be where the map starts.
+        """
+        self.distance = 0.0
+        self.heading = 0.0
+        self.x = 0.0
+        self.y = 0.0
+        self._closest = None  # (distance from the start, buckets, distance driven) of the best lap closure so far
+        self._line_angle = 0.0
+        self._last_left = None
+        self._last_right = None
+        self._lap_start = 0.0
+        self._bucket_start_distance = 0.0
+        self._bucket_start_heading = None
+
+    @property
+    def lap_length(self):
+        return len(self.curvatures) * self.bucket_length
+
+    @property
+    def ready(self):
+        return self.state == FOLLOWING
+
+    def update(self, left_degrees, right_degrees, position):
+        """
+        Advance the odometry with the wheel encoder positions and the line position (None if not detected).
+        """
+        if self._last_left is None:
+            self._last_left = left_degrees
+            self._last_right = right_degrees
+            return
+        left = (left_degrees - self._last_left) * self.mm_per_degree
+        right = (right_degrees - self._last_right) * self.mm_per_degree
+        self._last_left = left_degrees
+        self._last_right = right_degrees
+
+        distance = (left + right) / 2.0
+        turn = (right - left) / self.wheel_base
+        self.distance += distance
+        if self.state == MAPPING:
+            middle = self.heading + turn / 2.0
+            self.x += distance * math.cos(middle)
+            self.y += distance * math.sin(middle)
+        self.heading += turn
+        if position is not None:
+            self._line_angle = math.atan2((position - self.setpoint) * self.sensor_pitch, self.sensor_offset)
+        line_heading = self.heading + self._line_angle
+
+        if self._bucket_start_heading is None:
+            self._bucket_start_heading = line_heading
+        while self.distance - self._bucket_start_distance >= self.bucket_length:
+            curvature = (line_heading - self._bucket_start_heading) / (self.distance - self._bucket_start_distance)
+            self._bucket_start_distance += self.bucket_length
+            self._bucket_start_heading = line_heading
+            self._end_bucket(curvature)
+
+    def _end_bucket(self, curvature):
+        if self.state == MAPPING:
+            self.curvatures.append(curvature)
+            if abs(self.heading) > 1.5 * math.pi:
+                radius = math.hypot(self.x, self.y)
+                if radius < self.closure_radius:
+                    if self._closest is None or radius < self._closest[0]:
+                        self._closest = (radius, len(self.curvatures), self._bucket_start_distance)
+                elif self._closest is not None:
+                    self._close_lap()
+            return
+
+        self._recent[self._recent_count % self.window] = curvature
+        self._recent_count += 1
+        if self.distance - self._lap_start >= self.lap_length:
+            self._lap_start += self.lap_length
+            self.laps += 1
+        # Matching costs window * (2 * search + 1) operations, spread it out to keep the ticks short
+        if self._recent_count >= self.window and self._recent_count % (self.window // 2) == 0:
+            self._relocalize()
+
+    def _close_lap(self):
+        radius, buckets, distance = self._closest
+        # The buckets driven since the closest approach already belong to the next lap
+        del self.curvatures[buckets:]
+        self.state = FOLLOWING
+        self._lap_start = distance
+        self.laps = 1
+        self.plan()
+
+    def _relocalize(self):
+        """
+        Shift the lap start by the offset (within search buckets) at which the last window of measured curvatures
+        best matches the map. Straights match everywhere equally well, so only curvy windows are used.
+        """
+        count = len(self.curvatures)
+        window = self.window
+        recent = self._recent
+        first = self._recent_count % window  # Oldest entry of the ring buffer
+        measured = [recent[(first + i) % window] for i in range(window)]
+        if max(abs(value) for value in measured) < 0.002:
+            return
+
+        current = self.bucket() - window  # Map bucket of the oldest measured curvature
+        curvatures = self.curvatures
+        errors = {}
+        for offset in range(-self.search, self.search + 1):
+            start = current + offset
+            error = 0.0
+            for i in range(window):
+                difference = measured[i] - curvatures[(start + i) % count]
+                error += difference * difference
+            errors[offset] = error
+        best_offset = min(errors, key=lambda offset: (errors[offset], abs(offset)))
+        # Only move for a clearly better match, noise alone should not make the position jitter
+        if best_offset and errors[best_offset] < 0.5 * errors[0]:
+            self._lap_start -= best_offset * self.bucket_length
+            self.corrections += abs(best_offset)
+
+    def plan(self):
+        """
+        Compute the speed profile from the curvature map.
+        """
+        count = len(self.curvatures)
+        curvatures = self.curvatures
+        ds = self.bucket_length
+        mm_per_speed = self.mm_per_speed
+
+        # Smooth the per bucket curvature over its neighbours, it is noisy from the line position quantization
+        limits = []
+        for i in range(count):
+            curvature = abs(curvatures[i - 1] + curvatures[i] + curvatures[(i + 1) % count]) / 3.0
+            speed = self.max_speed * mm_per_speed
+            if curvature > 0:
+                speed = min(speed, math.sqrt(self.lateral_acceleration / curvature))
+            limits.append(max(self.min_speed * mm_per_speed, speed))
+
+        # Braking backwards and acceleration forwards, twice around the loop so the limits wrap over the lap start
+        speeds = list(limits)
+        for i in range(2 * count - 1, -1, -1):
+            index = i % count
+            following = speeds[(index + 1) % count]
+            speeds[index] = min(speeds[index], math.sqrt(following * following + 2.0 * self.braking * ds))
+        for i in range(2 * count):
+            index = i % count
+            previous = speeds[index - 1]
+            speeds[index] = min(speeds[index], math.sqrt(previous * previous + 2.0 * self.acceleration * ds))
+
+        self.profile = array('f', (speed / mm_per_speed for speed in speeds))
+
+    def bucket(self):
+        """
+        :return: Index of the map bucket the robot is in.
+        """
+        return int((self.distance - self._lap_start) // self.bucket_length) % len(self.curvatures)
+
+    def speed(self):
+        """
+        :return: Planned base speed at the current position, None while mapping.
+        """
+        if self.state != FOLLOWING:
+            return None
+        return self.profile[self.bucket()]
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.bucket_length, len(self.curvatures)))
+            self.curvatures.tofile(f)
+
+    def load(self, path):
+        """
+        Load a map saved by save() and follow it from the current place.
+        """
+        with open(path, 'rb') as f:
+            magic, version, bucket_length, count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("{} is not a track map".format(path))
+            if version != VERSION:
+                raise ValueError("Unsupported track map version {}".format(version))
+            if count == 0:
+                raise ValueError("{} is an empty track map".format(path))
+            curvatures = array('f')
+            curvatures.fromfile(f, count)
+        self.follow(curvatures, bucket_length)
+
+    def follow(self, curvatures, bucket_length):
+        """
+        Follow a map of the given curvatures per bucket from the current place.
+        """
+        self.bucket_length = bucket_length
+        self.curvatures = array('f', curvatures)
+        self.state = FOLLOWING
+        self.laps = 0
+        self.reset_odometry()
+        self.plan()
+
+
+def compare(track='rounded', duration=90.0, path=None):
+    """
+    Drive a mapping run in the simulator, then a second run with the saved map and the speed scheduler for reference.
+    :return: List of (label, world summary, track map).
+    """
+    from line_follower import LineFollower
+    from simulation import SimulationBackend, TRACKS, run_simulation
+    from speed_scheduler import SpeedScheduler
+    import contextlib
+    import io
+    import tempfile
+
+    track = TRACKS[track]()
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), 'track_map.lftm')
+
+    results = []
+    for label in ("scheduled", "mapping", "mapped"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            follower = LineFollower(backend=SimulationBackend(track=track))
+            follower.debug_mode = False
+            follower.speed_scheduler = SpeedScheduler()
+            if label != "scheduled":
+                # The speed range the profile was tuned with in the simulator, not the follower's base speed
+                follower.enable_track_map(path, min_speed=20.0, max_speed=80.0)
+            summary = run_simulation(follower, duration)
+        results.append((label, summary, follower.track_map))
+    return results
+
+
+def main():
+    from simulation import TRACKS
+
+    parser = argparse.ArgumentParser(description="Map a simulated track and drive it with the learned speed profile.")
+    parser.add_argument('--track', default='rounded', choices=sorted(TRACKS))
+    parser.add_argument('--duration', type=float, default=90.0)
+    args = parser.parse_args()
+
+    for label, summary, track_map in compare(args.track, args.duration):
+        lap_times = ", ".join("{:.2f}".format(t) for t in summary['lap_times'])
+        print("{:<9} | laps {:2d} | lap times {} | RMS error {:5.1f} mm | max error {:5.1f} mm | off track {}".format(
+            label, summary['laps'], lap_times, summary['rms_error'], summary['max_error'], summary['off_track']))
+        if track_map is not None and track_map.ready:
+            print("          | map {} buckets, {:.0f} mm lap, {} bytes, {} drift corrections".format(
+                len(track_map.curvatures), track_map.lap_length,
+                HEADER.size + len(track_map.curvatures) * track_map.curvatures.itemsize, track_map.corrections))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Desktop client for the line follower's tuning server.
+
+The server only runs when the line follower is started with --tuning-server, and only accepts connections from other
+hosts with --tuning-host 0.0.0.0 (the commands are not authenticated, use it on a trusted network only):
+    python3 line_follower_python.py --tuning-server --tuning-host 0.0.0.0
+
+Examples:
+    python3 tuning_client.py --host ev3dev.local set kp=8 kd=10 base_speed=20
+    python3 tuning_client.py --host ev3dev.local start
+    python3 tuning_client.py --host ev3dev.local mode RAW
+    python3 tuning_client.py --host ev3dev.local calibrate sweep matte-paper
+    python3 tuning_client.py --host ev3dev.local profile on   # Time the hot path stages, "profile off" to stop
+    python3 tuning_client.py --host ev3dev.local watch
+    python3 tuning_client.py --host ev3dev.local plot   # Requires matplotlib
+"""
+from tuning_server import TuningClient, DEFAULT_PORT
+from collections import deque
+import argparse
+import json
+
+
+def parse_assignments(assignments):
+    values = {}
+    for assignment in assignments:
+        name, _, value = assignment.partition('=')
+        if not value:
+            raise argparse.ArgumentTypeError("Expected name=value, got {!r}".format(assignment))
+        values[name] = float(value)
+    return values
+
+
+def watch(client, decimation):
+    client.request({'cmd': 'subscribe', 'decimation': decimation})
+    while True:
+        message = client.receive()
+        if message is None:
+            break
+        sample = message.get('telemetry')
+        if sample is None:
+            continue
+        position = sample['position']
+        print("{:10.3f} | position {:>6} | correction {:7.2f} | L {:7.2f} R {:7.2f} | {:6.1f} Hz".format(
+            sample['t'], "-" if position is None else "{:.2f}".format(position), sample['correction'],
+            sample['left_speed'], sample['right_speed'], sample['loop_frequency']))
+
+
+def plot(client, decimation, history=500):
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
+
+    client.sock.setblocking(False)
+    client.send({'cmd': 'subscribe', 'decimation': decimation})
+    buffer = bytearray()
+    times, positions, corrections, lefts, rights = (deque(maxlen=history) for _ in range(5))
+
+    figure, (position_axes, speed_axes) = plt.subplots(2, 1, sharex=True)
+    position_line, = position_axes.plot([], [], label="position")
+    position_axes.axhline(4.5, color='gray', linewidth=0.5)
+    position_axes.set_ylim(0.5, 8.5)
+    position_axes.legend(loc='upper left')
+    correction_line, = speed_axes.plot([], [], label="correction")
+    left_line, = speed_axes.plot([], [], label="left")
+    right_line, = speed_axes.plot([], [], label="right")
+    speed_axes.set_ylim(-100, 100)
+    speed_axes.legend(loc='upper left')
+
+    def update(_):
+        try:
+            while True:
+                data = client.sock.recv(65536)
+                if not data:
+                    break
+                buffer.extend(data)
+        except BlockingIOError:
+            pass
+        while b'\n' in buffer:
+            end = buffer.index(b'\n')
+            message = json.loads(bytes(buffer[:end]).decode())
+            del buffer[:end + 1]
+            sample = message.get('telemetry')
+            if sample is None:
+                continue
+            times.append(sample['t'])
+            positions.append(sample['position'] if sample['position'] is not None else float('nan'))
+            corrections.append(sample['correction'])
+            lefts.append(sample['left_speed'])
+            rights.append(sample['right_speed'])
+        if times:
+            position_line.set_data(times, positions)
+            correction_line.set_data(times, corrections)
+            left_line.set_data(times, lefts)
+            right_line.set_data(times, rights)
+            if times[0] < times[-1]:
+                speed_axes.set_xlim(times[0], times[-1])
+        return position_line, correction_line, left_line, right_line
+
+    animation = FuncAnimation(figure, update, interval=50, cache_frame_data=False)
+    plt.show()
+    return animation
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the line follower and watch its telemetry over the network.")
+    parser.add_argument('--host', default='ev3dev.local')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--decimation', type=int, default=1, help="Receive every n-th telemetry sample")
+    parser.add_argument('command', choices=('set', 'start', 'stop', 'mode', 'calibrate', 'get', 'stats',
+                                            'reset_stats', 'profile', 'watch', 'plot'))
+    parser.add_argument('arguments', nargs='*', help="name=value pairs for set, RAW/CAL for mode, sweep [profile] "
+                                                     "or white/black for calibrate, on/off for profile")
+    args = parser.parse_args()
+
+    client = TuningClient(args.host, args.port)
+    try:
+        if args.command == 'watch':
+            watch(client, args.decimation)
+            return
+        if args.command == 'plot':
+            plot(client, args.decimation)
+            return
+
+        command = {'cmd': args.command}
+        if args.command == 'set':
+            command.update(parse_assignments(args.arguments))
+        elif args.command == 'mode':
+            command['mode'] = args.arguments[0].upper() if args.arguments else None
+        elif args.command == 'calibrate':
+            command['target'] = args.arguments[0].lower() if args.arguments else None
+            if len(args.arguments) > 1:
+                command['profile'] = args.arguments[1]
+        elif args.command == 'profile' and args.arguments:
+            command['enabled'] = args.arguments[0].lower() == 'on'
+        print(json.dumps(client.request(command), indent=2))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
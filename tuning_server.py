@@ -0,0 +1,443 @@
+from collections import deque
+from threading import Thread
+import json
+import math
+import selectors
+import socket
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 5005
+
+# Parameters the "set" command accepts, with their allowed ranges
+SETTABLE = {
+    'kp': (0.0, 1000.0),
+    'ki': (0.0, 1000.0),
+    'kd': (0.0, 1000.0),
+    'base_speed': (-100.0, 100.0),
+    'setpoint': (1.0, 8.0),
+}
+MODES = ('RAW', 'CAL')
+# 'sweep' runs the automatic calibration, 'white' and 'black' calibrate the sensor's CAL mode one surface at a time
+CALIBRATION_TARGETS = ('sweep', 'white', 'black')
+COMMANDS = ('set', 'mode', 'start', 'stop', 'calibrate', 'stats', 'reset_stats', 'profile', 'get', 'ping',
+            'subscribe', 'unsubscribe')
+
+# Legacy single letter commands of the old stdin parser, e.g. "p6.5"
+SHORTHAND = {'p': 'kp', 'i': 'ki', 'd': 'kd', 's': 'base_speed'}
+
+MAX_LINE = 4096
+MAX_OUTPUT = 65536  # Telemetry is dropped for subscribers with more than this many bytes unsent
+
+
+class CommandError(ValueError):
+    pass
+
+
+def parse_command(line):
+    """
+    Parse and validate one request line, either a JSON object such as {"cmd": "set", "kp": 8, "id": 1} or a legacy
+    shorthand such as "p6.5", "stats" or "mode RAW".
+    :return: The command as a dict with at least "cmd".
+    :raises CommandError: If the command is malformed or a value is out of range.
+    """
+    line = line.strip()
+    if line.startswith('{'):
+        try:
+            command = json.loads(line)
+        except ValueError as e:
+            raise CommandError("Invalid JSON: {}".format(e))
+        if not isinstance(command, dict):
+            raise CommandError("A command must be a JSON object")
+    else:
+        command = _parse_shorthand(line)
+
+    name = command.get('cmd')
+    if name not in COMMANDS:
+        raise CommandError("Unknown command {!r}, use one of: {}".format(name, ", ".join(COMMANDS)))
+
+    if name == 'set':
+        values = dict((key, value) for key, value in command.items() if key not in ('cmd', 'id'))
+        if not values:
+            raise CommandError("Nothing to set, use any of: {}".format(", ".join(sorted(SETTABLE))))
+        for key, value in values.items():
+            if key not in SETTABLE:
+                raise CommandError("Unknown parameter {!r}".format(key))
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise CommandError("{} must be a finite number".format(key))
+            low, high = SETTABLE[key]
+            if not low <= value <= high:
+                raise CommandError("{} must be between {} and {}".format(key, low, high))
+            command[key] = float(value)
+    elif name == 'mode':
+        if command.get('mode') not in MODES:
+            raise CommandError("mode must be one of: {}".format(", ".join(MODES)))
+    elif name == 'calibrate':
+        if command.get('target') not in CALIBRATION_TARGETS:
+            raise CommandError("target must be one of: {}".format(", ".join(CALIBRATION_TARGETS)))
+        profile = command.get('profile')
+        if profile is not None and (not isinstance(profile, str) or not profile):
+            raise CommandError("profile must be a non-empty string")
+    elif name == 'profile':
+        if 'enabled' in command and not isinstance(command['enabled'], bool):
+            raise CommandError("enabled must be true or false")
+    elif name == 'subscribe':
+        decimation = command.get('decimation', 1)
+        if isinstance(decimation, bool) or not isinstance(decimation, int) or decimation < 1:
+            raise CommandError("decimation must be a positive integer")
+        command['decimation'] = decimation
+    return command
+
+
+def _parse_shorthand(line):
+    words = line.split()
+    if not words:
+        raise CommandError("Empty command")
+    if words == ['reset', 'stats']:
+        return {'cmd': 'reset_stats'}
+    if words[0] == 'mode' and len(words) == 2:
+        return {'cmd': 'mode', 'mode': words[1].upper()}
+    if words[0] == 'profile' and len(words) == 2 and words[1] in ('on', 'off'):
+        return {'cmd': 'profile', 'enabled': words[1] == 'on'}
+    if words[0] == 'calibrate' and len(words) == 2:
+        return {'cmd': 'calibrate', 'target': words[1].lower()}
+    if words[0] == 'calibrate' and len(words) == 3:
+        return {'cmd': 'calibrate', 'target': words[1].lower(), 'profile': words[2]}
+    if len(words) == 1 and words[0] in COMMANDS:
+        return {'cmd': words[0]}
+    if len(words) == 1 and words[0][:1] in SHORTHAND:
+        try:
+            return {'cmd': 'set', SHORTHAND[words[0][0]]: float(words[0][1:])}
+        except ValueError:
+            raise CommandError("Invalid value. Please enter a numeric value after p, i, d, or s.")
+    raise CommandError("Invalid command. Use p, i, d, or s followed by a value, or a JSON command.")
+
+
+def _request_id(line):
+    """
+    :return: The "id" of a request line that failed validation, so the error reply can still be matched, or None.
+    """
+    try:
+        command = json.loads(line)
+    except ValueError:
+        return None
+    return command.get('id') if isinstance(command, dict) else None
+
+
+class _Client:
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.input = bytearray()
+        self.output = bytearray()
+        self.decimation = 0  # Subscribed to every n-th telemetry sample, 0 if not subscribed
+        self.counter = 0
+        self.dropped = 0
+
+
+class TuningServer:
+    """
+    TCP server for live tuning and telemetry, run by a selector in a background thread.
+
+    Clients send one command per line (see parse_command) and get one JSON reply per command, matched by the optional
+    "id". Commands are only validated by the server thread. They are queued and the control loop applies them all
+    between two ticks by calling process(), so a command never takes effect in the middle of a tick and several
+    values sent in one "set" change together.
+
+    Subscribers receive {"telemetry": {...}} lines. The control loop asks telemetry_due() every tick and only builds
+    a sample every `decimation` ticks while anyone is subscribed. Subscribers that do not keep up lose samples rather
+    than slowing anything down.
+    """
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, decimation=10):
+        """
+        :param host: Interface to listen on. The commands are not authenticated, so only the EV3 itself can connect by
+                     default, '0.0.0.0' accepts them from every host on the network.
+        :param port: TCP port, 0 to pick a free one (see address).
+        :param decimation: Offer a telemetry sample to subscribers every this many ticks.
+        """
+        self.decimation = decimation
+        self._selector = selectors.DefaultSelector()
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(4)
+        self._listener.setblocking(False)
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self.address = self._listener.getsockname()
+
+        # Wakes up the selector when the control loop queues replies or telemetry
+        self._wake_read, self._wake_write = socket.socketpair()
+        self._wake_read.setblocking(False)
+        self._wake_write.setblocking(False)
+        self._selector.register(self._wake_read, selectors.EVENT_READ)
+
+        self._clients = {}
+        self._commands = deque()  # (client, command) from the server thread to the control loop
+        self._outgoing = deque()  # (client or None for telemetry, message) from the control loop to the server thread
+        self._subscribers = 0
+        self._tick = 0
+        self._running = False
+        self._thread = None
+
+        self.commands_applied = 0
+        self.telemetry_sent = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = Thread(target=self._run, name='TuningServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._running = False
+        self._wake()
+        self._thread.join()
+        self._thread = None
+        for client in list(self._clients.values()):
+            self._close_client(client)
+        self._selector.close()
+        self._listener.close()
+        self._wake_read.close()
+        self._wake_write.close()
+
+    # Called from the control loop
+
+    def process(self, handler):
+        """
+        Apply all queued commands. Called by the control loop at a tick boundary.
+        :param handler: Function taking a command dict and returning a dict merged into the reply. It may raise
+                        CommandError to reject the command.
+        :return: Number of commands applied.
+        """
+        commands = self._commands
+        if not commands:
+            return 0
+        count = 0
+        while commands:
+            client, command = commands.popleft()
+            reply = {'ok': True}
+            try:
+                result = handler(command)
+                if result:
+                    reply.update(result)
+            except CommandError as e:
+                reply = {'ok': False, 'error': str(e)}
+            if 'id' in command:
+                reply['id'] = command['id']
+            self._outgoing.append((client, reply))
+            count += 1
+        self.commands_applied += count
+        self._wake()
+        return count
+
+    def telemetry_due(self):
+        """
+        :return: True if a telemetry sample should be published this tick.
+        """
+        if not self._subscribers:
+            return False
+        self._tick += 1
+        return self._tick % self.decimation == 0
+
+    def publish(self, sample):
+        """
+        :param sample: Dict of JSON serializable values, encoded by the server thread.
+        """
+        self._outgoing.append((None, sample))
+        self._wake()
+
+    # Server thread
+
+    def _wake(self):
+        try:
+            self._wake_write.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # A wake-up is already pending (or the server is closing)
+
+    def _run(self):
+        while self._running:
+            for key, events in self._selector.select():
+                if key.fileobj is self._listener:
+                    self._accept()
+                elif key.fileobj is self._wake_read:
+                    try:
+                        while self._wake_read.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    client = key.data
+                    if events & selectors.EVENT_READ:
+                        self._read(client)
+                    if events & selectors.EVENT_WRITE and client.sock.fileno() != -1:
+                        self._write(client)
+            self._send_outgoing()
+
+    def _accept(self):
+        try:
+            sock, address = self._listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = _Client(sock, address)
+        self._clients[sock.fileno()] = client
+        self._selector.register(sock, selectors.EVENT_READ, client)
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close_client(client)
+            return
+
+        client.input += data
+        while True:
+            end = client.input.find(b'\n')
+            if end < 0:
+                if len(client.input) > MAX_LINE:
+                    self._close_client(client)
+                return
+            line = client.input[:end].decode('utf-8', 'replace')
+            del client.input[:end + 1]
+            if line.strip():
+                self._handle_line(client, line)
+
+    def _handle_line(self, client, line):
+        try:
+            command = parse_command(line)
+        except CommandError as e:
+            reply = {'ok': False, 'error': str(e)}
+            command_id = _request_id(line)
+            if command_id is not None:
+                reply['id'] = command_id
+            self._queue(client, reply)
+            return
+
+        # Subscriptions and pings are answered by the server thread, everything else goes to the control loop
+        name = command['cmd']
+        if name in ('subscribe', 'unsubscribe', 'ping'):
+            if name == 'subscribe':
+                if not client.decimation:
+                    self._subscribers += 1
+                client.decimation = command['decimation']
+            elif name == 'unsubscribe' and client.decimation:
+                client.decimation = 0
+                self._subscribers -= 1
+            reply = {'ok': True}
+            if 'id' in command:
+                reply['id'] = command['id']
+            self._queue(client, reply)
+        else:
+            self._commands.append((client, command))
+
+    def _send_outgoing(self):
+        outgoing = self._outgoing
+        while outgoing:
+            client, message = outgoing.popleft()
+            if client is None:
+                line = None
+                for subscriber in list(self._clients.values()):
+                    if not subscriber.decimation:
+                        continue
+                    subscriber.counter += 1
+                    if subscriber.counter % subscriber.decimation:
+                        continue
+                    if len(subscriber.output) > MAX_OUTPUT:
+                        subscriber.dropped += 1
+                        continue
+                    if line is None:
+                        line = (json.dumps({'telemetry': message}) + "\n").encode()
+                    self._queue_bytes(subscriber, line)
+                    self.telemetry_sent += 1
+            elif client.sock.fileno() != -1:
+                self._queue(client, message)
+
+    def _queue(self, client, message):
+        self._queue_bytes(client, (json.dumps(message) + "\n").encode())
+
+    def _queue_bytes(self, client, data):
+        was_empty = not client.output
+        client.output += data
+        if was_empty:
+            self._write(client)
+
+    def _write(self, client):
+        if client.output:
+            try:
+                sent = client.sock.send(client.output)
+                del client.output[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self._close_client(client)
+                return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.output else 0)
+        self._selector.modify(client.sock, events, client)
+
+    def _close_client(self, client):
+        if client.sock.fileno() == -1:
+            return
+        if client.decimation:
+            self._subscribers -= 1
+            client.decimation = 0
+        del self._clients[client.sock.fileno()]
+        self._selector.unregister(client.sock)
+        client.sock.close()
+
+
+class TuningClient:
+    """
+    Blocking client for TuningServer, used by tuning_client.py and the loopback benchmark.
+    """
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, timeout=5.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self.sock.makefile('rb')
+        self._next_id = 0
+        self.telemetry = deque(maxlen=10000)  # Samples received while waiting for replies
+
+    def send(self, command):
+        """
+        Send a command dict without waiting for the reply.
+        :return: The id assigned to the command.
+        """
+        self._next_id += 1
+        command = dict(command, id=self._next_id)
+        self.sock.sendall((json.dumps(command) + "\n").encode())
+        return self._next_id
+
+    def receive(self):
+        """
+        :return: The next message from the server (a reply or a telemetry sample), None on disconnect.
+        """
+        line = self._file.readline()
+        if not line:
+            return None
+        return json.loads(line.decode())
+
+    def request(self, command):
+        """
+        Send a command and wait for its reply, keeping the telemetry received meanwhile.
+        :return: The reply dict.
+        """
+        command_id = self.send(command)
+        while True:
+            message = self.receive()
+            if message is None:
+                raise ConnectionError("Server closed the connection")
+            if 'telemetry' in message:
+                self.telemetry.append(message['telemetry'])
+            elif message.get('id') == command_id:
+                return message
+
+    def close(self):
+        self._file.close()
+        self.sock.close()
@@ -0,0 +1,211 @@
+from collections import deque, namedtuple
+from threading import Event, Thread
+import os
+import select
+import struct
+import time
+
+# The EV3 brick buttons' evdev device and their key codes (from linux/input-event-codes.h)
+BUTTONS_FILENAME = '/dev/input/by-path/platform-gpio_keys-event'
+BUTTON_CODES = {
+    103: 'up',
+    108: 'down',
+    105: 'left',
+    106: 'right',
+    28: 'enter',
+    14: 'backspace',
+}
+EV_KEY = 1
+
+# struct input_event: struct timeval (two native longs), type, code, value
+INPUT_EVENT = struct.Struct('llHHi')
+
+ButtonEvent = namedtuple('ButtonEvent', ['name', 'pressed', 'timestamp'])
+
+
+class ButtonEvents:
+    """
+    Queue of debounced button edge events. Producers call push(), usually from a background thread, the control loop
+    calls poll() once per tick. The queue is a deque, whose append and popleft are atomic, so no lock is needed.
+    """
+    def __init__(self, debounce=0.05, clock=time.monotonic, maxlen=32):
+        """
+        :param debounce: Edges of the same button closer together than this many seconds are ignored.
+        :param maxlen: Maximum number of queued events, the oldest are dropped beyond it.
+        """
+        self.debounce = debounce
+        self.clock = clock
+        self._queue = deque(maxlen=maxlen)
+        self._state = {}
+        self._last_edge = {}
+
+    def push(self, name, pressed, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock()
+        if self._state.get(name, False) == pressed:
+            return  # Not an edge (e.g. autorepeat)
+        last = self._last_edge.get(name)
+        # The state follows every edge, only the event of a bounce is dropped. Otherwise a quick release would leave
+        # the button pressed and the next real press would not be an edge.
+        self._state[name] = pressed
+        self._last_edge[name] = timestamp
+        if last is not None and timestamp - last < self.debounce:
+            return
+        self._queue.append(ButtonEvent(name, pressed, timestamp))
+
+    def poll(self):
+        """
+        :return: The oldest pending ButtonEvent, or None.
+        """
+        try:
+            return self._queue.popleft()
+        except IndexError:
+            return None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class EvdevButtonReader(ButtonEvents):
+    """
+    Reads the brick buttons' evdev device in a background thread, blocking in select() until an event arrives.
+    """
+    def __init__(self, path=BUTTONS_FILENAME, **kwargs):
+        ButtonEvents.__init__(self, **kwargs)
+        self.path = path
+        self._stop_event = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, name='EvdevButtonReader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            while not self._stop_event.is_set():
+                # Wake up regularly to notice stop()
+                if not select.select([fd], [], [], 0.2)[0]:
+                    continue
+                try:
+                    data = os.read(fd, INPUT_EVENT.size * 16)
+                except BlockingIOError:
+                    continue
+                for offset in range(0, len(data) - INPUT_EVENT.size + 1, INPUT_EVENT.size):
+                    seconds, microseconds, event_type, code, value = INPUT_EVENT.unpack_from(data, offset)
+                    if event_type == EV_KEY and code in BUTTON_CODES and value in (0, 1):
+                        self.push(BUTTON_CODES[code], value == 1)
+        finally:
+            os.close(fd)
+
+
+class PollingButtonReader(ButtonEvents):
+    """
+    Fallback for button objects without an evdev device: polls buttons_pressed in a background thread.
+    """
+    def __init__(self, buttons, interval=0.02, **kwargs):
+        ButtonEvents.__init__(self, **kwargs)
+        self.buttons = buttons
+        self.interval = interval
+        self._stop_event = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, name='PollingButtonReader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            pressed = self.buttons.buttons_pressed
+            for name in BUTTON_CODES.values():
+                self.push(name, name in pressed)
+
+
+class AsyncSpeaker:
+    """
+    Plays speech and beeps from a background thread so the control loop never waits for espeak.
+    Only the newest messages are kept: the queue holds at most maxlen entries and messages that waited longer than
+    max_age by the time they would be played are dropped as stale.
+    """
+    def __init__(self, sound=None, max_age=2.0, maxlen=3, clock=time.monotonic, create_sound=None):
+        """
+        :param sound: An ev3dev2 Sound (or stand-in) doing the actual, blocking playback.
+        :param create_sound: Function returning the Sound if sound is None, called in the speaker thread before the
+                             first message is played so the import and setup never delay the caller.
+        """
+        self.sound = sound
+        self._create_sound = create_sound
+        self.max_age = max_age
+        self.clock = clock
+        self.dropped = 0
+        self._queue = deque(maxlen=maxlen)
+        self._wake = Event()
+        self._stopping = False
+        self._thread = Thread(target=self._run, name='AsyncSpeaker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def speak(self, text):
+        self._queue.append(('speak', text, self.clock()))
+        self._wake.set()
+
+    def beep(self):
+        self._queue.append(('beep', None, self.clock()))
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            while True:
+                try:
+                    kind, text, queued = self._queue.popleft()
+                except IndexError:
+                    break
+                if self.clock() - queued > self.max_age:
+                    self.dropped += 1
+                    continue
+                if self.sound is None:
+                    self.sound = self._create_sound()
+                if kind == 'speak':
+                    self.sound.speak(text)
+                else:
+                    self.sound.beep()
+            if self._stopping:
+                return
+
+    def stop(self):
+        """
+        Play what is still queued and stop the thread.
+        """
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None